@@ -0,0 +1,174 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+HISTORICAL BACKFILL
+
+Ingests TotalDistribution events for a block or date range, e.g. the whole contract history:
+
+    python backfill.py --from-block 19000000 --to-block 19500000
+    python backfill.py --from-date 2024-01-01 --to-date 2024-03-01
+
+Range is split into shards of BACKFILL_SHARD_SIZE blocks, fetched and decoded in BACKFILL_WORKERS processes
+and stored by the main process, each shard in a single transaction together with its progress record.
+Started again with the same range, backfill skips done shards, so an interrupted run continues where it stopped.
+Shards are leased to the instance fetching them just before they are fetched, so backfills of the same range
+started on several hosts share the shards instead of fetching each of them on every host.
+Only confirmed blocks are backfilled, sync cursor of the scheduled ingestion is not touched.
+
+plan_shards() -- split block range into shards aligned to BACKFILL_SHARD_SIZE
+fetch_shard() -- fetch and decode shard logs, runs in a worker process
+claim_shards() -- lease not done shards to this instance one by one, skipping shards leased by other instances
+backfill() -- fetch, decode and store not done shards, logging throughput
+"""
+import argparse
+import datetime
+import itertools
+import logging
+import multiprocessing
+import time
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+
+from blockchain.events import last_block, fetch_logs, decode_logs, find_block_by_time
+from metrics import metrics
+from db.coordination import get_coordinator
+from db.database import create_db_and_tables, get_backfill_shards, store_backfill_shard
+from settings import BACKFILL_SHARD_SIZE, BACKFILL_WORKERS, CONFIRMATION_BLOCKS, BACKFILL_SHARD_LEASE_TTL
+
+logger = logging.getLogger(__name__)
+
+
+def plan_shards(start_block, end_block, shard_size=BACKFILL_SHARD_SIZE):
+    """ Splits block range into shards. Shards are aligned to shard_size, so backfills of overlapping ranges
+    share their shards and don't fetch them twice
+
+    :return list: (start_block, end_block) tuples, both included """
+    shards = []
+    shard_start = start_block
+    while shard_start <= end_block:
+        shard_end = min((shard_start // shard_size + 1) * shard_size - 1, end_block)
+        shards.append((shard_start, shard_end))
+        shard_start = shard_end + 1
+    return shards
+
+
+def fetch_shard(start_block, end_block):
+    """ Fetches and decodes shard logs, runs in a worker process (with its own RPC connections and caches)
+
+    :return list: decoded events dicts, None if some logs were not fetched or decoded """
+    logs = fetch_logs(start_block, end_block)
+    if logs is None:
+        return None
+    events = decode_logs([log for log in logs if not log.get('removed')])
+    if None in events:
+        return None
+    return events
+
+
+def shard_lease_name(shard) -> str:
+    return f"backfill_shard:{shard[0]}-{shard[1]}"
+
+
+def claim_shards(shards, skipped):
+    """ Leases shards to this instance as they are taken from the generator. Shard leased by another instance,
+    or done by it after this backfill started, is skipped
+
+    :param skipped: list the skipped shards are appended to
+    :return: generator of claimed (start_block, end_block) tuples """
+    for shard in shards:
+        if get_coordinator().acquire(shard_lease_name(shard), BACKFILL_SHARD_LEASE_TTL):
+            if get_backfill_shards([shard]) == [shard]:
+                yield shard
+                continue
+            get_coordinator().release(shard_lease_name(shard))
+        skipped.append(shard)
+
+
+def backfill(start_block, end_block, workers=BACKFILL_WORKERS, shard_size=BACKFILL_SHARD_SIZE) -> bool:
+    """ Backfills events from not done shards of the block range
+
+    :param workers: worker processes, 0 — fetch and decode in this process
+    :return bool: True if all shards are done, False if some failed and backfill must be started again """
+    shards = get_backfill_shards(plan_shards(start_block, end_block, shard_size))
+    if shards is None:
+        return False
+    total_blocks = sum(shard_end - shard_start + 1 for shard_start, shard_end in shards)
+    logger.info(f"Backfill of blocks {start_block}-{end_block}: {len(shards)} shards, {total_blocks} blocks to go")
+
+    started_at = time.perf_counter()
+    metrics_snapshot = metrics.snapshot()
+    done_blocks = events_count = failed_shards = 0
+    skipped_shards = []
+    claimed_shards = claim_shards(shards, skipped_shards)
+
+    def store_shard(shard, events):
+        nonlocal done_blocks, events_count, failed_shards
+        shard_start, shard_end = shard
+        stored_count = None if events is None else store_backfill_shard(events, shard_start, shard_end)
+        get_coordinator().release(shard_lease_name(shard))
+        if stored_count is None:
+            failed_shards += 1
+            logger.error(f"Shard {shard_start}-{shard_end} failed, it will be retried on the next run")
+            return
+        done_blocks += shard_end - shard_start + 1
+        events_count += len(events)
+        elapsed = time.perf_counter() - started_at
+        logger.info(f"Shard {shard_start}-{shard_end}: {len(events)} events. "
+                    f"Done {done_blocks}/{total_blocks} blocks, {done_blocks / elapsed:.0f} blocks/s, "
+                    f"{events_count / elapsed:.1f} events/s")
+
+    if workers:
+        # spawned workers don't inherit parent's open RPC and db connections
+        # a shard is claimed when a worker is free for it, so other instances can take the rest
+        with ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context("spawn")) as executor:
+            futures = {executor.submit(fetch_shard, *shard): shard
+                       for shard in itertools.islice(claimed_shards, workers)}
+            while futures:
+                done_futures, _ = wait(futures, return_when=FIRST_COMPLETED)
+                for future in done_futures:
+                    shard = futures.pop(future)
+                    try:
+                        events = future.result()
+                    except Exception as e:
+                        logger.error(f"Failed to fetch shard {shard}: {e}")
+                        events = None
+                    store_shard(shard, events)
+                    for next_shard in itertools.islice(claimed_shards, 1):
+                        futures[executor.submit(fetch_shard, *next_shard)] = next_shard
+    else:
+        for shard in claimed_shards:
+            store_shard(shard, fetch_shard(*shard))
+
+    logger.info(f"Backfill finished in {time.perf_counter() - started_at:.1f}s: {done_blocks} blocks, "
+                f"{events_count} events, {failed_shards} shards failed, "
+                f"{len(skipped_shards)} shards done or being done by other instances")
+    logger.info(f"Backfill summary: {metrics.summary(metrics_snapshot)}")
+    return not failed_shards
+
+
+def parse_date(value):
+    return datetime.datetime.strptime(value, "%Y-%m-%d")
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description="Backfill TotalDistribution events history")
+    parser.add_argument("--from-block", type=int, help="first block of the range")
+    parser.add_argument("--to-block", type=int, help="last block of the range, the last confirmed block by default")
+    parser.add_argument("--from-date", type=parse_date, help="first day of the range (UTC), e.g. 2024-01-01")
+    parser.add_argument("--to-date", type=parse_date, help="day after the range (UTC), e.g. 2024-03-01")
+    parser.add_argument("--workers", type=int, default=BACKFILL_WORKERS, help="worker processes")
+    parser.add_argument("--shard-size", type=int, default=BACKFILL_SHARD_SIZE, help="blocks in a shard")
+    args = parser.parse_args()
+    if (args.from_block is None) == (args.from_date is None):
+        parser.error("one of --from-block or --from-date is required")
+
+    create_db_and_tables()
+    confirmed_block = last_block() - CONFIRMATION_BLOCKS
+    from_block = args.from_block if args.from_block is not None else find_block_by_time(args.from_date)
+    to_block = args.to_block if args.to_block is not None else confirmed_block
+    if args.to_date is not None:
+        to_block = find_block_by_time(args.to_date) - 1
+    to_block = min(to_block, confirmed_block)
+
+    if not backfill(from_block, to_block, workers=args.workers, shard_size=args.shard_size):
+        raise SystemExit(1)
@@ -0,0 +1,9 @@
+# -*- coding: utf-8 -*-
+"""
+BENCHMARKS
+
+Performance harness: synthetic TotalDistribution history served by local JSON-RPC and Telegram Bot API stand-ins,
+end-to-end ingestion, db queries and reports are timed and written as JSON to compare releases.
+
+    python -m benchmarks.bench --years 1 --events-per-day 100 --output results.json
+"""
@@ -0,0 +1,166 @@
+# -*- coding: utf-8 -*-
+"""
+SYNTHETIC CHAIN
+
+Deterministic TotalDistribution history and local servers standing in for the Ethereum node and Telegram.
+Blocks are not stored: block n is mined at genesis + 12 * n seconds and its hash is n as 32 bytes,
+only events (with their transactions) are generated.
+
+SyntheticChain -- generated events history, answers JSON-RPC requests the project makes
+serve_chain() -- JSON-RPC server of the chain on a local port
+serve_bot_api() -- Telegram Bot API stand-in accepting sendMessage on a local port
+"""
+import bisect
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+from eth_utils import keccak
+from settings import CONTRACT_ADDRESS, TOTAL_DISTRIBUTION_EVENT_SIGNATURE_TEXT
+
+
+BLOCK_TIME = 12  # seconds
+LOGS_LIMIT = 10000  # eth_getLogs results limit, as Infura has
+TOPIC = "0x" + keccak(text=TOTAL_DISTRIBUTION_EVENT_SIGNATURE_TEXT).hex()
+
+
+def to_hash(number) -> str:
+    return "0x" + f"{number:064x}"
+
+
+class SyntheticChain:
+    """ Events history ending at the current time
+
+    :param years: history length
+    :param events_per_day: TotalDistribution events a day, in random blocks
+    :param wallets: number of distributor wallets sending distribution transactions
+    :param seed: random seed, the same parameters and seed give the same chain """
+
+    def __init__(self, years=1.0, events_per_day=100, wallets=1, seed=1):
+        self.head = int(years * 365 * 24 * 60 * 60 / BLOCK_TIME)
+        self.genesis_timestamp = int(time.time()) - self.head * BLOCK_TIME
+        self.wallets = ["0x" + f"{0xd15 + number:040x}" for number in range(wallets)]
+        generator = random.Random(seed)
+        events_count = int(years * 365 * events_per_day)
+        blocks = sorted(generator.randrange(1, self.head + 1) for _ in range(events_count))
+        self.events = []  # (block, log index, tx number, wallet, data)
+        for tx_number, block in enumerate(blocks, start=1):
+            log_index = 0 if not self.events or self.events[-1][0] != block else self.events[-1][1] + 1
+            input_amount = generator.randrange(10 ** 18, 10 ** 22)
+            distributed_amount = input_amount * 9 // 10
+            swapped_amount = generator.randrange(10 ** 15, 10 ** 18)
+            words = (input_amount, distributed_amount, swapped_amount, swapped_amount * 9 // 10)
+            data = "0x" + "".join(f"{word:064x}" for word in words)
+            self.events.append((block, log_index, tx_number, generator.choice(self.wallets), data))
+        self.event_blocks = [event[0] for event in self.events]
+        self.senders = {to_hash(event[2]): event[3] for event in self.events}
+        self.requests = {}  # method: count
+        self._lock = threading.Lock()
+
+    def block(self, number):
+        return {'number': hex(number), 'hash': to_hash(number), 'parentHash': to_hash(max(number - 1, 0)),
+                'timestamp': hex(self.genesis_timestamp + number * BLOCK_TIME), 'transactions': []}
+
+    def log(self, event):
+        block, log_index, tx_number, _, data = event
+        return {'address': CONTRACT_ADDRESS, 'topics': [TOPIC], 'data': data, 'blockNumber': hex(block),
+                'blockHash': to_hash(block), 'transactionHash': to_hash(tx_number), 'transactionIndex': '0x0',
+                'logIndex': hex(log_index), 'removed': False}
+
+    def get_logs(self, filter_params):
+        start_block = int(filter_params.get('fromBlock', '0x0'), 16)
+        end_block = min(int(filter_params.get('toBlock', hex(self.head)), 16), self.head)
+        first = bisect.bisect_left(self.event_blocks, start_block)
+        last = bisect.bisect_right(self.event_blocks, end_block)
+        if last - first > LOGS_LIMIT:
+            raise ValueError(f"query returned more than {LOGS_LIMIT} results")
+        return [self.log(event) for event in self.events[first:last]]
+
+    def call(self, method, params):
+        """ Result of JSON-RPC method, raises ValueError for errors """
+        with self._lock:
+            self.requests[method] = self.requests.get(method, 0) + 1
+        if method == 'eth_getLogs':
+            return self.get_logs(params[0])
+        if method == 'eth_blockNumber':
+            return hex(self.head)
+        if method == 'eth_getBlockByNumber':
+            number = self.head if params[0] == 'latest' else int(params[0], 16)
+            return self.block(number) if number <= self.head else None
+        if method == 'eth_getBlockByHash':
+            number = int(params[0], 16)
+            return self.block(number) if number <= self.head else None
+        if method == 'eth_getTransactionByHash':
+            sender = self.senders.get(params[0])
+            return sender and {'hash': params[0], 'from': sender}
+        if method == 'eth_getBalance':
+            return hex(10 ** 18 + int(params[0], 16))
+        if method == 'eth_chainId':
+            return '0x1'
+        if method == 'web3_clientVersion':
+            return "synthetic-chain/1.0"
+        raise ValueError(f"the method {method} does not exist")
+
+    def respond(self, request):
+        try:
+            return {'jsonrpc': '2.0', 'id': request.get('id'), 'result': self.call(request['method'],
+                                                                                   request.get('params', []))}
+        except ValueError as e:
+            return {'jsonrpc': '2.0', 'id': request.get('id'), 'error': {'code': -32005, 'message': str(e)}}
+
+
+def start_server(handler_class) -> ThreadingHTTPServer:
+    server = ThreadingHTTPServer(('127.0.0.1', 0), handler_class)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def send_json(handler, body, status=200):
+    body = json.dumps(body).encode()
+    handler.send_response(status)
+    handler.send_header('Content-Type', 'application/json')
+    handler.send_header('Content-Length', str(len(body)))
+    handler.end_headers()
+    handler.wfile.write(body)
+
+
+def serve_chain(chain: SyntheticChain) -> ThreadingHTTPServer:
+    """ Serves chain JSON-RPC (single and batch requests) at http://127.0.0.1:server.server_port """
+    class JSONRPCHandler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"  # keep-alive, as real providers
+
+        def do_POST(self):
+            payload = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+            if isinstance(payload, list):
+                send_json(self, [chain.respond(request) for request in payload])
+            else:
+                send_json(self, chain.respond(payload))
+
+        def log_message(self, *args):
+            pass
+
+    return start_server(JSONRPCHandler)
+
+
+def serve_bot_api(sent_messages: list) -> ThreadingHTTPServer:
+    """ Telegram Bot API stand-in: every sendMessage succeeds and (chat id, text) is appended to sent_messages.
+    Use with telebot.apihelper.API_URL = f"http://127.0.0.1:{server.server_port}/bot{{0}}/{{1}}" """
+    class BotAPIHandler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def do_POST(self):
+            self.rfile.read(int(self.headers.get('Content-Length', 0)))
+            params = parse_qs(urlparse(self.path).query)
+            chat_id = int(params['chat_id'][0])
+            sent_messages.append((chat_id, params['text'][0]))
+            send_json(self, {'ok': True, 'result': {'message_id': len(sent_messages), 'date': int(time.time()),
+                                                    'chat': {'id': chat_id, 'type': 'group'}}})
+
+        def log_message(self, *args):
+            pass
+
+    return start_server(BotAPIHandler)
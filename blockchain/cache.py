@@ -0,0 +1,126 @@
+# -*- coding: utf-8 -*-
+"""
+BLOCKCHAIN DATA CACHE
+
+Confirmed blockchain data never changes, so there is no need to ask the node for it twice.
+
+LRUCache -- bounded least recently used cache with hit/miss counters and optional persistence to a json file
+TTLCache -- cache for data which changes over time (e.g. wallet balances), items expire after ttl seconds
+"""
+import json
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+
+
+logger = logging.getLogger(__name__)
+
+
+class LRUCache:
+    """ Bounded dict-like cache; when it's full the least recently used item is evicted.
+
+    If path is given, cache is loaded from the json file on creation and written back by save(),
+    so it survives restarts. Keys and values must be json serializable (block nums, hashes, timestamps). """
+
+    def __init__(self, maxsize, path=None):
+        self.maxsize = maxsize
+        self.path = path
+        self.hits = 0
+        self.misses = 0
+        self._items = OrderedDict()
+        self._lock = threading.Lock()  # logs are fetched and decoded from a few threads
+        if path:
+            self.load()
+
+    def __len__(self):
+        return len(self._items)
+
+    def __contains__(self, key):
+        return key in self._items
+
+    def get(self, key, default=None):
+        """ Returns cached value and marks it as recently used, counts hits and misses """
+        with self._lock:
+            if key in self._items:
+                self.hits += 1
+                self._items.move_to_end(key)
+                return self._items[key]
+            self.misses += 1
+            return default
+
+    def set(self, key, value):
+        """ Adds value to cache, evicting the least recently used item if cache is full """
+        with self._lock:
+            self._items[key] = value
+            self._items.move_to_end(key)
+            while len(self._items) > self.maxsize:
+                self._items.popitem(last=False)
+
+    def stats(self) -> dict[str, any]:
+        """ Cache counters for monitoring """
+        requests = self.hits + self.misses
+        return {'size': len(self._items), 'hits': self.hits, 'misses': self.misses,
+                'hit_rate': self.hits / requests if requests else 0.0}
+
+    def load(self):
+        """ Loads cache items from json file, missing or broken file means an empty cache """
+        try:
+            with open(self.path) as cache_file:
+                items = json.load(cache_file)
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError) as e:
+            logger.error(f"Can't load cache from {self.path}: {e}")
+            return
+        with self._lock:
+            # items are stored as [key, value] pairs from the least to the most recently used
+            for key, value in items[-self.maxsize:]:
+                self._items[key] = value
+
+    def save(self):
+        """ Writes cache items to json file (through temp file, so a crash won't leave it half written) """
+        if not self.path:
+            return
+        with self._lock:
+            items = list(self._items.items())
+        temp_path = f"{self.path}.tmp"
+        try:
+            with open(temp_path, "w") as cache_file:
+                json.dump(items, cache_file)
+            os.replace(temp_path, self.path)
+        except OSError as e:
+            logger.error(f"Can't save cache to {self.path}: {e}")
+
+
+class TTLCache:
+    """ Dict-like cache which items expire ttl seconds after they were set """
+
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._items = {}  # key: (expiration monotonic time, value)
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        """ Returns cached value if it's not expired yet, counts hits and misses """
+        with self._lock:
+            expires_at, value = self._items.get(key, (0, default))
+            if expires_at > time.monotonic():
+                self.hits += 1
+                return value
+            self._items.pop(key, None)
+            self.misses += 1
+            return default
+
+    def set(self, key, value):
+        with self._lock:
+            self._items[key] = (time.monotonic() + self.ttl, value)
+
+    def stats(self) -> dict[str, any]:
+        """ Cache counters for monitoring """
+        requests = self.hits + self.misses
+        return {'size': len(self._items), 'hits': self.hits, 'misses': self.misses,
+                'hit_rate': self.hits / requests if requests else 0.0}
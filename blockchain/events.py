@@ -4,81 +4,432 @@ BLOCKCHAIN EVENTS
 
 Module with all functions to get data from ETH blockchain
 
-fetch_logs() -- filter and get smart contracts event logs
+fetch_logs() -- get logs of all tracked contracts and events, block range is split into chunks fetched in parallel
+plan_chunks() -- split block range into chunks of given size
 decode_log() -- decode and process each fetched from blockchain event log to event dict
+decode_logs() -- route a batch of logs to their events decoders, blocks and transactions data is requested
+    in JSON-RPC batches
+rpc_batch() -- send many JSON-RPC requests in a few HTTP round trips
+get_provider_pool() -- pool of RPC providers endpoints, created on the first use
+get_web3() -- Web3 client sending requests through the providers pool, created on the first use
+get_block_timestamp(), get_transaction_sender() -- cached blocks and transactions data needed to decode logs
+get_block_hash() -- hash of the canonical block with given number, to detect chain reorganizations
+save_rpc_caches() -- persist cached blocks and transactions data to disk
 get_wallet_balance() -- used for creating reports
+get_wallet_balances() -- balances of many wallets in a single JSON-RPC batch, cached for a short time
 last_block() -- get last block num
+find_block_by_time() -- first block mined at or after given time
+follow_heads() -- stream of new head block nums, from WebSocket newHeads subscription or head polling
 """
+import json
 import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
 from datetime import datetime
-from web3 import Web3
 from decimal import Decimal
-from settings import WEB3_PROVIDER_URL, CONTRACT_ADDRESS, TOTAL_DISTRIBUTION_EVENT_SIGNATURE_TEXT
+from eth_utils import from_wei, to_checksum_address
+from hexbytes import HexBytes
+from settings import WEB3_PROVIDER_URLS
+from settings import LOGS_CHUNK_SIZE, LOGS_MAX_CHUNK_SIZE, LOGS_FETCH_WORKERS
+from settings import WEB3_WS_PROVIDER_URL, STREAM_POLL_INTERVAL
+from settings import RPC_CACHE_SIZE, RPC_CACHE_DIR, RPC_BATCH_SIZE, RPC_TIMEOUT, BALANCE_CACHE_TTL
+from blockchain.cache import LRUCache, TTLCache
+from blockchain.registry import event_registry, TOTAL_DISTRIBUTION
+from metrics import metrics
 
 
 # Setup logging for monitoring and debugging
 logger = logging.getLogger(__name__)
 
 
-# Initialize Web3
-web3 = Web3(Web3.HTTPProvider(WEB3_PROVIDER_URL))
-assert web3.is_connected(), logger.error("Failed to connect to the Ethereum network. Check WEB3_PROVIDER_URL.")
+# Web3 is imported and initialized on the first use by get_web3(), so importing this module is fast
+# and doesn't need the network
+web3 = None
+web3_lock = threading.Lock()
 
+# Providers pool is shared by Web3 and JSON-RPC batches, its endpoints keep connections alive and reused
+provider_pool = None
+provider_pool_lock = threading.Lock()
 
-# Keccak hash of the TotalDistribution event signature
-event_signature = web3.keccak(text=TOTAL_DISTRIBUTION_EVENT_SIGNATURE_TEXT).hex()
 
+def get_provider_pool():
+    """ Returns pool of WEB3_PROVIDER_URLS endpoints, creating it on the first call """
+    global provider_pool
+    with provider_pool_lock:
+        if provider_pool is None:
+            from blockchain.providers import ProviderPool  # imports web3, which takes about a second
+            provider_pool = ProviderPool(WEB3_PROVIDER_URLS)
+        return provider_pool
 
-def fetch_logs(start_block, end_block):
-    """ Fetches logs with TotalDistribution event from smart contract in the given block range.
 
-    :params start_block, end_block: blockchain block range
-    :return list: of blockchain smart contract filtered by block range, contract address and event signature logs """
-    filter_params = {
-        'fromBlock': start_block,
-        'toBlock': end_block,
-        'address': CONTRACT_ADDRESS,
-        'topics': [event_signature],
-    }
+def get_web3():
+    """ Returns Web3 client, creating it and checking connection on the first call """
+    global web3
+    pool = get_provider_pool()
+    with web3_lock:
+        if web3 is None:
+            from web3 import Web3  # web3 import takes about a second
+            from blockchain.providers import PoolProvider
+            client = Web3(PoolProvider(pool))
+            if not client.is_connected():
+                logger.error("Failed to connect to the Ethereum network. Check WEB3_PROVIDER_URLS.")
+            web3 = client
+        return web3
+
+
+# Block with given hash and transaction with given hash never change, even if chain is reorganized,
+# so their timestamps and senders are cached by hashes
+block_timestamps = LRUCache(RPC_CACHE_SIZE, RPC_CACHE_DIR and os.path.join(RPC_CACHE_DIR, "block_timestamps.json"))
+transaction_senders = LRUCache(RPC_CACHE_SIZE,
+                               RPC_CACHE_DIR and os.path.join(RPC_CACHE_DIR, "transaction_senders.json"))
+# Balances change, but reports made at the same time (e.g. for a few chats or commands) can share them
+wallet_balances = TTLCache(BALANCE_CACHE_TTL)
+metrics.add_collector(lambda: [
+    (f"cache_{counter}_total", {'cache': name}, getattr(cache, counter))
+    for name, cache in (('block_timestamps', block_timestamps), ('transaction_senders', transaction_senders),
+                        ('wallet_balances', wallet_balances))
+    for counter in ('hits', 'misses')])
+
+# Parts of providers error messages meaning that block range or response is too big and should be split
+# (Infura, Alchemy, QuickNode, geth etc. all use different wording)
+RANGE_ERROR_MARKERS = ('more than', 'too many', 'too large', 'limit exceeded', 'response size', 'block range',
+                       'timeout', 'timed out')
+
+
+def plan_chunks(start_block, end_block, chunk_size):
+    """ Splits block range into chunks
+
+    :params start_block, end_block: blockchain block range, both included
+    :param chunk_size: max blocks in a chunk
+    :return list: of (start_block, end_block) tuples """
+    return [(chunk_start, min(chunk_start + chunk_size - 1, end_block))
+            for chunk_start in range(start_block, end_block + 1, chunk_size)]
+
+
+def is_range_error(error):
+    """ Checks if provider rejected a request because block range or result size is too big, or it timed out """
+    message = f"{type(error).__name__} {error}".lower()
+    return any(marker in message for marker in RANGE_ERROR_MARKERS)
+
+
+def fetch_chunk_logs(start_block, end_block):
+    """ Fetches logs for a single chunk, bisecting it while provider says the range is too big
+
+    :params start_block, end_block: chunk block range
+    :return tuple: logs list and size of the biggest range provider accepted """
     try:
-        return web3.eth.get_logs(filter_params)
+        return list(get_web3().eth.get_logs(event_registry.logs_filter(start_block, end_block))), \
+            end_block - start_block + 1
     except Exception as e:
-        logger.error(f"Failed to fetch logs: {e}")
-        return []
+        if start_block == end_block or not is_range_error(e):
+            raise
+        middle_block = (start_block + end_block) // 2
+        logger.info(f"Splitting blocks {start_block}-{end_block} in two: {e}")
+        left_logs, left_size = fetch_chunk_logs(start_block, middle_block)
+        right_logs, right_size = fetch_chunk_logs(middle_block + 1, end_block)
+        return left_logs + right_logs, min(left_size, right_size)
+
 
+@metrics.timed("fetch_logs")
+def fetch_logs(start_block, end_block):
+    """ Fetches logs of all tracked events (TotalDistribution and TRACKED_EVENTS) in the given block range,
+    with a single filter, so the number of requests doesn't depend on the number of tracked events.
+
+    Range is fetched by chunks over a pool of LOGS_FETCH_WORKERS threads. Chunk which provider rejects as too big is
+    bisected, next chunks are planned with the size that worked; after each successful chunk size is doubled
+    up to LOGS_MAX_CHUNK_SIZE.
+
+    :params start_block, end_block: blockchain block range
+    :return list: of blockchain smart contracts logs filtered by block range, contracts addresses and events topics
+        or None if logs can't be fetched, so caller won't mistake a failure for an empty block range """
+    logs = []
+    chunk_size = LOGS_CHUNK_SIZE
+    next_block = start_block
+    with ThreadPoolExecutor(max_workers=LOGS_FETCH_WORKERS) as executor:
+        running = {}  # future: requested chunk size
+        try:
+            while next_block <= end_block or running:
+                # keep the pool busy with next chunks of currently best known size
+                while next_block <= end_block and len(running) < LOGS_FETCH_WORKERS:
+                    chunk_end = min(next_block + chunk_size - 1, end_block)
+                    running[executor.submit(fetch_chunk_logs, next_block, chunk_end)] = chunk_end - next_block + 1
+                    next_block = chunk_end + 1
 
-def decode_log(log):
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    requested_size = running.pop(future)
+                    chunk_logs, accepted_size = future.result()
+                    logs.extend(chunk_logs)
+                    if accepted_size < requested_size:
+                        chunk_size = min(chunk_size, accepted_size)
+                    else:
+                        chunk_size = min(max(chunk_size, requested_size * 2), LOGS_MAX_CHUNK_SIZE)
+        except Exception as e:
+            for future in running:
+                future.cancel()
+            logger.error(f"Failed to fetch logs: {e}")
+            return None
+
+    # chunks are finished in any order
+    logs.sort(key=lambda log: (log.get('blockNumber', 0), log.get('logIndex', 0)))
+    return logs
+
+
+def decode_log(log, total_distribution_data=None):
     """Decodes TotalDistribution event data and extracting relevant information from blockchain log entry.
+    Data is decoded by the event decoder compiled in blockchain/registry.py, the same one other tracked events use
 
     :param log: single blockchain event log entire
+    :param total_distribution_data: event arguments if they are decoded already, e.g. in batch by decode_logs()
     :return decoded_log_event dict: with cleared and transformed data from event log entire"""
     try:
-        total_distribution_data = web3.codec.decode(['uint256', 'uint256', 'uint256', 'uint256'], log['data'])
-        transaction = web3.eth.get_transaction(log['transactionHash'])
-        block = web3.eth.get_block(log['blockNumber'])  # we need it to get timestamp
-        return {
-            'block': log['blockNumber'],
-            'tx_hash': log['transactionHash'].hex(),
-            'timestamp': datetime.utcfromtimestamp(block['timestamp']),
-            'distributor_wallet': transaction['from'],
-
-            # TotalDistribution decoded data:
-            'input_aix_amount': Decimal(total_distribution_data[0]),
-            'distributed_aix_amount': Decimal(total_distribution_data[1]),
-            'swapped_eth_amount': Decimal(total_distribution_data[2]),
-            'distributed_eth_amount': Decimal(total_distribution_data[3])
-            }  # Decimal() accurate enough for storing in db ETH wei, ether and other converted from HexBytes num values
+        if total_distribution_data is None:
+            total_distribution_data = TOTAL_DISTRIBUTION.decode(log['topics'], log['data'])
+        return make_event_data(log, total_distribution_data)
 
     except Exception as e:
         logger.error(f"Failed to process log: {e}")
         return None
 
 
+@metrics.timed("decode_logs")
+def decode_logs(logs):
+    """ Decodes a batch of tracked events logs, each log is routed to its event decoder by topics[0].
+
+    Unique blocks and transactions of all logs missing in cache are requested in JSON-RPC batches, instead of
+    two requests for each log (transactions senders are needed for TotalDistribution events only),
+    then data of all logs of each event is decoded in a single pass by the event batch decoder
+    (see blockchain/registry.py compile_batch_decoder()). If a batch has a malformed log, logs of that event are
+    decoded one by one, so only the malformed one fails.
+
+    :param logs: blockchain event log entries
+    :return list: decoded_log_event dicts in the same order as logs, None for logs which failed to decode.
+        TotalDistribution events are TotalDistributionEvent columns dicts, other tracked events have 'event' key
+        with the event name. Logs of not tracked contract and event pairs are skipped """
+    routed_logs = [(log, event_registry.route(log)) for log in logs]
+    if any(spec is None for _, spec in routed_logs):
+        logger.info(f"{sum(spec is None for _, spec in routed_logs)} logs of not tracked events skipped")
+        routed_logs = [(log, spec) for log, spec in routed_logs if spec is not None]
+    distribution_logs = [log for log, spec in routed_logs if spec is TOTAL_DISTRIBUTION]
+
+    block_hashes = list({block_hash for block_hash in (HexBytes(log['blockHash']).hex() for log, _ in routed_logs)
+                         if block_hash not in block_timestamps})
+    tx_hashes = list({tx_hash for tx_hash in (HexBytes(log['transactionHash']).hex() for log in distribution_logs)
+                      if tx_hash not in transaction_senders})
+    try:
+        results = rpc_batch([('eth_getBlockByHash', [block_hash, False]) for block_hash in block_hashes] +
+                            [('eth_getTransactionByHash', [tx_hash]) for tx_hash in tx_hashes])
+        for block_hash, block in zip(block_hashes, results[:len(block_hashes)]):
+            block_timestamps.set(block_hash, int(block['timestamp'], 16))
+        for tx_hash, transaction in zip(tx_hashes, results[len(block_hashes):]):
+            transaction_senders.set(tx_hash, to_checksum_address(transaction['from']))
+    except Exception as e:
+        # not critical, single requests will be made for not cached data
+        logger.error(f"Failed to get blocks and transactions in batch: {e}")
+
+    arguments = [None] * len(routed_logs)  # decoded event arguments of each log
+    for spec in {spec for _, spec in routed_logs}:
+        positions = [position for position, (_, log_spec) in enumerate(routed_logs) if log_spec is spec]
+        try:
+            for position, event_arguments in zip(positions, spec.decode_batch([routed_logs[position][0]
+                                                                                 for position in positions])):
+                arguments[position] = event_arguments
+        except Exception as e:
+            logger.error(f"Failed to decode {spec.name} logs in batch, decoding one by one: {e}")
+
+    return [decode_log(log, event_arguments) if spec is TOTAL_DISTRIBUTION
+            else decode_tracked_log(log, spec, event_arguments)
+            for (log, spec), event_arguments in zip(routed_logs, arguments)]
+
+
+def decode_tracked_log(log, spec, event_arguments=None):
+    """ Decodes log of a tracked event (other than TotalDistribution) with the event compiled decoder
+
+    :param spec: EventSpec the log is routed to
+    :param event_arguments: event arguments if they are decoded already, e.g. in batch by decode_logs()
+    :return decoded_log_event dict: event name, log position, block time, contract and event arguments columns,
+        None if log failed to decode """
+    try:
+        if event_arguments is None:
+            event_arguments = spec.decode(log['topics'], log['data'])
+        return {
+            'event': spec.name,
+            'block': log['blockNumber'],
+            'block_hash': HexBytes(log['blockHash']).hex(),
+            'tx_hash': HexBytes(log['transactionHash']).hex(),
+            'log_index': log['logIndex'],
+            'timestamp': datetime.utcfromtimestamp(get_block_timestamp(HexBytes(log['blockHash']).hex())),
+            'address': to_checksum_address(log['address']),
+            **event_arguments,
+        }
+    except Exception as e:
+        logger.error(f"Failed to process {spec.name} log: {e}")
+        return None
+
+
+def make_event_data(log, total_distribution_data):
+    """ Makes decoded_log_event dict from log entry and its decoded TotalDistribution data
+
+    :param total_distribution_data: event arguments by column names, from TOTAL_DISTRIBUTION.decode() """
+    tx_hash = HexBytes(log['transactionHash']).hex()
+    return {
+        'block': log['blockNumber'],
+        'block_hash': HexBytes(log['blockHash']).hex(),
+        'tx_hash': tx_hash,
+        'log_index': log['logIndex'],
+        'timestamp': datetime.utcfromtimestamp(get_block_timestamp(HexBytes(log['blockHash']).hex())),
+        'distributor_wallet': get_transaction_sender(tx_hash),
+
+        # TotalDistribution decoded data: input_aix_amount, distributed_aix_amount, swapped_eth_amount and
+        # distributed_eth_amount as Decimal, accurate enough for storing in db ETH wei
+        **total_distribution_data,
+        }
+
+
+def rpc_batch(calls):
+    """ Sends JSON-RPC requests to the provider in batches of RPC_BATCH_SIZE requests
+
+    :param calls: list of (method, params) tuples
+    :return list: results in the same order as calls; raises ValueError if any request failed """
+    results = []
+    for batch_start in range(0, len(calls), RPC_BATCH_SIZE):
+        batch = calls[batch_start:batch_start + RPC_BATCH_SIZE]
+        for method, _ in batch:
+            metrics.inc("rpc_requests_total", method=method)
+        payload = [{'jsonrpc': '2.0', 'id': request_id, 'method': method, 'params': params}
+                   for request_id, (method, params) in enumerate(batch)]
+        # batch responses can come in any order
+        responses = {item.get('id'): item for item in get_provider_pool().post(payload)}
+        for request_id, (method, params) in enumerate(batch):
+            item = responses.get(request_id)
+            if item is None or 'error' in item or item.get('result') is None:
+                raise ValueError(f"{method}{params} failed: {item and item.get('error')}")
+            results.append(item['result'])
+    return results
+
+
+def get_block_timestamp(block_hash):
+    """ Returns block timestamp, asks the node only if block is not in cache """
+    timestamp = block_timestamps.get(block_hash)
+    if timestamp is None:
+        timestamp = get_web3().eth.get_block(block_hash)['timestamp']
+        block_timestamps.set(block_hash, timestamp)
+    return timestamp
+
+
+def get_block_hash(block_number):
+    """ Returns hash of the block with given number in the current canonical chain """
+    return HexBytes(get_web3().eth.get_block(block_number)['hash']).hex()
+
+
+def get_transaction_sender(tx_hash):
+    """ Returns address transaction was sent from, asks the node only if transaction is not in cache """
+    sender = transaction_senders.get(tx_hash)
+    if sender is None:
+        sender = get_web3().eth.get_transaction(tx_hash)['from']
+        transaction_senders.set(tx_hash, sender)
+    return sender
+
+
+def save_rpc_caches():
+    """ Persists blocks and transactions caches (if RPC_CACHE_DIR is set) and logs their hit rate
+    and providers stats """
+    for name, cache in (('Block timestamps', block_timestamps), ('Transaction senders', transaction_senders)):
+        cache.save()
+        logger.info(f"{name} cache: {cache.stats()}")
+    if provider_pool is not None:
+        logger.info(f"Providers: {provider_pool.stats()}")
+
+
 def get_wallet_balance(wallet):
     """ Retrieves the current balance of a given wallet address, converting the value from Wei to Ether. """
-    return web3.from_wei(web3.eth.get_balance(wallet), "ether")
+    return from_wei(get_web3().eth.get_balance(wallet), "ether")
+
+
+@metrics.timed("get_wallet_balances")
+def get_wallet_balances(wallets) -> dict[str, Decimal]:
+    """ Retrieves balances of wallets in Ether. Each wallet is requested once, all of them in a single JSON-RPC batch
+    pinned to the same block, so balances are consistent. Balances are cached for BALANCE_CACHE_TTL seconds.
+
+    :param wallets: wallet addresses, may repeat
+    :return dict: wallet address: balance in Ether """
+    wallets = list(dict.fromkeys(wallets))
+    balances = {wallet: wallet_balances.get(wallet) for wallet in wallets}
+    missing_wallets = [wallet for wallet, balance in balances.items() if balance is None]
+    if missing_wallets:
+        try:
+            block = hex(last_block())
+            results = rpc_batch([('eth_getBalance', [wallet, block]) for wallet in missing_wallets])
+            fetched_balances = {wallet: from_wei(int(result, 16), "ether")
+                                for wallet, result in zip(missing_wallets, results)}
+        except Exception as e:
+            logger.error(f"Failed to get balances in batch: {e}")
+            fetched_balances = {wallet: get_wallet_balance(wallet) for wallet in missing_wallets}
+        for wallet, balance in fetched_balances.items():
+            wallet_balances.set(wallet, balance)
+        balances.update(fetched_balances)
+    return balances
 
 
 def last_block():
-    """ returns last block number; needed to get timerange (default equal 7200 blocks / 24h ) """
-    return web3.eth.block_number
+    """ returns last block number; needed to get block range to scan for new events """
+    return get_web3().eth.block_number
+
+
+def find_block_by_time(timestamp: datetime) -> int:
+    """ First block mined at or after given UTC time, found by binary search over block timestamps
+    (about 25 requests for the whole mainnet history)
+
+    :param timestamp: naive datetime in UTC, as timestamps are stored in db
+    :return int: block num, last block + 1 if time is in the future """
+    target = timestamp.timestamp() if timestamp.tzinfo else (timestamp - datetime(1970, 1, 1)).total_seconds()
+    low, high = 0, last_block() + 1
+    while low < high:
+        middle = (low + high) // 2
+        if get_web3().eth.get_block(middle)['timestamp'] < target:
+            low = middle + 1
+        else:
+            high = middle
+    return low
+
+
+def follow_heads(poll_interval=STREAM_POLL_INTERVAL, ws_url=WEB3_WS_PROVIDER_URL):
+    """ Endless stream of blockchain head block numbers, yields each time the head moves forward.
+
+    If ws_url is set, heads are pushed by the node through WebSocket eth_subscribe("newHeads"), otherwise
+    (or if subscription fails) head block number is polled each poll_interval seconds,
+    which is a single cheap eth_blockNumber request. """
+    head = None
+    if ws_url:
+        try:
+            for head in subscribe_heads(ws_url):
+                yield head
+        except Exception as e:
+            logger.error(f"WebSocket newHeads subscription failed, polling heads instead: {e}")
+
+    while True:
+        try:
+            current_block = last_block()
+            if head is None or current_block > head:
+                head = current_block
+                yield head
+        except Exception as e:
+            logger.error(f"Failed to get last block: {e}")
+        time.sleep(poll_interval)
+
+
+def subscribe_heads(ws_url):
+    """ Yields head block numbers pushed by the node through WebSocket newHeads subscription """
+    from websockets.sync.client import connect
+
+    with connect(ws_url) as websocket:
+        websocket.send(json.dumps({'jsonrpc': '2.0', 'id': 1, 'method': 'eth_subscribe', 'params': ['newHeads']}))
+        response = json.loads(websocket.recv(timeout=RPC_TIMEOUT))
+        if 'error' in response:
+            raise ValueError(response['error'])
+        logger.info(f"Subscribed to newHeads: {response['result']}")
+        while True:
+            notification = json.loads(websocket.recv())
+            yield int(notification['params']['result']['number'], 16)
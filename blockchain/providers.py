@@ -0,0 +1,158 @@
+# -*- coding: utf-8 -*-
+"""
+RPC PROVIDERS POOL
+
+Requests are sent to the fastest healthy endpoint of WEB3_PROVIDER_URLS. Endpoint which failed (network error,
+HTTP error, rate limit) is skipped for a cooldown growing with each failure in a row, and the request is
+retried on the next endpoint, so an outage of one provider doesn't stop blocks ingestion.
+
+Endpoint -- provider endpoint with its pooled HTTP session, latency and errors counters
+ProviderPool -- routes JSON-RPC requests (single or batch) to endpoints, fails over on errors
+PoolProvider -- web3 provider sending requests through ProviderPool
+ProviderError -- raised when request failed on every endpoint
+"""
+import json
+import logging
+import threading
+import time
+from urllib.parse import urlparse
+
+import requests
+from requests.adapters import HTTPAdapter
+from web3.providers.base import JSONBaseProvider
+from metrics import metrics
+from settings import RPC_TIMEOUT, RPC_POOL_SIZE, PROVIDER_COOLDOWN, PROVIDER_MAX_COOLDOWN, PROVIDER_LATENCY_SMOOTHING
+
+
+logger = logging.getLogger(__name__)
+
+# Parts of JSON-RPC error messages meaning that provider limits us, not that request is wrong
+RATE_LIMIT_MARKERS = ('rate limit', 'too many requests', 'request count exceeded', 'compute units', 'credits',
+                      'capacity exceeded')
+
+
+class ProviderError(Exception):
+    pass
+
+
+class Endpoint:
+    """ Provider endpoint: its own HTTP session (keeping up to RPC_POOL_SIZE connections alive) and stats """
+
+    def __init__(self, url):
+        self.url = url
+        self.name = urlparse(url).netloc  # without path, as it usually has API key
+        self.session = requests.Session()
+        self.session.mount(url, HTTPAdapter(pool_connections=1, pool_maxsize=RPC_POOL_SIZE))
+        self.latency = None  # smoothed seconds, None until the first successful request
+        self.requests = 0
+        self.errors = 0
+        self.errors_in_row = 0
+        self.unhealthy_until = 0  # monotonic time
+
+    def is_healthy(self, now):
+        return self.unhealthy_until <= now
+
+    def stats(self) -> dict[str, any]:
+        return {'requests': self.requests, 'errors': self.errors,
+                'error_rate': self.errors / self.requests if self.requests else 0.0,
+                'latency_ms': round(self.latency * 1000, 1) if self.latency is not None else None,
+                'healthy': self.is_healthy(time.monotonic())}
+
+
+class ProviderPool:
+    """ Routes JSON-RPC requests to the fastest healthy endpoint and fails over to the next one on errors """
+
+    def __init__(self, urls, timeout=RPC_TIMEOUT):
+        if not urls:
+            raise ValueError("At least one provider URL is required")
+        self.endpoints = [Endpoint(url) for url in urls]
+        for number, endpoint in enumerate(self.endpoints):
+            if sum(other.name == endpoint.name for other in self.endpoints) > 1:
+                endpoint.name = f"{endpoint.name}#{number}"  # e.g. a few keys of the same provider
+        self.timeout = timeout
+        self._lock = threading.Lock()
+
+    def ordered_endpoints(self) -> list[Endpoint]:
+        """ Healthy endpoints from the fastest (not measured yet ones first, to measure them),
+        then unhealthy ones from the soonest to recover, as the last resort """
+        now = time.monotonic()
+        with self._lock:
+            healthy = [endpoint for endpoint in self.endpoints if endpoint.is_healthy(now)]
+            unhealthy = [endpoint for endpoint in self.endpoints if not endpoint.is_healthy(now)]
+        healthy.sort(key=lambda endpoint: -1 if endpoint.latency is None else endpoint.latency)
+        unhealthy.sort(key=lambda endpoint: endpoint.unhealthy_until)
+        return healthy + unhealthy
+
+    def post(self, payload):
+        """ Sends JSON-RPC request or batch to endpoints in order until one of them answers
+
+        :param payload: request dict or list of them, or already encoded json bytes
+        :return: decoded json response
+        :raises ProviderError: if request failed on every endpoint """
+        data = payload if isinstance(payload, bytes) else json.dumps(payload).encode()
+        errors = []
+        for endpoint in self.ordered_endpoints():
+            started_at = time.perf_counter()
+            try:
+                response = endpoint.session.post(endpoint.url, data=data, timeout=self.timeout,
+                                                 headers={'Content-Type': 'application/json'})
+                response.raise_for_status()
+                result = response.json()
+                rate_limit_error = find_rate_limit_error(result)
+                if rate_limit_error:
+                    raise ProviderError(f"rate limited: {rate_limit_error}")
+            except (requests.RequestException, ValueError, ProviderError) as e:
+                metrics.inc("rpc_errors_total", endpoint=endpoint.name)
+                self.record_failure(endpoint)
+                errors.append(f"{endpoint.name}: {e}")
+                logger.warning(f"Provider {endpoint.name} failed, trying the next one: {e}")
+                continue
+            latency = time.perf_counter() - started_at
+            metrics.observe("rpc_latency_seconds", latency, endpoint=endpoint.name)
+            self.record_success(endpoint, latency)
+            return result
+        raise ProviderError(f"All providers failed: {'; '.join(errors)}")
+
+    def record_success(self, endpoint, latency):
+        with self._lock:
+            endpoint.requests += 1
+            endpoint.errors_in_row = 0
+            endpoint.unhealthy_until = 0
+            if endpoint.latency is None:
+                endpoint.latency = latency
+            else:
+                endpoint.latency += PROVIDER_LATENCY_SMOOTHING * (latency - endpoint.latency)
+
+    def record_failure(self, endpoint):
+        with self._lock:
+            endpoint.requests += 1
+            endpoint.errors += 1
+            endpoint.errors_in_row += 1
+            cooldown = min(PROVIDER_COOLDOWN * 2 ** (endpoint.errors_in_row - 1), PROVIDER_MAX_COOLDOWN)
+            endpoint.unhealthy_until = time.monotonic() + cooldown
+
+    def stats(self) -> dict[str, dict]:
+        """ Endpoints counters for monitoring """
+        with self._lock:
+            return {endpoint.name: endpoint.stats() for endpoint in self.endpoints}
+
+
+def find_rate_limit_error(result):
+    """ Returns JSON-RPC error of the response (or of any response in batch) meaning provider limits us """
+    for item in (result if isinstance(result, list) else [result]):
+        error = item.get('error') if isinstance(item, dict) else None
+        if error and any(marker in str(error).lower() for marker in RATE_LIMIT_MARKERS):
+            return error
+    return None
+
+
+class PoolProvider(JSONBaseProvider):
+    """ web3 provider sending requests through ProviderPool """
+
+    def __init__(self, pool: ProviderPool):
+        super().__init__()
+        self.pool = pool
+
+    def make_request(self, method, params):
+        metrics.inc("rpc_requests_total", method=method)
+        return self.pool.post(self.encode_rpc_request(method, params))
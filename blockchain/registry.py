@@ -0,0 +1,241 @@
+# -*- coding: utf-8 -*-
+"""
+EVENTS REGISTRY
+
+Tracked smart contract events: TotalDistribution of CONTRACT_ADDRESS and TRACKED_EVENTS from settings.py.
+Logs of all tracked contracts and events are requested with a single eth_getLogs filter, so RPC cost depends
+on the scanned block range only, not on the number of tracked events. Each log is routed by its topics[0]
+to the event decoder, compiled once from the event ABI entry, and stored in the event's own table.
+
+EventSpec -- tracked event: ABI signature and topic, contracts addresses, compiled decoders, db model
+EventRegistry -- tracked events by topic: logs filter for all of them and logs routing
+event_registry -- registry of the project tracked events
+event_signature() -- canonical signature of ABI event entry, e.g. Transfer(address,address,uint256)
+compile_decoder() -- function decoding log topics and data into event arguments by column names
+compile_batch_decoder() -- function decoding many logs of the event at once
+"""
+import json
+import re
+from decimal import Decimal
+
+from eth_utils import keccak, to_checksum_address
+from hexbytes import HexBytes
+from sqlalchemy import DECIMAL, Boolean, String, Text
+from db.models import TotalDistributionEvent, make_event_model, EVENT_MODEL_COLUMNS
+from settings import CONTRACT_ADDRESS, TOTAL_DISTRIBUTION_EVENT_ABI, TRACKED_EVENTS
+
+
+WORD_SIZE = 32  # bytes of ABI static value and of log topic
+
+
+def event_signature(abi) -> str:
+    """ Canonical signature of the event ABI entry, which keccak hash is the event topic """
+    return f"{abi['name']}({','.join(abi_type(item) for item in abi['inputs'])})"
+
+
+def abi_type(item) -> str:
+    """ Canonical type of ABI input, tuples (structs) as types of their components in brackets """
+    if item['type'].startswith('tuple'):
+        return f"({','.join(abi_type(component) for component in item['components'])}){item['type'][5:]}"
+    return item['type']
+
+
+def column_name(name) -> str:
+    """ Snake case column name of the event argument, e.g. inputAixAmount -> input_aix_amount """
+    name = re.sub(r"(?<=[a-z0-9])([A-Z])", r"_\1", name.lstrip("_")).lower()
+    return f"{name}_arg" if name in EVENT_MODEL_COLUMNS else name
+
+
+def column_type(solidity_type):
+    """ SQLAlchemy type of event argument column: numbers as DECIMAL (uint256 has 78 digits), arrays and
+    tuples as JSON text, addresses and bytes as 0x-prefixed hex strings """
+    if solidity_type.endswith("]") or solidity_type.startswith("tuple") or solidity_type == "string":
+        return Text
+    if re.fullmatch(r"u?int\d*", solidity_type):
+        return DECIMAL(precision=78, scale=0)
+    if solidity_type == "bool":
+        return Boolean
+    return String
+
+
+def is_word_type(solidity_type) -> bool:
+    """ Checks if the value of type is encoded as a single 32 bytes word, so it can be sliced from log data """
+    return bool(re.fullmatch(r"u?int\d*|address|bool|bytes([1-9]|[12]\d|3[0-2])", solidity_type))
+
+
+def word_converter(solidity_type):
+    """ Function converting 32 bytes word with the value of type into value stored in db """
+    if solidity_type.startswith("uint"):
+        return lambda word: Decimal(int.from_bytes(word, "big"))
+    if solidity_type.startswith("int"):
+        return lambda word: Decimal(int.from_bytes(word, "big", signed=True))
+    if solidity_type == "address":
+        return lambda word: to_checksum_address(word[-20:])
+    if solidity_type == "bool":
+        return lambda word: word[-1] == 1
+    if solidity_type.startswith("bytes") and is_word_type(solidity_type):
+        size = int(solidity_type[5:])
+        return lambda word: "0x" + word[:size].hex()
+    # indexed dynamic value (string, bytes, array, tuple): topic is keccak hash of the value, not the value itself
+    return lambda word: "0x" + bytes(word).hex()
+
+
+def to_column_value(value):
+    """ Converts value decoded by eth_abi into value stored in db """
+    if isinstance(value, bool) or isinstance(value, str):
+        return value
+    if isinstance(value, int):
+        return Decimal(value)
+    if isinstance(value, bytes):
+        return "0x" + value.hex()
+    return json.dumps(value, default=lambda item: "0x" + item.hex() if isinstance(item, bytes) else str(item))
+
+
+def compile_decoder(inputs):
+    """ Compiles decoder of the event log. Indexed arguments are taken from topics; not indexed ones, when all of
+    them are 32 bytes words (numbers, addresses, bools), are sliced from data by precomputed offsets,
+    without running ABI decoder for each log; otherwise data is decoded by eth_abi.
+
+    :param inputs: event ABI entry inputs
+    :return: function(topics, data) returning dict of column name: value, raises ValueError for malformed log """
+    topic_converters = [(column_name(item['name']), word_converter(item['type']))
+                        for item in inputs if item.get('indexed')]
+    data_inputs = [item for item in inputs if not item.get('indexed')]
+    data_columns = [column_name(item['name']) for item in data_inputs]
+
+    if all(is_word_type(item['type']) for item in data_inputs):
+        data_converters = [(column, word_converter(item['type']), offset * WORD_SIZE)
+                           for offset, (column, item) in enumerate(zip(data_columns, data_inputs))]
+        data_size = len(data_converters) * WORD_SIZE
+
+        def decode_data(data):
+            if len(data) != data_size:
+                raise ValueError(f"Event data must be {data_size} bytes long, got {len(data)}")
+            return {column: convert(data[offset:offset + WORD_SIZE]) for column, convert, offset in data_converters}
+    else:
+        from eth_abi import decode  # needed for dynamic types only
+        data_types = [abi_type(item) for item in data_inputs]
+
+        def decode_data(data):
+            return {column: to_column_value(value) for column, value in zip(data_columns, decode(data_types, data))}
+
+    def decode_event(topics, data):
+        if len(topics) != len(topic_converters) + 1:
+            raise ValueError(f"Event must have {len(topic_converters) + 1} topics, got {len(topics)}")
+        arguments = {column: convert(HexBytes(topic)) for (column, convert), topic in zip(topic_converters, topics[1:])}
+        arguments.update(decode_data(HexBytes(data)))
+        return arguments
+
+    return decode_event
+
+
+def compile_batch_decoder(inputs, decode_event):
+    """ Compiles decoder of many logs of the event at once. When all not indexed arguments are 32 bytes words,
+    data of all logs is joined into a single buffer and each argument column is sliced from it in one pass with
+    a fixed stride, instead of decoding logs one by one; otherwise logs are decoded by decode_event one by one.
+
+    :param inputs: event ABI entry inputs
+    :param decode_event: single log decoder from compile_decoder()
+    :return: function(logs) returning list of dicts of column name: value in the same order as logs,
+        raises ValueError if any log is malformed """
+    data_inputs = [item for item in inputs if not item.get('indexed')]
+    if not all(is_word_type(item['type']) for item in data_inputs):
+        return lambda logs: [decode_event(log['topics'], log['data']) for log in logs]
+
+    topic_converters = [(column_name(item['name']), word_converter(item['type']))
+                        for item in inputs if item.get('indexed')]
+    data_converters = [(column_name(item['name']), word_converter(item['type']), offset * WORD_SIZE)
+                       for offset, item in enumerate(data_inputs)]
+    data_size = len(data_converters) * WORD_SIZE
+
+    def decode_events(logs):
+        logs_data = [HexBytes(log['data']) for log in logs]
+        if any(len(data) != data_size for data in logs_data):
+            raise ValueError(f"Event data must be {data_size} bytes long")
+        if any(len(log['topics']) != len(topic_converters) + 1 for log in logs):
+            raise ValueError(f"Event must have {len(topic_converters) + 1} topics")
+        buffer = b"".join(logs_data)
+        columns = {column: [convert(buffer[start:start + WORD_SIZE])
+                            for start in range(offset, len(buffer), data_size or WORD_SIZE)]
+                   for column, convert, offset in data_converters}
+        events = [{column: convert(HexBytes(topic)) for (column, convert), topic in zip(topic_converters,
+                                                                                          log['topics'][1:])}
+                  for log in logs]
+        for column, values in columns.items():
+            for event, value in zip(events, values):
+                event[column] = value
+        return events
+
+    return decode_events
+
+
+class EventSpec:
+    """ Tracked event
+
+    :param abi: event ABI entry
+    :param addresses: contracts which events are tracked
+    :param model: db model storing the events, by default a table named after the event with arguments columns """
+
+    def __init__(self, abi, addresses, model=None):
+        if abi.get('anonymous'):
+            raise ValueError(f"Anonymous event {abi['name']} has no topic to be routed by")
+        self.name = abi['name']
+        self.signature = event_signature(abi)
+        self.topic = "0x" + keccak(text=self.signature).hex()
+        self.addresses = [to_checksum_address(address) for address in addresses]
+        self.data_types = [abi_type(item) for item in abi['inputs'] if not item.get('indexed')]
+        self.decode = compile_decoder(abi['inputs'])
+        self.decode_batch = compile_batch_decoder(abi['inputs'], self.decode)
+        self.model = model or make_event_model(
+            f"{self.name}Event", f"{column_name(self.name)}_events",
+            {column_name(item['name']): column_type(item['type']) for item in abi['inputs']})
+
+    def __repr__(self):
+        return f"EventSpec({self.signature})"
+
+
+class EventRegistry:
+    """ Tracked events by their topic """
+
+    def __init__(self):
+        self.events = {}  # topic: EventSpec
+        self.by_address = {}  # lowercase contract address: topics of events tracked for it
+
+    def register(self, spec: EventSpec) -> EventSpec:
+        """ Adds event to the registry, events are told apart by topic and stored by name, so both must be unique """
+        if spec.topic in self.events or any(event.name == spec.name for event in self.events.values()):
+            raise ValueError(f"Event {spec.signature} is already tracked")
+        self.events[spec.topic] = spec
+        for address in spec.addresses:
+            self.by_address.setdefault(address.lower(), set()).add(spec.topic)
+        return spec
+
+    def get(self, name) -> EventSpec:
+        return next(spec for spec in self.events.values() if spec.name == name)
+
+    def logs_filter(self, start_block, end_block) -> dict[str, any]:
+        """ eth_getLogs filter for all tracked events of all tracked contracts """
+        addresses = list(dict.fromkeys(address for spec in self.events.values() for address in spec.addresses))
+        return {'fromBlock': start_block, 'toBlock': end_block, 'address': addresses,
+                'topics': [list(self.events)]}
+
+    def route(self, log) -> EventSpec:
+        """ Finds tracked event of the log by its topics[0] and address. Filter matches any of the tracked addresses
+        with any of the tracked topics, so logs of an event from another tracked contract are not routed
+
+        :return: EventSpec or None if the log is not tracked """
+        topics = log.get('topics')
+        if not topics:
+            return None
+        topic = HexBytes(topics[0]).hex()
+        topic = topic if topic.startswith("0x") else "0x" + topic
+        if topic not in self.by_address.get(str(log.get('address', "")).lower(), ()):
+            return None
+        return self.events[topic]
+
+
+event_registry = EventRegistry()
+TOTAL_DISTRIBUTION = event_registry.register(EventSpec(TOTAL_DISTRIBUTION_EVENT_ABI, [CONTRACT_ADDRESS],
+                                                       model=TotalDistributionEvent))
+for tracked_event in TRACKED_EVENTS:
+    event_registry.register(EventSpec(tracked_event['abi'], tracked_event['addresses']))
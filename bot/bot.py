@@ -2,27 +2,56 @@
 """
 TELEGRAM BOT
 
-The only command is /start. After that the only way it interacts - through sending report messages.
+Commands: /start, /stats [time window, e.g. 24h or 7d] and /wallets, answered from the reports cache.
+Scheduled reports are queued and sent by bot/delivery.py.
+
+get_bot() -- Telegram bot, created on the first use
+start_command() -- /start
+stats_command() -- /stats 24h, /stats 7d
+wallets_command() -- /wallets
 """
-import datetime
 import logging
+import threading
 import telebot
-from settings import TELEGRAM_API_KEY, TELEGRAM_CHAT_ID
+from bot.report import get_report, get_wallets_report, parse_window
+from settings import TELEGRAM_API_KEY
 
 logger = logging.getLogger(__name__)
 
-# initializing Telegram bot
-bot = telebot.TeleBot(TELEGRAM_API_KEY)
+# Telegram bot is initialized on the first use by get_bot()
+bot = None
+bot_lock = threading.Lock()
+
+
+def get_bot():
+    """ Returns Telegram bot with registered commands handlers, creating it on the first call """
+    global bot
+    with bot_lock:
+        if bot is None:
+            bot = telebot.TeleBot(TELEGRAM_API_KEY)
+            bot.register_message_handler(start_command, commands=['start'])
+            bot.register_message_handler(stats_command, commands=['stats'])
+            bot.register_message_handler(wallets_command, commands=['wallets'])
+        return bot
 
 
-@bot.message_handler(commands=['start'])
 def start_command(message):
     """ Responds to the /start command """
     welcome_message = "Welcome to the TotalDistributionBot!\nHottest AIX TotalDistribution statistics every 4 hours."
-    bot.send_message(message.chat.id, welcome_message)
+    get_bot().send_message(message.chat.id, welcome_message)
+
+
+def stats_command(message):
+    """ Responds to the /stats command with the report for the time window, 24h by default """
+    arguments = message.text.split()[1:]
+    try:
+        hours = parse_window(arguments[0]) if arguments else 24
+    except ValueError as e:
+        get_bot().reply_to(message, f"{e}\nUsage: /stats 24h or /stats 7d")
+        return
+    get_bot().send_message(message.chat.id, get_report(hours), parse_mode='MarkdownV2')
 
 
-def send_report(report):
-    """ Just sends a prepared report to chat """
-    bot.send_message(TELEGRAM_CHAT_ID, report, parse_mode='MarkdownV2')
-    logger.info(f"Report at {datetime.datetime.now()} was sent:\n{report}\n")
+def wallets_command(message):
+    """ Responds to the /wallets command with distributor wallets balances """
+    get_bot().send_message(message.chat.id, get_wallets_report(), parse_mode='MarkdownV2')
@@ -0,0 +1,150 @@
+# -*- coding: utf-8 -*-
+"""
+TELEGRAM DELIVERY QUEUE
+
+Reports are not sent straight away: they are stored in the outbox table for each chat from TELEGRAM_CHAT_IDS
+and sent from there at Telegram's rate limits. Failed messages stay in the outbox and are retried with
+exponential backoff (or after Telegram's retry_after), so a Telegram hiccup or a restart doesn't lose a report.
+
+TokenBucket -- rate limiter, allows short bursts up to capacity and rate messages per second on average
+send_report() -- queue report for every chat and send it
+queue_report() -- put report into the outbox for every chat
+deliver_messages() -- send due outbox messages, respecting global and per-chat limits
+retry_delay() -- how long to wait before the next attempt after a failed one
+"""
+import datetime
+import logging
+import threading
+import time
+
+import requests
+from telebot.apihelper import ApiTelegramException, ApiHTTPException
+
+from bot.bot import get_bot
+from metrics import metrics
+from db.database import enqueue_messages, get_due_messages, finish_message, retry_message
+from settings import TELEGRAM_CHAT_IDS, TELEGRAM_GLOBAL_RATE, TELEGRAM_CHAT_RATE, TELEGRAM_GROUP_RATE
+from settings import TELEGRAM_MAX_ATTEMPTS, TELEGRAM_RETRY_BACKOFF, TELEGRAM_MAX_RETRY_BACKOFF
+
+
+logger = logging.getLogger(__name__)
+
+
+class TokenBucket:
+    """ Token bucket: gets rate tokens per second up to capacity, each message takes one """
+
+    def __init__(self, rate, capacity=1):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated_at = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    def delay(self) -> float:
+        """ Seconds to wait until a token is available """
+        with self._lock:
+            self._refill()
+            return max(0.0, (1 - self.tokens) / self.rate)
+
+    def take(self):
+        with self._lock:
+            self._refill()
+            self.tokens -= 1
+
+    def pause(self, seconds):
+        """ No tokens for the next seconds, e.g. after Telegram asked to retry later """
+        with self._lock:
+            self._refill()
+            self.tokens = min(self.tokens, 1 - seconds * self.rate)
+
+
+global_bucket = TokenBucket(TELEGRAM_GLOBAL_RATE, capacity=TELEGRAM_GLOBAL_RATE)
+chat_buckets = {}  # chat id: TokenBucket
+
+
+def get_chat_bucket(chat_id) -> TokenBucket:
+    """ Rate limiter of the chat, groups (negative ids) have lower limit than private chats """
+    if chat_id not in chat_buckets:
+        chat_buckets[chat_id] = TokenBucket(TELEGRAM_GROUP_RATE if chat_id < 0 else TELEGRAM_CHAT_RATE)
+    return chat_buckets[chat_id]
+
+
+@metrics.timed("send_report")
+def send_report(report):
+    """ Queues prepared report for every chat from TELEGRAM_CHAT_IDS and sends what is due """
+    queue_report(report)
+    deliver_messages()
+
+
+def queue_report(report, chat_ids=None) -> bool:
+    """ Puts prepared report into the outbox for every chat from TELEGRAM_CHAT_IDS
+
+    :return bool: True if queued, False on db error """
+    chat_ids = chat_ids or TELEGRAM_CHAT_IDS
+    queued = enqueue_messages(chat_ids, report, parse_mode='MarkdownV2')
+    if queued:
+        logger.info(f"Report at {datetime.datetime.now()} was queued for {len(chat_ids)} chats:\n{report}\n")
+    return queued
+
+
+@metrics.timed("deliver_messages")
+def deliver_messages() -> int:
+    """ Sends due outbox messages once. Waits for the global limit, but a message to a chat which limit
+    is exhausted is postponed, so one busy chat doesn't hold the others
+
+    :return int: number of sent messages """
+    sent_count = 0
+    for message in get_due_messages():
+        chat_bucket = get_chat_bucket(message.chat_id)
+        chat_delay = chat_bucket.delay()
+        if chat_delay:
+            retry_message(message.id, datetime.datetime.utcnow() + datetime.timedelta(seconds=chat_delay))
+            continue
+        time.sleep(global_bucket.delay())
+        global_bucket.take()
+        chat_bucket.take()
+
+        try:
+            get_bot().send_message(message.chat_id, message.text, parse_mode=message.parse_mode)
+        except Exception as e:
+            delay = retry_delay(e, message.attempts)
+            if delay is None or message.attempts + 1 >= TELEGRAM_MAX_ATTEMPTS:
+                logger.error(f"Message {message.id} to chat {message.chat_id} failed: {e}")
+                metrics.inc("telegram_messages_total", status="failed")
+                finish_message(message.id, error=str(e))
+            else:
+                logger.warning(f"Message {message.id} to chat {message.chat_id} failed, retry in {delay}s: {e}")
+                metrics.inc("telegram_messages_total", status="retried")
+                chat_bucket.pause(delay)
+                retry_message(message.id, datetime.datetime.utcnow() + datetime.timedelta(seconds=delay), str(e))
+            continue
+
+        finish_message(message.id)
+        metrics.inc("telegram_messages_total", status="sent")
+        sent_count += 1
+        logger.info(f"Message {message.id} was sent to chat {message.chat_id}")
+    return sent_count
+
+
+def retry_delay(error, attempts):
+    """ How long to wait before the next attempt to send a message
+
+    :param error: exception raised by the attempt
+    :param attempts: number of the previous failed attempts
+    :return: seconds, None if message must not be retried (e.g. bad markup or bot was removed from chat) """
+    backoff = min(TELEGRAM_RETRY_BACKOFF * 2 ** attempts, TELEGRAM_MAX_RETRY_BACKOFF)
+    if isinstance(error, ApiTelegramException):
+        if error.error_code == 429:
+            return error.result_json.get('parameters', {}).get('retry_after', backoff)
+        return backoff if error.error_code >= 500 else None
+    if isinstance(error, ApiHTTPException):  # not a json response, e.g. from a proxy
+        status_code = error.result.status_code
+        return backoff if status_code == 429 or status_code >= 500 else None
+    if isinstance(error, requests.RequestException):  # network errors and timeouts
+        return backoff
+    return None
@@ -3,14 +3,132 @@
 REPORTS
 
 All about processing saved in DB TotalDistributionEvent objects to make text message report.
+Rendered reports are cached, so a scheduled report for many chats and many users asking for /stats at once
+cost one DB and RPC computation. The cache is invalidated when new events are stored.
 
+ReportCache -- rendered reports by key, rendered once however many callers ask for them at the same time
+get_report() -- cached report message for the time window
+get_wallets_report() -- cached distributor wallets balances message
+parse_window() -- hours in the time window like "24h" or "7d"
+format_window() -- time window hours as "24h" or "7d"
 format_duration() -- for human durations like "8m ago"
 prepare_report_data() -- aggregating list of TotalDistributionEvents to statistical data to be included in report
+prepare_summary_report_data() -- the same from TotalDistributionEvents summary aggregated in db
+summarize_events() -- aggregating list of TotalDistributionEvents the same way as db.database.get_events_summary()
 create_report_message() -- inserting prepared statistical data in markdown2 telegram message
 """
 import datetime
-from blockchain.events import get_wallet_balance, web3
-from settings import CONTRACT_ADDRESS
+import logging
+import re
+import threading
+import time
+from eth_utils import from_wei
+from blockchain.events import get_wallet_balances
+from db.database import get_events_summary
+from metrics import metrics
+from settings import CONTRACT_ADDRESS, REPORT_CACHE_TTL, REPORT_MAX_HOURS, WALLETS_REPORT_HOURS
+
+
+logger = logging.getLogger(__name__)
+
+REPORT_TITLES = {24: "Daily", 7 * 24: "Weekly"}  # by window hours, other windows are titled like "12h"
+WINDOW_RE = re.compile(r"^(\d+)([hd])$")
+
+
+class ReportCache:
+    """ Rendered reports by key, e.g. time window. Cached report is valid until invalidate() (new events stored)
+    or for ttl seconds, as report has relative times like "8m ago" and its time window moves.
+
+    Concurrent callers asking for the same missing report wait for the first one to render it (single flight). """
+
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.renders = 0
+        self.render_seconds = 0.0
+        self.version = 0  # increased on each invalidation
+        self._items = {}  # key: (rendered at monotonic time, version, report)
+        self._key_locks = {}  # key: lock held while the report is rendered
+        self._lock = threading.Lock()
+
+    def get(self, key, render):
+        """ Returns cached report or renders it with render() and caches
+
+        :param key: hashable report key
+        :param render: function without arguments returning report """
+        with self._lock:
+            key_lock = self._key_locks.setdefault(key, threading.Lock())
+        with key_lock:
+            with self._lock:
+                rendered_at, version, report = self._items.get(key, (0, None, None))
+                if version == self.version and time.monotonic() - rendered_at < self.ttl:
+                    self.hits += 1
+                    return report
+                self.misses += 1
+                version = self.version
+
+            started_at = time.perf_counter()
+            report = render()
+            render_seconds = time.perf_counter() - started_at
+            metrics.observe("report_render_seconds", render_seconds)
+            with self._lock:
+                self._items[key] = (time.monotonic(), version, report)
+                self.renders += 1
+                self.render_seconds += render_seconds
+            logger.info(f"Report {key} rendered in {render_seconds:.3f}s")
+            return report
+
+    def invalidate(self):
+        """ Marks all cached reports outdated, e.g. new events were stored """
+        with self._lock:
+            self.version += 1
+
+    def stats(self) -> dict[str, any]:
+        """ Cache counters for monitoring """
+        requests = self.hits + self.misses
+        return {'size': len(self._items), 'hits': self.hits, 'misses': self.misses,
+                'hit_rate': self.hits / requests if requests else 0.0, 'renders': self.renders,
+                'avg_render_seconds': self.render_seconds / self.renders if self.renders else 0.0}
+
+
+report_cache = ReportCache(REPORT_CACHE_TTL)
+metrics.add_collector(lambda: [(f"cache_{counter}_total", {'cache': "reports"}, getattr(report_cache, counter))
+                               for counter in ('hits', 'misses')])
+
+
+def get_report(hours=24) -> str:
+    """ Report message for the last hours, rendered once and shared by all chats and commands """
+    return report_cache.get(('stats', hours), lambda: create_report_message(
+        prepare_summary_report_data(get_events_summary(hours=hours)), hours=hours))
+
+
+def get_wallets_report() -> str:
+    """ Distributor wallets seen in the last WALLETS_REPORT_HOURS with their balances """
+    def render():
+        summary = get_events_summary(hours=WALLETS_REPORT_HOURS)
+        if not summary:
+            return f"No distributor wallets for the last {format_window(WALLETS_REPORT_HOURS)}"
+        return "```\n" + format_wallets(get_wallet_balances(summary['distributor_wallets'])) + "```"
+    return report_cache.get(('wallets',), render)
+
+
+def parse_window(window: str) -> int:
+    """ Parses time window like "24h" or "7d" into hours
+
+    :raises ValueError: if window is malformed or longer than REPORT_MAX_HOURS """
+    match = WINDOW_RE.match(window.strip().lower())
+    if not match:
+        raise ValueError(f"Bad time window {window!r}, expected e.g. 24h or 7d")
+    hours = int(match.group(1)) * (24 if match.group(2) == 'd' else 1)
+    if not 0 < hours <= REPORT_MAX_HOURS:
+        raise ValueError(f"Time window must be from 1h to {format_window(REPORT_MAX_HOURS)}")
+    return hours
+
+
+def format_window(hours: int) -> str:
+    """ Formats time window hours as "7d" if it's whole days, else as "36h" """
+    return f"{hours // 24}d" if hours % 24 == 0 and hours > 24 else f"{hours}h"
 
 
 def format_duration(delta: datetime.timedelta) -> str:
@@ -25,39 +143,66 @@ def format_duration(delta: datetime.timedelta) -> str:
         return f"{int(minutes)}m ago"
 
 
+def summarize_events(events) -> dict[str, any]:
+    """ Aggregates TotalDistributionEvent objects into the same summary db.database.get_events_summary() returns """
+    if not events:
+        return None
+    return {
+        'events_count': len(events),
+        'first_timestamp': min(event.timestamp for event in events),
+        'last_timestamp': max(event.timestamp for event in events),
+        'input_aix_amount': sum(event.input_aix_amount for event in events),
+        'distributed_aix_amount': sum(event.distributed_aix_amount for event in events),
+        'swapped_eth_amount': sum(event.swapped_eth_amount for event in events),
+        'distributed_eth_amount': sum(event.distributed_eth_amount for event in events),
+        'distributor_wallets': list(dict.fromkeys(event.distributor_wallet for event in events)),
+    }
+
+
 def prepare_report_data(events) -> dict[str, any]:
     """ Process TotalDistributionEvent objects to aggregate data for reporting """
-    if events:
-        # Make sure all events have been in ascending order of timestamp
-        events.sort(key=lambda event: event.timestamp)
+    return prepare_summary_report_data(summarize_events(events))
 
+
+def prepare_summary_report_data(summary) -> dict[str, any]:
+    """ Process TotalDistributionEvents summary to data for reporting
+
+    :param summary: dict from db.database.get_events_summary() or summarize_events() """
+    if summary:
         report_data = {
-            'first_tx_ago': format_duration(datetime.datetime.utcnow() - events[0].timestamp),
-            'last_tx_ago': format_duration(datetime.datetime.utcnow() - events[-1].timestamp),
-
-            'aix_processed': web3.from_wei(sum(event.input_aix_amount for event in events), "ether"),
-            'aix_distributed': web3.from_wei(sum(event.distributed_aix_amount for event in events), "ether"),
-            'eth_bought': web3.from_wei(sum(event.swapped_eth_amount for event in events), "ether"),
-            'eth_distributed': web3.from_wei(sum(event.distributed_eth_amount for event in events), "ether"),
-            'distributor_wallets': {event.distributor_wallet: get_wallet_balance(event.distributor_wallet) for event in events}
+            'first_tx_ago': format_duration(datetime.datetime.utcnow() - summary['first_timestamp']),
+            'last_tx_ago': format_duration(datetime.datetime.utcnow() - summary['last_timestamp']),
+
+            'aix_processed': from_wei(summary['input_aix_amount'], "ether"),
+            'aix_distributed': from_wei(summary['distributed_aix_amount'], "ether"),
+            'eth_bought': from_wei(summary['swapped_eth_amount'], "ether"),
+            'eth_distributed': from_wei(summary['distributed_eth_amount'], "ether"),
+            'distributor_wallets': get_wallet_balances(summary['distributor_wallets'])
             # Not sure if there can be only one distributor wallet, so predict the situation where appear few wallets
         }
         return report_data
     return
 
 
-def create_report_message(data: dict[str, any]) -> str:
-    """ Generates the report message from aggregated data """
+def format_wallets(wallet_balances: dict[str, any]) -> str:
+    """ Distributor wallets and their balances, one after another in case there can be more than one wallet """
+    return "\n".join(
+        [f"Distributor wallet: {wallet}\n"
+         f"Distributor balance: {balance:.4f} ETH" for wallet, balance in wallet_balances.items()])
+
+
+def create_report_message(data: dict[str, any], hours=24) -> str:
+    """ Generates the report message from aggregated data
+
+    :param hours: report time window, for the title and "no updates" message """
     if not data:
-        return (f"Sorry, no updates for the last 24 hours. Maybe an issue."
+        return (f"Sorry, no updates for the last {hours} hours. Maybe an issue."
                 f"Check manually at https://etherscan.io/address/{CONTRACT_ADDRESS}")
 
-    # in case there can be more than one wallet
-    wallets_info = "\n".join(
-        [f"Distributor wallet: {wallet}\n"
-         f"Distributor balance: {balance:.4f} ETH" for wallet, balance in data['distributor_wallets'].items()])
+    wallets_info = format_wallets(data['distributor_wallets'])
+    title = REPORT_TITLES.get(hours, format_window(hours))
 
-    report = (f"\nDaily $AIX Stats:\n"
+    report = (f"\n{title} $AIX Stats:\n"
               f"- First TX: {data['first_tx_ago']}\n"
               f"- Last TX: {data['last_tx_ago']}\n"
               f"- AIX processed: {data['aix_processed']:,.2f}\n"
@@ -0,0 +1,214 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+EVENTS ANALYTICS
+
+Stats over long TotalDistribution events history, computed in vectorized NumPy passes over event columns
+instead of ORM objects, and export of events to columnar files for offline analysis:
+
+    python -m db.analytics --hours 8760  # stats of the last year as JSON
+    python -m db.analytics --export events.parquet  # or events.arrow for Arrow IPC file
+
+Amounts are kept as exact wei integers (object arrays) for totals, and as float64 ether units for averages,
+percentiles and rates, where float precision is enough. numpy and pyarrow are optional dependencies,
+imported on use: pip install numpy pyarrow
+
+EventColumns -- events columns as NumPy arrays
+load_event_columns() -- read events with timestamp in last x hours into columns with a single query
+compute_stats() -- totals, per wallet and per hour breakdowns, averages, percentiles, moving average, swap rate trend
+export_events() -- write events to Parquet or Arrow IPC file in batches
+"""
+import argparse
+import datetime
+import json
+import logging
+from dataclasses import dataclass
+from sqlalchemy import select
+from db.database import get_session, AMOUNT_COLUMNS, EVENT_COLUMNS
+from db.models import TotalDistributionEvent
+from metrics import metrics
+from settings import ANALYTICS_MOVING_AVERAGE_HOURS, ANALYTICS_PERCENTILES, ANALYTICS_EXPORT_BATCH_SIZE
+
+
+logger = logging.getLogger(__name__)
+
+WEI = 10 ** 18  # AIX has 18 decimals as ETH
+PARQUET_SUFFIXES = ('.parquet',)
+ARROW_SUFFIXES = ('.arrow', '.feather', '.ipc')
+
+
+@dataclass
+class EventColumns:
+    """ Events ordered by time as NumPy arrays of the same length """
+    timestamps: any  # datetime64[s] array, UTC
+    wallets: any  # int array, index of the event distributor wallet in wallet_names
+    wallet_names: any  # str array of unique distributor wallets
+    amounts: dict  # amount column name: object array of exact wei ints
+
+    def __len__(self):
+        return len(self.timestamps)
+
+    def ether(self, column):
+        """ Amount column as float64 array in ether (AIX) units """
+        import numpy as np  # optional dependency
+        return self.amounts[column].astype(np.float64) / WEI
+
+
+def events_statement(columns, hours=None):
+    statement = select(*(getattr(TotalDistributionEvent, column) for column in columns))
+    if hours is not None:
+        start_time = datetime.datetime.utcnow() - datetime.timedelta(hours=hours)
+        statement = statement.where(TotalDistributionEvent.timestamp >= start_time)
+    return statement.order_by(TotalDistributionEvent.timestamp, TotalDistributionEvent.log_index)
+
+
+@metrics.timed("load_event_columns")
+def load_event_columns(hours=None, db_session=None) -> EventColumns:
+    """ Reads events with timestamp in last x hours (all events if hours is None) into columns,
+    with a single query of the needed columns only, without ORM objects
+
+    :return EventColumns: None on db error """
+    import numpy as np  # optional dependency
+    statement = events_statement(('timestamp', 'distributor_wallet') + AMOUNT_COLUMNS, hours)
+    with (db_session or get_session()) as session:
+        rows = session.execute(statement).all()
+        columns = list(zip(*rows)) or [()] * (2 + len(AMOUNT_COLUMNS))
+        wallet_names, wallets = np.unique(np.array(columns[1], dtype=str), return_inverse=True)
+        return EventColumns(
+            timestamps=np.array(columns[0], dtype='datetime64[s]'),
+            wallets=wallets.reshape(-1),
+            wallet_names=wallet_names,
+            # db drivers return Decimal, exact ints are made once per value, then all math is vectorized
+            amounts={column: np.array([int(value or 0) for value in values], dtype=object)
+                     for column, values in zip(AMOUNT_COLUMNS, columns[2:])},
+        )
+
+
+@metrics.timed("compute_stats")
+def compute_stats(columns: EventColumns, moving_average_hours=ANALYTICS_MOVING_AVERAGE_HOURS,
+                  percentiles=ANALYTICS_PERCENTILES) -> dict[str, any]:
+    """ Computes events stats in vectorized passes over columns
+
+    :param moving_average_hours: window of hourly distributed AIX moving average
+    :param percentiles: percentiles of distribution size (distributed AIX of an event)
+    :return dict: totals (exact wei), averages and distribution size (ether units), swap rate (ETH per AIX) and
+        its trend per day, per wallet totals, hourly series with a value for each hour from the first event to the
+        last one; None if there are no events """
+    import numpy as np  # optional dependency
+    if not len(columns):
+        return None
+    ether = {column: columns.ether(column) for column in AMOUNT_COLUMNS}
+
+    # per wallet exact totals: sums of wei ints grouped by wallet index
+    wallet_counts = np.bincount(columns.wallets, minlength=len(columns.wallet_names))
+    wallet_totals = {}
+    for column in AMOUNT_COLUMNS:
+        wallet_totals[column] = np.zeros(len(columns.wallet_names), dtype=object)
+        np.add.at(wallet_totals[column], columns.wallets, columns.amounts[column])
+
+    # hourly series over a dense hours grid, hours without events are zeros
+    hours = columns.timestamps.astype('datetime64[h]')
+    hour_indexes = (hours - hours.min()).astype(np.int64)
+    hours_count = int(hour_indexes.max()) + 1
+    hourly = {column: np.bincount(hour_indexes, weights=ether[column], minlength=hours_count)
+              for column in AMOUNT_COLUMNS}
+    window = min(moving_average_hours, hours_count)
+    moving_average = np.full(hours_count, np.nan)
+    moving_average[window - 1:] = np.convolve(hourly['distributed_aix_amount'], np.ones(window) / window, 'valid')
+    with np.errstate(divide='ignore', invalid='ignore'):
+        hourly_swap_rate = hourly['swapped_eth_amount'] / hourly['input_aix_amount']
+        swap_rates = ether['swapped_eth_amount'] / ether['input_aix_amount']
+
+    # swap rate trend: least squares slope of events swap rates over time
+    days = (columns.timestamps - columns.timestamps[0]) / np.timedelta64(1, 'D')
+    valid_rates = np.isfinite(swap_rates)
+    swap_rate_trend = 0.0
+    if len(np.unique(days[valid_rates])) > 1:
+        swap_rate_trend = float(np.polyfit(days[valid_rates], swap_rates[valid_rates], 1)[0])
+
+    distribution_sizes = ether['distributed_aix_amount']
+    total_input_aix = columns.amounts['input_aix_amount'].sum()
+    return {
+        'events_count': len(columns),
+        'first_timestamp': columns.timestamps.min().item(),
+        'last_timestamp': columns.timestamps.max().item(),
+        'totals': {column: int(columns.amounts[column].sum()) for column in AMOUNT_COLUMNS},
+        'averages': {column: float(ether[column].mean()) for column in AMOUNT_COLUMNS},
+        'distribution_size': {'min': float(distribution_sizes.min()), 'max': float(distribution_sizes.max()),
+                              **{f"p{percentile:g}": float(value) for percentile, value
+                                 in zip(percentiles, np.percentile(distribution_sizes, percentiles))}},
+        'swap_rate': {
+            'average': float(columns.amounts['swapped_eth_amount'].sum() / total_input_aix) if total_input_aix
+            else None,
+            'trend_per_day': swap_rate_trend,
+        },
+        'wallets': {str(wallet): {'events_count': int(wallet_counts[index]),
+                                  **{column: int(wallet_totals[column][index]) for column in AMOUNT_COLUMNS}}
+                    for index, wallet in enumerate(columns.wallet_names)},
+        'hourly': {
+            'hours': [hour.item() for hour in hours.min() + np.arange(hours_count)],
+            'events_count': np.bincount(hour_indexes, minlength=hours_count).tolist(),
+            'distributed_aix': hourly['distributed_aix_amount'].tolist(),
+            'distributed_eth': hourly['distributed_eth_amount'].tolist(),
+            'swap_rate': to_list(hourly_swap_rate),
+            'distributed_aix_moving_average': to_list(moving_average),
+        },
+    }
+
+
+def to_list(array) -> list:
+    """ Float array as list with None instead of NaN, so it can be dumped to JSON """
+    return [value if value == value else None for value in array.tolist()]
+
+
+@metrics.timed("export_events")
+def export_events(path, hours=None, batch_size=ANALYTICS_EXPORT_BATCH_SIZE, db_session=None):
+    """ Writes events with timestamp in last x hours (all events if hours is None) to a columnar file:
+    Parquet for .parquet path, Arrow IPC file for .arrow, .feather and .ipc. Events are read from db and written
+    by batches, so memory use doesn't grow with history length. Amounts are exact decimal128(38, 0) wei
+
+    :return int: number of exported events, None on db error """
+    import pyarrow  # optional dependency
+    import pyarrow.parquet
+    schema = pyarrow.schema(
+        [('block', pyarrow.int64()), ('block_hash', pyarrow.string()), ('tx_hash', pyarrow.string()),
+         ('log_index', pyarrow.int32()), ('timestamp', pyarrow.timestamp('s')),
+         ('distributor_wallet', pyarrow.string())] +
+        [(column, pyarrow.decimal128(38, 0)) for column in AMOUNT_COLUMNS])
+    if str(path).endswith(PARQUET_SUFFIXES):
+        writer = pyarrow.parquet.ParquetWriter(path, schema)
+    elif str(path).endswith(ARROW_SUFFIXES):
+        writer = pyarrow.ipc.new_file(path, schema)
+    else:
+        raise ValueError(f"Unknown export format of {path}, use {', '.join(PARQUET_SUFFIXES + ARROW_SUFFIXES)}")
+
+    exported_count = None  # stays None if db session fails
+    with writer, (db_session or get_session()) as session:
+        written_count = 0
+        result = session.execute(events_statement(EVENT_COLUMNS, hours).execution_options(yield_per=batch_size))
+        for rows in result.partitions():
+            writer.write_batch(pyarrow.record_batch(
+                [pyarrow.array(values, type=field.type) for values, field in zip(zip(*rows), schema)], schema=schema))
+            written_count += len(rows)
+        exported_count = written_count
+    if exported_count is None:
+        return None
+    logger.info(f"{exported_count} events exported to {path}")
+    return exported_count
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description="TotalDistribution events stats and export")
+    parser.add_argument("--hours", type=int, help="time window, the whole history by default")
+    parser.add_argument("--export", metavar="PATH", help="write events to .parquet or .arrow file instead of stats")
+    args = parser.parse_args()
+
+    if args.export:
+        if export_events(args.export, args.hours) is None:
+            raise SystemExit(1)
+    else:
+        event_columns = load_event_columns(args.hours)
+        if event_columns is None:
+            raise SystemExit(1)
+        print(json.dumps(compute_stats(event_columns), indent=2, default=str))
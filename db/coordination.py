@@ -0,0 +1,206 @@
+# -*- coding: utf-8 -*-
+"""
+INSTANCES COORDINATION
+
+Replicas of the bot share a database and coordinate through it, so adding an instance adds availability and
+throughput instead of duplicate RPC requests and duplicate Telegram reports:
+- roles: a single instance sends reports (and answers bot commands), a single one ingests new blocks. Roles are
+  renewed by a heartbeat thread, an instance which is gone loses them and another one takes them over;
+- work items: backfill shards are leased to the instance fetching them, others skip them.
+
+With PostgreSQL locks are session advisory locks: the server releases them as soon as the holder's connection is
+gone. Other databases (SQLite) use leases table rows which expire if not renewed, instances clocks must be in sync.
+
+Coordinator -- roles and work items held by this instance, heartbeat renewing the roles
+AdvisoryLocks -- PostgreSQL session advisory locks on a connection of their own
+LeaseLocks -- expiring leases in db table
+get_coordinator() -- coordinator of this instance, created on the first use
+lock_key() -- 64-bit advisory lock key of a lock name
+"""
+import hashlib
+import logging
+import threading
+import time
+from sqlalchemy import text
+from sqlalchemy.exc import SQLAlchemyError
+from db.database import get_engine, acquire_lease, release_lease
+from metrics import metrics
+from settings import INSTANCE_ID, LEASE_TTL
+
+
+logger = logging.getLogger(__name__)
+
+REPORT_ROLE = "report"  # sends scheduled reports, retries outbox messages and answers bot commands
+INGESTION_ROLE = "ingestion"  # scans new blocks
+LOCKS_NAMESPACE = "total_distribution_bot"  # advisory locks are database-wide, so keys are hashed with it
+
+# Coordinator is initialized on the first use by get_coordinator()
+coordinator = None
+coordinator_lock = threading.Lock()
+
+
+def lock_key(name) -> int:
+    """ Signed 64-bit key of the lock name, as pg_try_advisory_lock(bigint) takes """
+    digest = hashlib.blake2b(f"{LOCKS_NAMESPACE}:{name}".encode(), digest_size=8).digest()
+    return int.from_bytes(digest, "big", signed=True)
+
+
+class AdvisoryLocks:
+    """ PostgreSQL session advisory locks, held by a connection which is not returned to the pool. Server releases
+    them when the connection is closed, so locks of a crashed instance are free at once and ttl is not needed """
+
+    def __init__(self, engine):
+        self.engine = engine
+        self._connection = None
+        self._held = set()  # lock names
+        self._lock = threading.Lock()
+
+    def acquire(self, name, ttl=None) -> bool:
+        """ Takes the lock if it's free, checks the connection is alive if the lock is held already
+
+        :return bool: True if the lock is held now, False if another instance holds it or connection is lost """
+        with self._lock:
+            try:
+                if self._connection is None:
+                    self._connection = self.engine.connect()
+                if name in self._held:
+                    self._connection.execute(text("SELECT 1"))  # held while the connection is alive
+                    acquired = True
+                else:
+                    acquired = self._connection.scalar(text("SELECT pg_try_advisory_lock(:key)"),
+                                                       {'key': lock_key(name)})
+                self._connection.commit()  # session locks outlive transactions, don't stay idle in transaction
+                if acquired:
+                    self._held.add(name)
+                return bool(acquired)
+            except SQLAlchemyError as e:
+                logger.error(f"Error acquiring advisory lock {name}: {e}")
+                self.disconnect()  # locks of the lost connection are released by the server
+                return False
+
+    def release(self, name):
+        with self._lock:
+            if name not in self._held:
+                return
+            self._held.discard(name)
+            try:
+                self._connection.execute(text("SELECT pg_advisory_unlock(:key)"), {'key': lock_key(name)})
+                self._connection.commit()
+            except SQLAlchemyError as e:
+                logger.error(f"Error releasing advisory lock {name}: {e}")
+                self.disconnect()
+
+    def disconnect(self):
+        """ Closes the locks connection instead of returning it to the pool, where it would keep the locks """
+        self._held.clear()
+        if self._connection is not None:
+            self._connection.invalidate()
+            self._connection.close()
+            self._connection = None
+
+
+class LeaseLocks:
+    """ Leases table rows with owner and expiry time, for databases without advisory locks """
+
+    def __init__(self, owner=INSTANCE_ID):
+        self.owner = owner
+
+    def acquire(self, name, ttl=LEASE_TTL):
+        """ :return bool: True if the lease is held now, False if another instance holds it, None on db error """
+        return acquire_lease(name, self.owner, ttl)
+
+    def release(self, name):
+        release_lease(name, self.owner)
+
+
+class Coordinator:
+    """ Roles and work items held by this instance. Holding is also tracked locally: on db error a lease is kept
+    until it expires, as other instances can't take it before that either
+
+    :param locks: AdvisoryLocks or LeaseLocks
+    :param ttl: seconds a role is held without renewal, heartbeat renews roles each ttl / 3 """
+
+    def __init__(self, locks, ttl=LEASE_TTL):
+        self.locks = locks
+        self.ttl = ttl
+        self.roles = {}  # role: on_change callback
+        self._roles_held = {}  # role: held at the last heartbeat
+        self._held_until = {}  # lock name: time.monotonic() the lock is held until
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def acquire(self, name, ttl=None) -> bool:
+        """ Takes or renews the lock
+
+        :return bool: True if this instance holds the lock """
+        ttl = ttl or self.ttl
+        requested_at = time.monotonic()
+        acquired = self.locks.acquire(name, ttl)
+        with self._lock:
+            if acquired:
+                self._held_until[name] = requested_at + ttl
+            elif acquired is not None:
+                self._held_until.pop(name, None)
+        return self.holds(name)
+
+    def holds(self, name) -> bool:
+        with self._lock:
+            return time.monotonic() < self._held_until.get(name, 0)
+
+    def release(self, name):
+        with self._lock:
+            self._held_until.pop(name, None)
+        self.locks.release(name)
+
+    def elect(self, role, on_change=None) -> bool:
+        """ Campaigns for the role now and on each heartbeat
+
+        :param on_change: called with True when this instance takes the role and with False when it loses it
+        :return bool: True if this instance holds the role """
+        self.roles[role] = on_change
+        self.renew_roles()
+        return self.holds(role)
+
+    def renew_roles(self):
+        for role, on_change in list(self.roles.items()):
+            held = self.acquire(role)
+            if held == self._roles_held.get(role, False):
+                continue
+            self._roles_held[role] = held
+            metrics.inc("coordination_role_changes_total", role=role, status="taken" if held else "lost")
+            logger.info(f"Instance {INSTANCE_ID} {'took' if held else 'lost'} the {role} role")
+            if on_change:
+                on_change(held)
+
+    def start(self):
+        """ Starts heartbeat thread renewing the roles """
+        self._thread = threading.Thread(target=self.run, name="coordination", daemon=True)
+        self._thread.start()
+        return self
+
+    def run(self):
+        while not self._stopped.wait(self.ttl / 3):
+            try:
+                self.renew_roles()
+            except Exception as e:
+                logger.error(f"Failed to renew roles: {e}")
+
+    def stop(self):
+        """ Stops heartbeat and releases the roles, so other instances take them without waiting for expiry """
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+        for role in self.roles:
+            self.release(role)
+
+
+def get_coordinator() -> Coordinator:
+    """ Returns coordinator of this instance, creating it on the first call """
+    global coordinator
+    with coordinator_lock:
+        if coordinator is None:
+            engine = get_engine()
+            locks = AdvisoryLocks(engine) if engine.dialect.name == "postgresql" else LeaseLocks()
+            coordinator = Coordinator(locks)
+        return coordinator
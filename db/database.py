@@ -3,31 +3,77 @@
 DATABASE FUNCTIONS
 All functions to use DB in the project in one module.
 
+get_engine() -- SQLAlchemy engine, created on the first use
 get_session() -- database session. Made separate and selectable for easy testing
 create_db_and_tables() -- init the db and tables from SQLAlchemy models metadata
+migrate_db() -- add to existing tables columns and indexes which were added to models later
 store_event() -- store decoded and processed blockchain event log into TotalDistributionEvent object and db
+store_events() -- store a batch of decoded events in a single transaction, skipping already stored ones
+insert_tracked_events() -- insert decoded tracked events (other than TotalDistribution) into their tables
 get_events() -- get from db TotalDistributionEvent objects with timestamp in last x hours
+get_events_summary() -- aggregate in db TotalDistributionEvents with timestamp in last x hours
+get_sync_cursor() -- get last fully processed block number, None if nothing was synced yet, raises on db error
+set_sync_cursor() -- save last fully processed block number
+store_scan_results() -- store confirmed events, move confirmed pending events, buffer new pending ones, move cursors
+drop_pending_events() -- drop events from not confirmed blocks, e.g. after chain reorganization
+update_rollups() -- add stored events to hourly and daily rollups
+rebuild_rollups() -- recompute hourly and daily rollups from all stored events
+enqueue_messages() -- put Telegram message for each chat into the outbox
+get_due_messages() -- get outbox messages which are due for (re)sending
+finish_message() -- drop sent message from outbox, or keep it as failed
+retry_message() -- set time of the next attempt to send outbox message
+get_backfill_shards() -- register backfill shards and get those not done yet
+store_backfill_shard() -- store shard events and mark it done in a single transaction
+acquire_lease() -- take a free or expired lease, or renew the own one
+release_lease() -- give up the own lease
 """
 import datetime
 import logging
+import threading
+from decimal import Decimal
 from contextlib import contextmanager
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, inspect, text, func, select, union_all, and_, or_, case, delete, update
+from sqlalchemy.dialects import postgresql, sqlite
 from sqlalchemy.exc import SQLAlchemyError
 from sqlalchemy.orm import sessionmaker, declarative_base
-from db.models import TotalDistributionEvent, Base
+from db.models import TotalDistributionEvent, SyncCursor, HourlyDistributionRollup, DailyDistributionRollup, Base
+from db.models import PendingDistributionEvent, OutboxMessage, BackfillShard, Lease
+from blockchain.registry import event_registry
+from metrics import metrics
 from settings import DB_URL
 
 
 logger = logging.getLogger(__name__)
 
+AMOUNT_COLUMNS = ('input_aix_amount', 'distributed_aix_amount', 'swapped_eth_amount', 'distributed_eth_amount')
+EVENT_COLUMNS = ('block', 'block_hash', 'tx_hash', 'log_index', 'timestamp', 'distributor_wallet') + AMOUNT_COLUMNS
 
-engine = create_engine(DB_URL, echo=False)
-Session = sessionmaker(bind=engine)
+# sync cursor of blocks scanned into pending events buffer, the main cursor is TotalDistributionEvent table name
+PENDING_CURSOR = PendingDistributionEvent.__tablename__
+
+
+# Engine (and its connections pool) is created on the first use by get_engine() and reused after
+engine = None
+engine_lock = threading.Lock()
+Session = sessionmaker()
+
+
+class DatabaseUnavailable(Exception):
+    """ Raised on db error by functions which None result means something else, e.g. no sync cursor yet """
+
+
+def get_engine():
+    """ Returns SQLAlchemy engine, creating it on the first call """
+    global engine
+    with engine_lock:
+        if engine is None:
+            engine = create_engine(DB_URL, echo=False)
+        return engine
 
 
 @contextmanager
 def get_session():
-    db_session = Session()
+    db_session = Session(bind=get_engine())
     try:
         yield db_session
     except SQLAlchemyError as e:
@@ -39,18 +85,45 @@ def get_session():
 
 def create_db_and_tables():
     """ Create the tables for models in the database if they not exists yet """
-    Base.metadata.create_all(engine)
+    rollups_existed = inspect(get_engine()).has_table(HourlyDistributionRollup.__tablename__)
+    Base.metadata.create_all(get_engine())
+    migrate_db(get_engine())
+    if not rollups_existed:
+        rebuild_rollups()  # rollups appeared in db with already stored events
+
 
+def migrate_db(bind=None):
+    """ Lightweight migration for the tables created by previous versions: create_all() doesn't touch existing tables,
+    so missing columns (nullable, old rows get NULL) and indexes are added here. Events stored without log_index
+    get it when they are scanned again, see adopt_legacy_events().
+    Used at startup, safe to run many times """
+    bind = bind or get_engine()
+    inspector = inspect(bind)
+    for table in Base.metadata.sorted_tables:
+        if not inspector.has_table(table.name):
+            continue
+        existing_columns = {column['name'] for column in inspector.get_columns(table.name)}
+        with bind.begin() as connection:
+            for column in table.columns:
+                if column.name not in existing_columns:
+                    column_type = column.type.compile(dialect=bind.dialect)
+                    connection.execute(text(f"ALTER TABLE {table.name} ADD COLUMN {column.name} {column_type}"))
+                    logger.info(f"Column {table.name}.{column.name} added")
+            for index in table.indexes:
+                index.create(connection, checkfirst=True)
 
-def store_event(decoded_log_event, db_session=get_session()):
+
+@metrics.timed("store_event")
+def store_event(decoded_log_event, db_session=None) -> bool:
     """ Store single TotalDistributionEvent object into db
 
     I wasn't sure about opportunity of multiple TotalDistribution Events for a single transaction.
     So the code is designed to pass only unique events to avoid storing duplicate values even
     there is more than one TotalDistribution Event in single transaction.
 
-    :param decoded_log_event: decoded and processed log TotalDistribution event dict """
-    with db_session:
+    :param decoded_log_event: decoded and processed log TotalDistribution event dict
+    :return bool: True if event is stored or was already stored, False on db error """
+    with (db_session or get_session()) as db_session:
         try:
             # It's uncertain if it's possible to have multiple TotalDistribution events in a single transaction.
             # Theoretically, it's possible with tools like https://furucombo.app/ or through arbitrage bots,
@@ -70,18 +143,533 @@ def store_event(decoded_log_event, db_session=get_session()):
                 # No matching event found; add the new event.
                 new_event = TotalDistributionEvent(**decoded_log_event)
                 db_session.add(new_event)
+                update_rollups([decoded_log_event], db_session)
                 db_session.commit()
+                metrics.inc("db_rows_written_total", table=TotalDistributionEvent.__tablename__)
                 logger.info(f"Event {new_event.tx_hash} stored successfully.")
+            return True
 
         except SQLAlchemyError as e:
             db_session.rollback()  # Ensure the session is rolled back on error.
             logger.error(f"Error storing event: {e}")
+            return False
+
+
+@metrics.timed("store_events")
+def store_events(decoded_log_events, db_session=None):
+    """ Store a batch of TotalDistributionEvents into db with a single transaction
+
+    Events are identified by (tx_hash, log_index) unique index, so db itself skips already stored events
+    with INSERT ... ON CONFLICT DO NOTHING, no need to check each of them with SELECT first.
+    Only really inserted events are returned by db and added to rollups in the same transaction.
+
+    :param decoded_log_events: decoded and processed log TotalDistribution event dicts
+    :return int: number of new stored events, None on db error """
+    if not decoded_log_events:
+        return 0
+    with (db_session or get_session()) as session:
+        try:
+            stored_count = insert_events(decoded_log_events, session)
+            session.commit()
+            metrics.inc("db_rows_written_total", stored_count, table=TotalDistributionEvent.__tablename__)
+            logger.info(f"{stored_count} new events of {len(decoded_log_events)} stored successfully.")
+            return stored_count
+        except SQLAlchemyError as e:
+            session.rollback()
+            logger.error(f"Error storing events: {e}")
+            return None
+
+
+def insert_events(decoded_log_events, db_session) -> int:
+    """ Inserts not stored yet events and adds them to rollups, without commit.
+    Tracked events with 'event' key (see blockchain/registry.py) are inserted into their own tables
+
+    :return int: number of new stored TotalDistribution events """
+    insert_tracked_events([event for event in decoded_log_events if 'event' in event], db_session)
+    decoded_log_events = adopt_legacy_events([event for event in decoded_log_events if 'event' not in event],
+                                             db_session)
+    if not decoded_log_events:
+        return 0
+    statement = (dialect_insert(db_session)(TotalDistributionEvent)
+                 .on_conflict_do_nothing(index_elements=["tx_hash", "log_index"])
+                 .returning(TotalDistributionEvent.timestamp, TotalDistributionEvent.distributor_wallet,
+                            *(getattr(TotalDistributionEvent, column) for column in AMOUNT_COLUMNS)))
+    stored_events = [row._asdict() for row in db_session.execute(statement, decoded_log_events)]
+    update_rollups(stored_events, db_session)
+    return len(stored_events)
+
+
+def adopt_legacy_events(decoded_log_events, db_session) -> list:
+    """ Rows stored by versions without log_index column have it NULL after migrate_db(), and NULLs never conflict
+    on the unique index, so the first scan after the upgrade would store them again. Instead an event of a tx which
+    has such a legacy row fills that row (log_index, block hash and the rest of values), without commit.
+    The row is in rollups already, so the event isn't inserted and isn't added to rollups again
+
+    :return list: events which are not stored as legacy rows, to be inserted """
+    tx_hashes = {event['tx_hash'] for event in decoded_log_events}
+    if not tx_hashes:
+        return decoded_log_events
+    legacy_rows = {}  # tx hash: legacy rows of the tx
+    for row in db_session.scalars(select(TotalDistributionEvent).where(
+            TotalDistributionEvent.log_index.is_(None), TotalDistributionEvent.tx_hash.in_(tx_hashes))
+            .order_by(TotalDistributionEvent.id)):
+        legacy_rows.setdefault(row.tx_hash, []).append(row)
+    if not legacy_rows:
+        return decoded_log_events
+
+    new_events = []
+    for event in decoded_log_events:
+        if legacy_rows.get(event['tx_hash']):
+            # old version stored events of a tx by amounts, not by log position, any of its rows can take the event
+            row = legacy_rows[event['tx_hash']].pop(0)
+            for column, value in event.items():
+                setattr(row, column, value)
+        else:
+            new_events.append(event)
+    db_session.flush()
+    logger.info(f"{len(decoded_log_events) - len(new_events)} events stored by previous version got log index")
+    return new_events
+
+
+def insert_tracked_events(decoded_log_events, db_session) -> dict[str, int]:
+    """ Inserts not stored yet tracked events into tables of their events, without commit
+
+    :param decoded_log_events: decoded_log_event dicts with 'event' name key
+    :return dict: table name: number of new stored events """
+    events_by_name = {}
+    for event in decoded_log_events:
+        events_by_name.setdefault(event['event'], []).append(
+            {column: value for column, value in event.items() if column != 'event'})
+    stored_counts = {}
+    for name, events in events_by_name.items():
+        model = event_registry.get(name).model
+        statement = (dialect_insert(db_session)(model).on_conflict_do_nothing(index_elements=["tx_hash", "log_index"])
+                     .returning(model.id))
+        stored_counts[model.__tablename__] = len(db_session.execute(statement, events).all())
+        metrics.inc("db_rows_written_total", stored_counts[model.__tablename__], table=model.__tablename__)
+    return stored_counts
+
+
+@metrics.timed("store_scan_results")
+def store_scan_results(confirmed_events, pending_events, confirmed_block, scanned_block, scanned_block_hash,
+                       db_session=None):
+    """ Stores results of a blocks scan in a single transaction, so db is never left half updated:
+    - stores events from confirmed blocks;
+    - moves from pending buffer events which blocks are confirmed now;
+    - adds to pending buffer events from not confirmed yet blocks;
+    - moves main sync cursor to confirmed_block and pending one to scanned_block.
+    Tracked events (with 'event' key) from not confirmed blocks are stored in their tables at once,
+    drop_pending_events() deletes them if blocks are replaced.
+
+    :params confirmed_events, pending_events: decoded_log_event dicts from confirmed and not confirmed blocks
+    :param confirmed_block: all events up to this block are in TotalDistributionEvent table now
+    :params scanned_block, scanned_block_hash: last scanned block, to check it's still in chain on the next scan
+    :return int: number of new stored (confirmed) events, None on db error """
+    with (db_session or get_session()) as session:
+        try:
+            confirmed_pending_events = session.execute(
+                delete(PendingDistributionEvent).where(PendingDistributionEvent.block <= confirmed_block)
+                .returning(*(getattr(PendingDistributionEvent, column) for column in EVENT_COLUMNS))).all()
+            tracked_pending_events = [event for event in pending_events if 'event' in event]
+            pending_events = [event for event in pending_events if 'event' not in event]
+            stored_count = insert_events(confirmed_events + [row._asdict() for row in confirmed_pending_events] +
+                                         tracked_pending_events, session)
+            if pending_events:
+                session.execute(dialect_insert(session)(PendingDistributionEvent)
+                                .on_conflict_do_nothing(index_elements=["block_hash", "log_index"]), pending_events)
+
+            now = datetime.datetime.utcnow()
+            session.merge(SyncCursor(name=TotalDistributionEvent.__tablename__, last_block=confirmed_block,
+                                     updated_at=now))
+            session.merge(SyncCursor(name=PENDING_CURSOR, last_block=scanned_block, block_hash=scanned_block_hash,
+                                     updated_at=now))
+            session.commit()
+            metrics.inc("db_rows_written_total", stored_count, table=TotalDistributionEvent.__tablename__)
+            metrics.inc("db_rows_written_total", len(pending_events), table=PendingDistributionEvent.__tablename__)
+            logger.info(f"{stored_count} new events stored, {len(confirmed_pending_events)} of them were pending, "
+                        f"{len(pending_events)} events from blocks after {confirmed_block} are pending.")
+            return stored_count
+        except SQLAlchemyError as e:
+            session.rollback()
+            logger.error(f"Error storing scan results: {e}")
+            return None
+
+
+def drop_pending_events(db_session=None) -> bool:
+    """ Drops all events from pending buffer and its sync cursor, so not confirmed blocks are scanned again.
+    Tracked events from not confirmed blocks are deleted from their tables too.
+    Used when chain reorganization replaced the scanned blocks
+
+    :return bool: True if dropped, False on db error """
+    with (db_session or get_session()) as session:
+        try:
+            dropped_count = session.query(PendingDistributionEvent).delete()
+            confirmed_cursor = session.get(SyncCursor, TotalDistributionEvent.__tablename__)
+            if confirmed_cursor is not None:
+                for spec in event_registry.events.values():
+                    if spec.model is not TotalDistributionEvent:
+                        dropped_count += session.execute(
+                            delete(spec.model).where(spec.model.block > confirmed_cursor.last_block)).rowcount
+            session.query(SyncCursor).filter_by(name=PENDING_CURSOR).delete()
+            session.commit()
+            logger.info(f"{dropped_count} pending events dropped")
+            return True
+        except SQLAlchemyError as e:
+            session.rollback()
+            logger.error(f"Error dropping pending events: {e}")
+            return False
 
 
-def get_events(hours=24, db_session=get_session()) -> [TotalDistributionEvent]:
+@metrics.timed("get_events")
+def get_events(hours=24, db_session=None) -> [TotalDistributionEvent]:
     """ Get from db a TotalDistributionEvent objects list matching time range from now """
     now = datetime.datetime.utcnow()  # we store timestamps in utc tz, as in eth blockchain
     start_time = now - datetime.timedelta(hours=hours)
-    with get_session() as session:
+    with (db_session or get_session()) as session:
         events = session.query(TotalDistributionEvent).filter(TotalDistributionEvent.timestamp >= start_time).all()
         return events
+
+
+@metrics.timed("get_events_summary")
+def get_events_summary(hours=24, db_session=None) -> dict[str, any]:
+    """ Aggregates in db TotalDistributionEvents matching time range from now, with a single query.
+
+    Full days inside the time range are taken from daily rollups, the rest full hours from hourly rollups,
+    and only partial hours at the range edges from raw events. So a query reads at most a few hundred rollup rows
+    plus about an hour of raw events for any time range. Everything is grouped by distributor wallet
+    (usually there is only one), so result rows number doesn't depend on events number.
+
+    :return dict: first and last event timestamps, events count, sums of amounts and distributor wallets list;
+        None if there are no events in the time range """
+    start_time = datetime.datetime.utcnow() - datetime.timedelta(hours=hours)
+    hours_start = hour_bucket(start_time)
+    if hours_start < start_time:
+        hours_start += datetime.timedelta(hours=1)
+    hours_end = hour_bucket(datetime.datetime.utcnow())
+    days_start = day_bucket(hours_start)
+    if days_start < hours_start:
+        days_start += datetime.timedelta(days=1)
+    days_end = day_bucket(hours_end)
+    if days_start >= days_end:
+        days_start = days_end = hours_end  # no full days, only hours
+
+    if hours_start < hours_end:
+        queries = [
+            select_raw_summary(or_(and_(TotalDistributionEvent.timestamp >= start_time,
+                                        TotalDistributionEvent.timestamp < hours_start),
+                                   TotalDistributionEvent.timestamp >= hours_end)),
+            select_rollup_summary(HourlyDistributionRollup, or_(
+                and_(HourlyDistributionRollup.bucket >= hours_start, HourlyDistributionRollup.bucket < days_start),
+                and_(HourlyDistributionRollup.bucket >= days_end, HourlyDistributionRollup.bucket < hours_end))),
+            select_rollup_summary(DailyDistributionRollup, and_(DailyDistributionRollup.bucket >= days_start,
+                                                                DailyDistributionRollup.bucket < days_end)),
+        ]
+    else:
+        queries = [select_raw_summary(TotalDistributionEvent.timestamp >= start_time)]
+
+    rows = []
+    with (db_session or get_session()) as session:
+        rows = session.execute(union_all(*queries)).all()
+
+    if not rows:
+        return None
+    summary = {
+        'events_count': sum(row.events_count for row in rows),
+        'first_timestamp': min(row.first_timestamp for row in rows),
+        'last_timestamp': max(row.last_timestamp for row in rows),
+        'distributor_wallets': list(dict.fromkeys(row.distributor_wallet for row in rows)),
+    }
+    for column in AMOUNT_COLUMNS:
+        summary[column] = sum(getattr(row, column) for row in rows)
+    return summary
+
+
+def select_raw_summary(condition):
+    """ SELECT of TotalDistributionEvents aggregated by distributor wallet """
+    return select(
+        TotalDistributionEvent.distributor_wallet,
+        func.count(TotalDistributionEvent.id).label('events_count'),
+        func.min(TotalDistributionEvent.timestamp).label('first_timestamp'),
+        func.max(TotalDistributionEvent.timestamp).label('last_timestamp'),
+        *(func.sum(getattr(TotalDistributionEvent, column)).label(column) for column in AMOUNT_COLUMNS)
+    ).where(condition).group_by(TotalDistributionEvent.distributor_wallet)
+
+
+def select_rollup_summary(model, condition):
+    """ SELECT of rollup buckets aggregated by distributor wallet, the same columns as select_raw_summary() """
+    return select(
+        model.distributor_wallet,
+        func.sum(model.events_count).label('events_count'),
+        func.min(model.first_timestamp).label('first_timestamp'),
+        func.max(model.last_timestamp).label('last_timestamp'),
+        *(func.sum(getattr(model, column)).label(column) for column in AMOUNT_COLUMNS)
+    ).where(condition).group_by(model.distributor_wallet)
+
+
+def get_sync_cursor(name=TotalDistributionEvent.__tablename__, db_session=None, with_hash=False):
+    """ Get last fully processed block number for the synced entity
+
+    :param name: what is synced, by default TotalDistributionEvent table
+    :param with_hash: return block hash too
+    :return int: last processed block number or None if there was no sync yet (first start);
+        (block number, block hash) tuple if with_hash. Raises DatabaseUnavailable on db error, which must not be
+        taken for the first start """
+    read = False
+    with (db_session or get_session()) as session:
+        cursor = session.get(SyncCursor, name)
+        read = True
+    if not read:  # get_session() logged and swallowed the error
+        raise DatabaseUnavailable(f"Can't read sync cursor {name}")
+    if with_hash:
+        return (cursor.last_block, cursor.block_hash) if cursor else (None, None)
+    return cursor.last_block if cursor else None
+
+
+def set_sync_cursor(last_block, name=TotalDistributionEvent.__tablename__, block_hash=None, db_session=None) -> bool:
+    """ Save last fully processed block number, next run will start from the next block
+
+    :param last_block: block num, all events up to and including it are stored
+    :param name: what is synced, by default TotalDistributionEvent table
+    :param block_hash: last block hash, if it needs to be checked later
+    :return bool: True if saved, False on db error """
+    with (db_session or get_session()) as session:
+        try:
+            session.merge(SyncCursor(name=name, last_block=last_block, block_hash=block_hash,
+                                     updated_at=datetime.datetime.utcnow()))
+            session.commit()
+            return True
+        except SQLAlchemyError as e:
+            session.rollback()
+            logger.error(f"Error saving sync cursor {name}: {e}")
+            return False
+
+
+def hour_bucket(timestamp):
+    """ Start of the hour timestamp belongs to """
+    return timestamp.replace(minute=0, second=0, microsecond=0)
+
+
+def day_bucket(timestamp):
+    """ Start of the day timestamp belongs to """
+    return timestamp.replace(hour=0, minute=0, second=0, microsecond=0)
+
+
+ROLLUPS = ((HourlyDistributionRollup, hour_bucket), (DailyDistributionRollup, day_bucket))
+
+
+def dialect_insert(session):
+    """ INSERT construct of the session db dialect, with ON CONFLICT support """
+    return postgresql.insert if session.get_bind().dialect.name == "postgresql" else sqlite.insert
+
+
+def add_to_rollup_rows(rollup_rows, event, bucket_of):
+    """ Adds event to in-memory rollup rows dict keyed by (bucket, distributor_wallet) """
+    key = (bucket_of(event['timestamp']), event['distributor_wallet'])
+    row = rollup_rows.get(key)
+    if row is None:
+        rollup_rows[key] = {'bucket': key[0], 'distributor_wallet': key[1], 'events_count': 1,
+                            'first_timestamp': event['timestamp'], 'last_timestamp': event['timestamp'],
+                            **{column: Decimal(event[column]) for column in AMOUNT_COLUMNS}}
+    else:
+        row['events_count'] += 1
+        row['first_timestamp'] = min(row['first_timestamp'], event['timestamp'])
+        row['last_timestamp'] = max(row['last_timestamp'], event['timestamp'])
+        for column in AMOUNT_COLUMNS:
+            row[column] += Decimal(event[column])
+
+
+def update_rollups(stored_events, db_session):
+    """ Adds just stored events to hourly and daily rollups; doesn't commit, so it's done in the events transaction
+
+    :param stored_events: dicts with timestamp, distributor_wallet and amounts of new events
+    :param db_session: session events were stored with """
+    for model, bucket_of in ROLLUPS:
+        rollup_rows = {}
+        for event in stored_events:
+            add_to_rollup_rows(rollup_rows, event, bucket_of)
+        if not rollup_rows:
+            continue
+        insert = dialect_insert(db_session)(model)
+        statement = insert.on_conflict_do_update(index_elements=["bucket", "distributor_wallet"], set_={
+            'events_count': model.events_count + insert.excluded.events_count,
+            'first_timestamp': case((insert.excluded.first_timestamp < model.first_timestamp,
+                                     insert.excluded.first_timestamp), else_=model.first_timestamp),
+            'last_timestamp': case((insert.excluded.last_timestamp > model.last_timestamp,
+                                    insert.excluded.last_timestamp), else_=model.last_timestamp),
+            **{column: getattr(model, column) + getattr(insert.excluded, column) for column in AMOUNT_COLUMNS}})
+        db_session.execute(statement, list(rollup_rows.values()))
+
+
+def rebuild_rollups(db_session=None) -> bool:
+    """ Recomputes hourly and daily rollups from all stored TotalDistributionEvents,
+    e.g. after events were deleted or changed manually
+
+    :return bool: True if rebuilt, False on db error """
+    with (db_session or get_session()) as session:
+        try:
+            rollups_rows = {model: {} for model, _ in ROLLUPS}
+            events = session.query(TotalDistributionEvent.timestamp, TotalDistributionEvent.distributor_wallet,
+                                   *(getattr(TotalDistributionEvent, column) for column in AMOUNT_COLUMNS))
+            for event in events.yield_per(10000):
+                for model, bucket_of in ROLLUPS:
+                    add_to_rollup_rows(rollups_rows[model], event._asdict(), bucket_of)
+
+            for model, rollup_rows in rollups_rows.items():
+                session.query(model).delete()
+                if rollup_rows:
+                    session.execute(dialect_insert(session)(model), list(rollup_rows.values()))
+            session.commit()
+            for model, rollup_rows in rollups_rows.items():
+                logger.info(f"Rollups {model.__tablename__} rebuilt, {len(rollup_rows)} rows")
+            return True
+        except SQLAlchemyError as e:
+            session.rollback()
+            logger.error(f"Error rebuilding rollups: {e}")
+            return False
+
+
+def enqueue_messages(chat_ids, text, parse_mode=None, db_session=None) -> bool:
+    """ Puts message for each chat into the outbox in one transaction
+
+    :return bool: True if stored, False on db error """
+    now = datetime.datetime.utcnow()
+    with (db_session or get_session()) as session:
+        try:
+            session.add_all([OutboxMessage(chat_id=chat_id, text=text, parse_mode=parse_mode, status="pending",
+                                           attempts=0, next_attempt_at=now, created_at=now) for chat_id in chat_ids])
+            session.commit()
+            return True
+        except SQLAlchemyError as e:
+            session.rollback()
+            logger.error(f"Error storing outbox messages: {e}")
+            return False
+
+
+def get_due_messages(limit=100, db_session=None) -> [OutboxMessage]:
+    """ Get from db pending outbox messages which next attempt time has come, the oldest first """
+    messages = []
+    with (db_session or get_session()) as session:
+        messages = session.query(OutboxMessage).filter(
+            OutboxMessage.status == "pending", OutboxMessage.next_attempt_at <= datetime.datetime.utcnow()
+        ).order_by(OutboxMessage.id).limit(limit).all()
+        session.expunge_all()  # messages are used after the session is closed
+    return messages
+
+
+def finish_message(message_id, error=None, db_session=None) -> bool:
+    """ Drops sent message from outbox, or keeps it with 'failed' status and error if it can't be sent
+
+    :return bool: True if saved, False on db error """
+    with (db_session or get_session()) as session:
+        try:
+            if error is None:
+                session.query(OutboxMessage).filter_by(id=message_id).delete()
+            else:
+                session.query(OutboxMessage).filter_by(id=message_id).update(
+                    {'status': "failed", 'last_error': error, 'attempts': OutboxMessage.attempts + 1})
+            session.commit()
+            return True
+        except SQLAlchemyError as e:
+            session.rollback()
+            logger.error(f"Error finishing outbox message {message_id}: {e}")
+            return False
+
+
+def retry_message(message_id, next_attempt_at, error=None, db_session=None) -> bool:
+    """ Sets time of the next attempt to send outbox message
+
+    :param error: why the attempt failed, None if message was just postponed (not counted as attempt)
+    :return bool: True if saved, False on db error """
+    values = {'next_attempt_at': next_attempt_at}
+    if error is not None:
+        values.update(last_error=error, attempts=OutboxMessage.attempts + 1)
+    with (db_session or get_session()) as session:
+        try:
+            session.query(OutboxMessage).filter_by(id=message_id).update(values)
+            session.commit()
+            return True
+        except SQLAlchemyError as e:
+            session.rollback()
+            logger.error(f"Error rescheduling outbox message {message_id}: {e}")
+            return False
+
+
+def get_backfill_shards(shards, db_session=None):
+    """ Registers backfill shards which are not in db yet and returns the ones not done, so the same backfill
+    started again continues where it stopped
+
+    :param shards: (start_block, end_block) tuples
+    :return list: (start_block, end_block) tuples of not done shards, None on db error """
+    with (db_session or get_session()) as session:
+        try:
+            if shards:
+                session.execute(dialect_insert(session)(BackfillShard).on_conflict_do_nothing(), [
+                    {'start_block': start_block, 'end_block': end_block, 'status': "pending"}
+                    for start_block, end_block in shards])
+            done_shards = set(session.execute(select(BackfillShard.start_block, BackfillShard.end_block)
+                                              .where(BackfillShard.status == "done")).tuples())
+            session.commit()
+            return [shard for shard in shards if tuple(shard) not in done_shards]
+        except SQLAlchemyError as e:
+            session.rollback()
+            logger.error(f"Error registering backfill shards: {e}")
+            return None
+
+
+@metrics.timed("store_backfill_shard")
+def store_backfill_shard(decoded_log_events, start_block, end_block, db_session=None):
+    """ Stores backfill shard events (skipping already stored ones) and marks the shard done in one transaction
+
+    :return int: number of new stored events, None on db error """
+    with (db_session or get_session()) as session:
+        try:
+            stored_count = insert_events(decoded_log_events, session)
+            session.merge(BackfillShard(start_block=start_block, end_block=end_block, status="done",
+                                        events_count=len(decoded_log_events),
+                                        updated_at=datetime.datetime.utcnow()))
+            session.commit()
+            metrics.inc("db_rows_written_total", stored_count, table=TotalDistributionEvent.__tablename__)
+            return stored_count
+        except SQLAlchemyError as e:
+            session.rollback()
+            logger.error(f"Error storing backfill shard {start_block}-{end_block}: {e}")
+            return None
+
+
+def acquire_lease(name, owner, ttl, db_session=None):
+    """ Takes the lease if it's free or expired, renews it if owner holds it already. Update is conditional,
+    so of instances racing for an expired lease only one gets it
+
+    :param owner: instance id
+    :param ttl: seconds the lease is held for without renewal
+    :return bool: True if owner holds the lease now, False if another owner does, None on db error """
+    now = datetime.datetime.utcnow()
+    expires_at = now + datetime.timedelta(seconds=ttl)
+    with (db_session or get_session()) as session:
+        try:
+            session.execute(dialect_insert(session)(Lease).on_conflict_do_nothing(),
+                            [{'name': name, 'owner': owner, 'expires_at': now}])
+            acquired_count = session.execute(
+                update(Lease).where(Lease.name == name, or_(Lease.owner == owner, Lease.expires_at <= now))
+                .values(owner=owner, expires_at=expires_at)).rowcount
+            session.commit()
+            return acquired_count == 1
+        except SQLAlchemyError as e:
+            session.rollback()
+            logger.error(f"Error acquiring lease {name}: {e}")
+            return None
+
+
+def release_lease(name, owner, db_session=None) -> bool:
+    """ Gives up the lease if owner holds it, so other instances can take it at once
+
+    :return bool: True if released (or not held), False on db error """
+    with (db_session or get_session()) as session:
+        try:
+            session.execute(delete(Lease).where(Lease.name == name, Lease.owner == owner))
+            session.commit()
+            return True
+        except SQLAlchemyError as e:
+            session.rollback()
+            logger.error(f"Error releasing lease {name}: {e}")
+            return False
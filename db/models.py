@@ -1,9 +1,18 @@
 # -*- coding: utf-8 -*-
 """
-SQLAlchemy TotalDistributionEvent Model
+SQLAlchemy Models
+
+TotalDistributionEvent -- decoded TotalDistribution event from smart contract logs
+SyncCursor -- last fully processed blockchain block, so each run continues where the previous one stopped
+HourlyDistributionRollup, DailyDistributionRollup -- TotalDistributionEvents pre-aggregated by hour / day and wallet
+PendingDistributionEvent -- decoded TotalDistribution event from a block not deep enough to be sure it stays in chain
+OutboxMessage -- Telegram message waiting for delivery, so unsent reports survive restarts
+BackfillShard -- block range of a historical backfill and its progress, so an interrupted backfill resumes
+Lease -- role or work item held by an instance until it expires, so replicas don't do the same work
+make_event_model() -- model of a tracked event table, with event arguments columns
 """
 from dataclasses import dataclass
-from sqlalchemy import Column, String, Integer, BigInteger, DateTime, DECIMAL
+from sqlalchemy import Column, String, Integer, BigInteger, DateTime, DECIMAL, Index, Text
 from sqlalchemy.orm import declarative_base
 
 
@@ -12,12 +21,145 @@ Base = declarative_base()
 @dataclass
 class TotalDistributionEvent(Base):
     __tablename__ = "total_distribution_events"
+    __table_args__ = (
+        # tx hash and log position in the block identify event, so the same log can't be stored twice
+        Index("uq_total_distribution_events_tx_hash_log_index", "tx_hash", "log_index", unique=True),
+        Index("ix_total_distribution_events_timestamp", "timestamp"),  # reports time range
+        Index("ix_total_distribution_events_block", "block"),  # blocks range
+    )
     id: int = Column(Integer, primary_key=True)
     block: BigInteger = Column(BigInteger)
+    block_hash: str = Column(String)
     tx_hash: str = Column(String)
+    log_index: int = Column(Integer)
     timestamp: DateTime = Column(DateTime)  # storing in UTC time
     distributor_wallet: str = Column(String)
     input_aix_amount: DECIMAL = Column(DECIMAL(precision=38, scale=0))
     distributed_aix_amount: DECIMAL = Column(DECIMAL(precision=38, scale=0))
     swapped_eth_amount: DECIMAL = Column(DECIMAL(precision=38, scale=0))
     distributed_eth_amount: DECIMAL = Column(DECIMAL(precision=38, scale=0))
+
+
+@dataclass
+class SyncCursor(Base):
+    __tablename__ = "sync_cursors"
+    name: str = Column(String, primary_key=True)  # what is synced, e.g. "total_distribution_events" table name
+    last_block: BigInteger = Column(BigInteger)  # last block fully fetched, decoded and stored
+    block_hash: str = Column(String)  # last block hash, to check it's still in the chain on the next run
+    updated_at: DateTime = Column(DateTime)  # storing in UTC time
+
+
+@dataclass
+class PendingDistributionEvent(Base):
+    """ Confirmation buffer: events from the blocks near the head are kept here keyed by block hash,
+    they are moved to TotalDistributionEvent when block is CONFIRMATION_BLOCKS deep
+    and dropped if block was replaced by chain reorganization """
+    __tablename__ = "pending_distribution_events"
+    __table_args__ = (
+        Index("uq_pending_distribution_events_block_hash_log_index", "block_hash", "log_index", unique=True),
+    )
+    id: int = Column(Integer, primary_key=True)
+    block: BigInteger = Column(BigInteger)
+    block_hash: str = Column(String)
+    tx_hash: str = Column(String)
+    log_index: int = Column(Integer)
+    timestamp: DateTime = Column(DateTime)  # storing in UTC time
+    distributor_wallet: str = Column(String)
+    input_aix_amount: DECIMAL = Column(DECIMAL(precision=38, scale=0))
+    distributed_aix_amount: DECIMAL = Column(DECIMAL(precision=38, scale=0))
+    swapped_eth_amount: DECIMAL = Column(DECIMAL(precision=38, scale=0))
+    distributed_eth_amount: DECIMAL = Column(DECIMAL(precision=38, scale=0))
+
+
+class DistributionRollupMixin:
+    """ TotalDistributionEvents aggregated by time bucket and distributor wallet,
+    updated incrementally with each stored event, so long time range reports don't scan all raw events """
+    bucket = Column(DateTime, primary_key=True)  # bucket start, storing in UTC time
+    distributor_wallet = Column(String, primary_key=True)
+    events_count = Column(Integer)
+    first_timestamp = Column(DateTime)
+    last_timestamp = Column(DateTime)
+    input_aix_amount = Column(DECIMAL(precision=38, scale=0))
+    distributed_aix_amount = Column(DECIMAL(precision=38, scale=0))
+    swapped_eth_amount = Column(DECIMAL(precision=38, scale=0))
+    distributed_eth_amount = Column(DECIMAL(precision=38, scale=0))
+
+
+class HourlyDistributionRollup(DistributionRollupMixin, Base):
+    __tablename__ = "hourly_distribution_rollups"
+
+
+class DailyDistributionRollup(DistributionRollupMixin, Base):
+    __tablename__ = "daily_distribution_rollups"
+
+
+@dataclass
+class OutboxMessage(Base):
+    """ Telegram delivery queue: message is deleted when sent, or kept with 'failed' status when Telegram rejected it
+    or it ran out of retries """
+    __tablename__ = "outbox_messages"
+    __table_args__ = (
+        Index("ix_outbox_messages_status_next_attempt_at", "status", "next_attempt_at"),  # due messages
+    )
+    id: int = Column(Integer, primary_key=True)
+    chat_id: BigInteger = Column(BigInteger)
+    text: str = Column(Text)
+    parse_mode: str = Column(String)
+    status: str = Column(String, default="pending")  # pending or failed
+    attempts: int = Column(Integer, default=0)
+    next_attempt_at: DateTime = Column(DateTime)  # storing in UTC time
+    last_error: str = Column(String)
+    created_at: DateTime = Column(DateTime)  # storing in UTC time
+
+
+@dataclass
+class BackfillShard(Base):
+    __tablename__ = "backfill_shards"
+    start_block: BigInteger = Column(BigInteger, primary_key=True)
+    end_block: BigInteger = Column(BigInteger, primary_key=True)
+    status: str = Column(String, default="pending")  # pending or done
+    events_count: int = Column(Integer)  # decoded events in the shard
+    updated_at: DateTime = Column(DateTime)  # storing in UTC time
+
+
+@dataclass
+class Lease(Base):
+    """ Lease of a role (e.g. sending reports) or a work item (e.g. backfill shard), see db/coordination.py """
+    __tablename__ = "leases"
+    name: str = Column(String, primary_key=True)
+    owner: str = Column(String)  # instance id
+    expires_at: DateTime = Column(DateTime)  # storing in UTC time, then any instance can take the lease
+
+
+# Tracked events models by table name, each table is declared once
+event_models = {}
+# Columns every tracked event table has, event arguments with the same names get "_arg" suffix
+EVENT_MODEL_COLUMNS = ('id', 'block', 'block_hash', 'tx_hash', 'log_index', 'timestamp', 'address')
+
+
+def make_event_model(class_name, table_name, columns):
+    """ Declares model of a tracked event (see blockchain/registry.py): log position, block time and contract
+    which emitted the event, then a column for each event argument
+
+    :param columns: dict of argument column name: SQLAlchemy column type
+    :return: model class, the same one for the same table name """
+    if table_name in event_models:
+        return event_models[table_name]
+    attributes = {
+        '__tablename__': table_name,
+        '__table_args__': (
+            Index(f"uq_{table_name}_tx_hash_log_index", "tx_hash", "log_index", unique=True),
+            Index(f"ix_{table_name}_timestamp", "timestamp"),
+            Index(f"ix_{table_name}_block", "block"),
+        ),
+        'id': Column(Integer, primary_key=True),
+        'block': Column(BigInteger),
+        'block_hash': Column(String),
+        'tx_hash': Column(String),
+        'log_index': Column(Integer),
+        'timestamp': Column(DateTime),  # storing in UTC time
+        'address': Column(String),  # contract which emitted the event
+    }
+    attributes.update({name: Column(column_type) for name, column_type in columns.items()})
+    event_models[table_name] = type(class_name, (Base,), attributes)
+    return event_models[table_name]
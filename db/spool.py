@@ -0,0 +1,297 @@
+# -*- coding: utf-8 -*-
+"""
+SCAN RESULTS SPOOL
+
+Append-only local write-ahead log of blocks scan results. Ingestion appends decoded events and the cursors they
+move to, and goes on scanning from the spooled cursors; a background flusher stores spooled records into db in bulk
+and checkpoints the last stored one. So a slow or down database doesn't slow down or stop RPC ingestion, and
+events fetched while db was down are stored later instead of being fetched again.
+
+Records are JSON lines "<seq> <crc32> <json>" in segment files named by their first record seq. A line torn by
+a crash fails its checksum and is dropped on start, with everything after it. Storing records is idempotent
+(already stored events are skipped), so records stored but not checkpointed before a crash are stored again.
+Checkpoint file keeps the cursors of the stored records too, so ingestion doesn't need db to know where to go on.
+
+Spool -- segment files, append / read / checkpoint, sync cursors the spooled records move to
+SpoolFlusher -- background thread storing spooled records into db
+flush_spool() -- store spooled records into db, consecutive scans are merged into a single transaction
+merge_scans() -- merge consecutive scan records into one
+"""
+import datetime
+import json
+import logging
+import os
+import threading
+import zlib
+from decimal import Decimal
+from db.database import store_scan_results, drop_pending_events, PENDING_CURSOR
+from db.models import TotalDistributionEvent
+from metrics import metrics
+from settings import SPOOL_SEGMENT_SIZE, SPOOL_FLUSH_INTERVAL, SPOOL_FLUSH_BATCH
+
+
+logger = logging.getLogger(__name__)
+
+SCAN = "scan"  # record of blocks scan: events and cursors, see run.get_and_process_blockchain_logs()
+DROP_PENDING = "drop_pending"  # record of chain reorganization: pending events must be dropped
+SEGMENT_SUFFIX = ".seg"
+CHECKPOINT_FILE = "checkpoint"
+
+
+def encode_value(value):
+    """ JSON encoding of the decoded events values JSON doesn't support """
+    if isinstance(value, datetime.datetime):
+        return {'$datetime': value.isoformat()}
+    if isinstance(value, Decimal):
+        return {'$decimal': str(value)}
+    raise TypeError(f"Can't spool {type(value).__name__} value")
+
+
+def decode_value(item):
+    if '$datetime' in item:
+        return datetime.datetime.fromisoformat(item['$datetime'])
+    if '$decimal' in item:
+        return Decimal(item['$decimal'])
+    return item
+
+
+class Spool:
+    """ Segment files of records in a directory, with checkpoint of the last record stored into db
+
+    :param path: spool directory, created if it doesn't exist
+    :param segment_size: bytes, then the next segment file is started """
+
+    def __init__(self, path, segment_size=SPOOL_SEGMENT_SIZE):
+        self.path = path
+        self.segment_size = segment_size
+        self.wakeup = threading.Event()  # set on append, so the flusher doesn't wait for its interval
+        self._lock = threading.Lock()
+        self._file = None  # current segment opened for append
+        os.makedirs(path, exist_ok=True)
+        self.checkpoint_seq, self.stored_cursors = self.read_checkpoint()
+        self._cursors = dict(self.stored_cursors)  # sync cursor name: (last block, block hash) of spooled records
+        self.last_seq = self.checkpoint_seq
+        for seq, record in self.read():  # drops torn tail, restores cursors of the not stored yet records
+            self.last_seq = seq
+            self.update_cursors(record)
+        if self.backlog():
+            logger.info(f"Spool has {self.backlog()} records to store into db")
+
+    def segments(self) -> list[tuple[int, str]]:
+        """ (first record seq, file path) of segment files, from the oldest """
+        return sorted((int(name[:-len(SEGMENT_SUFFIX)]), os.path.join(self.path, name))
+                      for name in os.listdir(self.path) if name.endswith(SEGMENT_SUFFIX))
+
+    def read_checkpoint(self) -> tuple[int, dict]:
+        """ :return tuple: seq of the last stored record, sync cursors of the stored records by name """
+        try:
+            with open(os.path.join(self.path, CHECKPOINT_FILE)) as checkpoint_file:
+                checkpoint = json.load(checkpoint_file)
+        except FileNotFoundError:
+            return 0, {}
+        if isinstance(checkpoint, int):  # checkpoint of the first version: seq only
+            return checkpoint, {}
+        return checkpoint['seq'], {name: tuple(cursor) for name, cursor in checkpoint['cursors'].items()}
+
+    def backlog(self) -> int:
+        """ Number of records not stored into db yet """
+        return self.last_seq - self.checkpoint_seq
+
+    def cursors(self) -> dict:
+        """ Sync cursors the spooled records (stored or not yet) move to, by cursor name: (last block, block hash).
+        Cursor which isn't here was not moved through the spool yet, it's in db """
+        with self._lock:
+            return dict(self._cursors)
+
+    def update_cursors(self, record, cursors=None):
+        """ Moves cursors (of all spooled records by default) as the record moves them """
+        cursors = self._cursors if cursors is None else cursors
+        if record['type'] == SCAN:
+            cursors[TotalDistributionEvent.__tablename__] = (record['confirmed_block'], None)
+            cursors[PENDING_CURSOR] = (record['scanned_block'], record['scanned_block_hash'])
+        elif record['type'] == DROP_PENDING:
+            cursors[PENDING_CURSOR] = (None, None)
+
+    def append(self, record) -> int:
+        """ Appends record and syncs it to disk
+
+        :return int: record seq """
+        line_data = json.dumps(record, default=encode_value)
+        with self._lock:
+            seq = self.last_seq + 1
+            if self._file is None or self._file.tell() >= self.segment_size:
+                if self._file is not None:
+                    self._file.close()
+                self._file = open(os.path.join(self.path, f"{seq:012d}{SEGMENT_SUFFIX}"), "a")
+            self._file.write(f"{seq} {zlib.crc32(line_data.encode()):08x} {line_data}\n")
+            self._file.flush()
+            os.fsync(self._file.fileno())
+            self.last_seq = seq
+            self.update_cursors(record)
+        metrics.inc("spool_records_total", status="appended")
+        self.wakeup.set()
+        return seq
+
+    def read(self, limit=None) -> list[tuple[int, dict]]:
+        """ Reads not stored yet records, from the oldest
+
+        :return list: of (seq, record) tuples """
+        records = []
+        with self._lock:  # lines are read only when fully written
+            for _, segment_path in self.segments():
+                with open(segment_path, "rb") as segment_file:
+                    offset = 0
+                    for line in segment_file:
+                        record = self.parse_line(line)
+                        if record is None:
+                            self.truncate(segment_path, offset)
+                            return records
+                        offset += len(line)
+                        if record[0] > self.checkpoint_seq:
+                            records.append(record)
+                            if limit is not None and len(records) >= limit:
+                                return records
+        return records
+
+    def parse_line(self, line):
+        """ Parses and checks record line, None if it's torn or broken """
+        try:
+            seq, checksum, line_data = line.decode().rstrip("\n").split(" ", 2)
+            if not line.endswith(b"\n") or int(checksum, 16) != zlib.crc32(line_data.encode()):
+                return None
+            return int(seq), json.loads(line_data, object_hook=decode_value)
+        except ValueError:
+            return None
+
+    def truncate(self, segment_path, size):
+        """ Cuts broken tail of the segment (and drops later segments): records after it can't be trusted.
+        Called with the lock held """
+        logger.error(f"Spool segment {segment_path} is broken at {size} bytes, records after it are dropped")
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        with open(segment_path, "r+b") as segment_file:
+            segment_file.truncate(size)
+        for _, later_segment_path in self.segments():
+            if later_segment_path > segment_path:
+                os.remove(later_segment_path)
+
+    def checkpoint(self, seq, records=()):
+        """ Records that records up to seq are stored into db, removes segments with stored records only
+
+        :param records: records stored since the previous checkpoint, their cursors are kept in checkpoint file """
+        checkpoint_path = os.path.join(self.path, CHECKPOINT_FILE)
+        with self._lock:
+            for record in records:
+                self.update_cursors(record, self.stored_cursors)
+            with open(f"{checkpoint_path}.tmp", "w") as checkpoint_file:
+                json.dump({'seq': seq, 'cursors': self.stored_cursors}, checkpoint_file)
+                checkpoint_file.flush()
+                os.fsync(checkpoint_file.fileno())
+            os.replace(f"{checkpoint_path}.tmp", checkpoint_path)
+            metrics.inc("spool_records_total", seq - self.checkpoint_seq, status="stored")
+            self.checkpoint_seq = seq
+            segments = self.segments()
+            for (_, segment_path), (next_first_seq, _) in zip(segments, segments[1:]):
+                if next_first_seq <= seq + 1:
+                    os.remove(segment_path)
+            if seq >= self.last_seq:
+                # everything is in db now, cursors stay: db may be down when they are needed next time
+                if self._file is not None:
+                    self._file.close()
+                    self._file = None
+                for _, segment_path in self.segments():
+                    os.remove(segment_path)
+
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+
+def merge_scans(records) -> dict:
+    """ Merges consecutive scan records into one, which stored gives the same db state as storing them one by one:
+    events of the earlier scans pending buffer which blocks are confirmed by the last scan are confirmed ones """
+    last_record = records[-1]
+    pending_events = [event for record in records for event in record['pending_events']]
+    return {
+        'type': SCAN,
+        'confirmed_events': [event for record in records for event in record['confirmed_events']] +
+                            [event for event in pending_events if event['block'] <= last_record['confirmed_block']],
+        'pending_events': [event for event in pending_events if event['block'] > last_record['confirmed_block']],
+        'confirmed_block': last_record['confirmed_block'],
+        'scanned_block': last_record['scanned_block'],
+        'scanned_block_hash': last_record['scanned_block_hash'],
+    }
+
+
+@metrics.timed("flush_spool")
+def flush_spool(spool: Spool, batch_size=SPOOL_FLUSH_BATCH):
+    """ Stores spooled records into db: consecutive scans are merged and stored in a single transaction,
+    checkpoint moves after each stored transaction
+
+    :return int: number of new stored (confirmed) events, None on db error (not stored records stay in spool) """
+    stored_count = 0
+    while records := spool.read(batch_size):
+        scans = []
+        for seq, record in records + [(None, None)]:  # the end of records finishes the last scans group
+            if scans and (record is None or record['type'] != SCAN):
+                scan = merge_scans([scan_record for _, scan_record in scans])
+                scan_stored_count = store_scan_results(scan['confirmed_events'], scan['pending_events'],
+                                                       scan['confirmed_block'], scan['scanned_block'],
+                                                       scan['scanned_block_hash'])
+                if scan_stored_count is None:
+                    return None
+                stored_count += scan_stored_count
+                spool.checkpoint(scans[-1][0], [scan_record for _, scan_record in scans])
+                scans = []
+            if record is None:
+                break
+            if record['type'] == SCAN:
+                scans.append((seq, record))
+            elif record['type'] == DROP_PENDING:
+                if not drop_pending_events():
+                    return None
+                spool.checkpoint(seq, [record])
+    return stored_count
+
+
+class SpoolFlusher:
+    """ Daemon thread storing spooled records into db each interval seconds or as soon as a record is appended,
+    waits for the interval after db errors
+
+    :param on_stored: called with number of new stored events, e.g. to invalidate reports cache """
+
+    def __init__(self, spool: Spool, interval=SPOOL_FLUSH_INTERVAL, on_stored=None):
+        self.spool = spool
+        self.interval = interval
+        self.on_stored = on_stored
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self.run, name="spool-flusher", daemon=True)
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self, timeout=None):
+        self._stopped.set()
+        self.spool.wakeup.set()
+        self._thread.join(timeout)
+
+    def run(self):
+        while not self._stopped.is_set():
+            self.spool.wakeup.wait(self.interval)
+            self.spool.wakeup.clear()
+            if not self.spool.backlog():
+                continue
+            try:
+                stored_count = flush_spool(self.spool)
+            except Exception as e:
+                logger.error(f"Failed to flush spool: {e}")
+                stored_count = None
+            if stored_count is None:
+                logger.error(f"Spool is not stored into db, {self.spool.backlog()} records wait for the next try")
+                self._stopped.wait(self.interval)
+            elif stored_count and self.on_stored:
+                self.on_stored(stored_count)
@@ -0,0 +1,176 @@
+# -*- coding: utf-8 -*-
+"""
+METRICS
+
+Lightweight in-process instrumentation: counters and histograms with labels, exported in Prometheus text format
+by a local HTTP endpoint (METRICS_PORT in settings.py) and summed up in a log line after each job run.
+
+    @metrics.timed("fetch_logs")  -- stage duration histogram and errors counter
+    metrics.inc("rpc_requests_total", method="eth_getLogs")
+    metrics.add_collector(...)  -- values read at export time, e.g. caches counters
+
+Metrics -- registry of counters, histograms and collectors
+start_metrics_server() -- serve /metrics on a local port in a background thread
+"""
+import bisect
+import functools
+import logging
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+logger = logging.getLogger(__name__)
+
+PREFIX = "aix_"
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300)  # seconds
+
+
+def format_labels(labels, **extra_labels) -> str:
+    """ Prometheus labels like {stage="fetch_logs"} from labels tuple """
+    labels = labels + tuple(extra_labels.items())
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{name}="{value}"' for name, value in labels) + "}"
+
+
+class Metrics:
+    """ Registry of counters and histograms by name and labels, thread safe """
+
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.counters = defaultdict(float)  # (name, labels): value
+        self.histograms = {}  # (name, labels): [count by bucket, sum, count]
+        self.collectors = []  # functions returning [(name, labels dict, value)] of counters
+        self._lock = threading.Lock()
+
+    def inc(self, name, value=1, **labels):
+        """ Adds value to the counter """
+        with self._lock:
+            self.counters[(name, tuple(sorted(labels.items())))] += value
+
+    def observe(self, name, value, **labels):
+        """ Adds observation (e.g. seconds) to the histogram """
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            histogram = self.histograms.setdefault(key, [[0] * len(self.buckets), 0.0, 0])
+            bucket_index = bisect.bisect_left(self.buckets, value)
+            if bucket_index < len(self.buckets):
+                histogram[0][bucket_index] += 1
+            histogram[1] += value
+            histogram[2] += 1
+
+    @contextmanager
+    def timer(self, name, **labels):
+        """ Observes duration of the with block """
+        started_at = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - started_at, **labels)
+
+    def timed(self, stage):
+        """ Decorator observing function duration in stage_seconds histogram and its exceptions in stage_errors_total """
+        def decorator(func):
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                with self.timer("stage_seconds", stage=stage):
+                    try:
+                        return func(*args, **kwargs)
+                    except Exception:
+                        self.inc("stage_errors_total", stage=stage)
+                        raise
+            return wrapper
+        return decorator
+
+    def add_collector(self, collect):
+        """ Adds function returning [(name, labels dict, value)] of counters kept elsewhere, read at export time """
+        self.collectors.append(collect)
+
+    def collect_counters(self) -> dict:
+        """ All counters, own and collected, by (name, labels) """
+        with self._lock:
+            counters = dict(self.counters)
+        for collect in self.collectors:
+            try:
+                for name, labels, value in collect():
+                    counters[(name, tuple(sorted(labels.items())))] = value
+            except Exception as e:
+                logger.error(f"Metrics collector failed: {e}")
+        return counters
+
+    def snapshot(self) -> dict:
+        """ Current counters values and histograms sums and counts, to summarize a run later """
+        with self._lock:
+            histograms = {key: (histogram[1], histogram[2]) for key, histogram in self.histograms.items()}
+        return {'counters': self.collect_counters(), 'histograms': histograms}
+
+    def summary(self, since=None) -> str:
+        """ One line with what changed since the snapshot: stages time and calls, then counters increments """
+        since = since or {'counters': {}, 'histograms': {}}
+        now = self.snapshot()
+        parts = []
+        for (name, labels), (total, count) in sorted(now['histograms'].items()):
+            total_before, count_before = since['histograms'].get((name, labels), (0.0, 0))
+            if count > count_before:
+                parts.append(f"{name}{format_labels(labels)}={total - total_before:.3f}s/{count - count_before}")
+        for (name, labels), value in sorted(now['counters'].items()):
+            increment = value - since['counters'].get((name, labels), 0)
+            if increment:
+                parts.append(f"{name}{format_labels(labels)}={increment:g}")
+        return ", ".join(parts) or "no activity"
+
+    def render(self) -> str:
+        """ All metrics in Prometheus text exposition format """
+        lines = []
+        typed = set()
+        for (name, labels), value in sorted(self.collect_counters().items()):
+            if name not in typed:
+                lines.append(f"# TYPE {PREFIX}{name} counter")
+                typed.add(name)
+            lines.append(f"{PREFIX}{name}{format_labels(labels)} {value:g}")
+        with self._lock:
+            histograms = {key: (list(histogram[0]), histogram[1], histogram[2])
+                          for key, histogram in self.histograms.items()}
+        for (name, labels), (bucket_counts, total, count) in sorted(histograms.items()):
+            if name not in typed:
+                lines.append(f"# TYPE {PREFIX}{name} histogram")
+                typed.add(name)
+            cumulative = 0
+            for upper_bound, bucket_count in zip(self.buckets, bucket_counts):
+                cumulative += bucket_count
+                lines.append(f"{PREFIX}{name}_bucket{format_labels(labels, le=upper_bound)} {cumulative}")
+            lines.append(f"{PREFIX}{name}_bucket{format_labels(labels, le='+Inf')} {count}")
+            lines.append(f"{PREFIX}{name}_sum{format_labels(labels)} {total:g}")
+            lines.append(f"{PREFIX}{name}_count{format_labels(labels)} {count}")
+        return "\n".join(lines) + "\n"
+
+
+metrics = Metrics()
+
+
+def start_metrics_server(port, host="127.0.0.1", registry=metrics) -> ThreadingHTTPServer:
+    """ Serves registry metrics at http://host:port/metrics from a daemon thread
+
+    :return: server, stopped by shutdown() """
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split("?")[0] != "/metrics":
+                self.send_error(404)
+                return
+            body = registry.render().encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    threading.Thread(target=server.serve_forever, name="metrics", daemon=True).start()
+    logger.info(f"Metrics are served at http://{host}:{server.server_port}/metrics")
+    return server
@@ -3,58 +3,344 @@
 """
 MAIN PROGRAM
 """
+import time
+started_at = time.perf_counter()  # to measure cold start, before all other imports
+
+import argparse
+import asyncio
 import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
-from apscheduler.schedulers.blocking import BlockingScheduler
-from blockchain.events import last_block, fetch_logs, decode_log
-from bot.bot import send_report
-from bot.report import prepare_report_data, create_report_message
-from db.database import get_session, store_event, get_events, create_db_and_tables
+from apscheduler.schedulers.asyncio import AsyncIOScheduler
+from blockchain.events import last_block, fetch_logs, decode_logs, save_rpc_caches, follow_heads, get_block_hash
+from bot.delivery import queue_report, deliver_messages
+from bot.bot import get_bot
+from bot.report import get_report, report_cache
+from db.database import create_db_and_tables, get_sync_cursor, rebuild_rollups
+from db.database import store_scan_results, drop_pending_events, PENDING_CURSOR, DatabaseUnavailable
+from db.models import TotalDistributionEvent
+from db.spool import Spool, SpoolFlusher, flush_spool, SCAN, DROP_PENDING
+from db.coordination import get_coordinator, REPORT_ROLE, INGESTION_ROLE
 from settings import blockchain_events_trigger, telegram_report_trigger
+from settings import CONFIRMATION_BLOCKS, INITIAL_SCAN_BLOCKS, BACKFILL_FROM_BLOCK, STARTUP_TIME_BUDGET, JOB_TIMEOUTS
+from metrics import metrics, start_metrics_server
+from settings import TELEGRAM_RETRY_INTERVAL, METRICS_PORT, METRICS_HOST, SPOOL_DIR, COORDINATION
 
 # initialising and configuring logger to use in multiply project modules
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-# Setting up schedule
-schedule = BlockingScheduler()
+# Setting up schedule; jobs are coroutines, blocking work is done in the jobs threads
+schedule = AsyncIOScheduler()
+
+# Each job has its own thread, so a slow RPC provider never blocks building or delivering reports
+executors = {job: ThreadPoolExecutor(max_workers=1, thread_name_prefix=job) for job in JOB_TIMEOUTS}
+running_jobs = {}  # job name: future of its last run
+delivery_tasks = set()  # keeps references to running delivery tasks
+
+# Scan results are spooled on disk and stored into db by the flusher thread, see db/spool.py
+spool = None
+spool_lock = threading.Lock()
+
+
+def log_startup_time(stage):
+    """ Logs seconds passed since the program start, warns if cold start is slower than STARTUP_TIME_BUDGET """
+    startup_time = time.perf_counter() - started_at
+    if startup_time > STARTUP_TIME_BUDGET:
+        logger.warning(f"Startup: {stage} in {startup_time:.3f}s, over {STARTUP_TIME_BUDGET}s budget")
+    else:
+        logger.info(f"Startup: {stage} in {startup_time:.3f}s")
+
+
+def is_leader(role):
+    """ Checks if this instance has the role: with COORDINATION replicas elect one instance for each role,
+    a single instance has all of them """
+    return not COORDINATION or get_coordinator().holds(role)
+
+
+def get_spool():
+    """ Returns scan results spool in SPOOL_DIR, opening it on the first call; None if spooling is off """
+    global spool
+    with spool_lock:
+        if spool is None and SPOOL_DIR:
+            spool = Spool(SPOOL_DIR)
+        return spool
+
+
+def get_cursor(name=TotalDistributionEvent.__tablename__, with_hash=False):
+    """ Sync cursor as the spooled scans move it; the spool keeps cursors of the stored records too, so db is read
+    only while the spool has stored nothing yet
+
+    :return int: last processed block number or None; (block number, block hash) tuple if with_hash.
+        Raises DatabaseUnavailable if the cursor is read from db and db is down """
+    spooled_cursors = get_spool().cursors() if get_spool() else {}
+    if name not in spooled_cursors:
+        return get_sync_cursor(name, with_hash=with_hash)
+    return spooled_cursors[name] if with_hash else spooled_cursors[name][0]
+
 
+def drop_pending():
+    """ Drops pending events after chain reorganization, through the spool to keep the order with spooled scans
 
-def get_and_process_blockchain_logs():
+    :return bool: True if dropped (or spooled), False on db error """
+    if get_spool():
+        get_spool().append({'type': DROP_PENDING})
+        return True
+    return drop_pending_events()
+
+
+def get_blocks_to_scan(current_block):
+    """ Block range not processed yet: from the block after sync cursor up to the confirmed (reorg-safe) block.
+    On the first start, when there is no sync cursor yet, makes one-shot backfill range.
+
+    :param current_block: blockchain head block num
+    :return tuple: start_block, end_block; start_block > end_block if there are no new confirmed blocks """
+    end_block = current_block - CONFIRMATION_BLOCKS
+    cursor = get_cursor()
+    if cursor is not None:
+        return cursor + 1, end_block
+    if BACKFILL_FROM_BLOCK is not None:
+        return BACKFILL_FROM_BLOCK, end_block
+    return end_block - INITIAL_SCAN_BLOCKS, end_block
+
+
+def get_scan_start_block(start_block):
+    """ First block to scan: the block after the last scanned one if it's still in chain (its events are in the pending
+    buffer already), otherwise, after chain reorganization, pending events are dropped and scan starts again
+    from the block after the confirmed one.
+
+    :param start_block: block after the last confirmed one
+    :return int: block num, None on db error """
+    scanned_block, scanned_block_hash = get_cursor(PENDING_CURSOR, with_hash=True)
+    if scanned_block is None or scanned_block < start_block:
+        return start_block
+    try:
+        if get_block_hash(scanned_block) == scanned_block_hash:
+            return scanned_block + 1
+    except Exception as e:
+        logger.error(f"Failed to check block {scanned_block} hash: {e}")  # rescanning a few blocks is safe anyway
+    logger.warning(f"Block {scanned_block} was replaced by chain reorganization, scanning again from {start_block}")
+    return start_block if drop_pending() else None
+
+
+@metrics.timed("ingestion")
+def get_and_process_blockchain_logs(current_block=None):
     """ Main blockchain worker;
-    Used to fetch from blockchain, decode and process logs, then store as events """
-    current_block = last_block()
-    start_block = current_block - 7200  # ~24h. 1 block each 12 seconds, 5 blocks a minute, 24h * 60m * 5 blocks = 7200
+    Used to fetch from blockchain, decode and process logs, then store as events.
+
+    Blocks are scanned up to the head. Events from blocks CONFIRMATION_BLOCKS deep are stored at once, events from
+    newer blocks wait in the pending buffer until their blocks are deep enough, or are dropped if chain is reorganized.
+    Sync cursors move forward only if every log in the range was decoded and stored, otherwise the range is
+    scanned again on the next run (already stored events are skipped).
+    With SPOOL_DIR scan results are appended to the spool and stored into db by the flusher thread
+
+    :param current_block: blockchain head block num, if it's already known """
+    head_block = last_block() if current_block is None else current_block
+    try:
+        start_block, confirmed_block = get_blocks_to_scan(head_block)
+        confirmed_block = max(confirmed_block, start_block - 1)  # head can move back a bit, confirmed cursor can't
+        start_block = get_scan_start_block(start_block)
+    except DatabaseUnavailable as e:
+        # unknown cursor is not the first start: scanning from INITIAL_SCAN_BLOCKS back would skip blocks
+        logger.error(f"{e}, blocks scan is postponed")
+        return
+    if start_block is None:
+        return
+    if start_block > head_block:
+        logger.info(f"No new blocks, last scanned block {start_block - 1}")
+        return
+
+    # head hash is taken before logs, so if head is replaced while logs are fetched, it's detected on the next run
+    try:
+        head_block_hash = get_block_hash(head_block)
+    except Exception as e:
+        logger.error(f"Failed to get block {head_block} hash: {e}")
+        return
 
     # getting smart contract's logs with TotalDistribution event
-    logs = fetch_logs(start_block, current_block)
+    logs = fetch_logs(start_block, head_block)
+    if logs is None:
+        return
+    logs = [log for log in logs if not log.get('removed')]  # log from orphaned block, if provider reports it
 
     # decoding and processing logs
-    for log in logs:
-        event_data = decode_log(log)
+    events = decode_logs(logs)
+    save_rpc_caches()
+    if None in events:
+        return
 
-        # saving them as TotalDistribution objects to db
-        if event_data:
-            with get_session() as session:
-                store_event(event_data, session)
+    # saving them as TotalDistribution objects to db, or keeping in the pending buffer if blocks aren't confirmed yet
+    confirmed_events = [event_data for event_data in events if event_data['block'] <= confirmed_block]
+    pending_events = [event_data for event_data in events if event_data['block'] > confirmed_block]
+    if get_spool():
+        # stored into db by the flusher, next runs go on from the spooled cursors even if db is down
+        get_spool().append({'type': SCAN, 'confirmed_events': confirmed_events, 'pending_events': pending_events,
+                            'confirmed_block': confirmed_block, 'scanned_block': head_block,
+                            'scanned_block_hash': head_block_hash})
+        logger.info(f"Processed blocks {start_block}-{head_block}, {len(events)} events spooled")
+        return
+    stored_count = store_scan_results(confirmed_events, pending_events, confirmed_block, head_block, head_block_hash)
+    if stored_count:
+        report_cache.invalidate()
+    if stored_count is not None:
+        logger.info(f"Processed blocks {start_block}-{head_block}, {len(events)} events, {stored_count} new confirmed")
 
 
-def generate_and_send_report(hours=24):
-    """ Getting TotalDistributionEvents from db in time range and process them to create report message """
-    report_events = get_events(hours=hours)
-    report_data = prepare_report_data(report_events)
-    report_message = create_report_message(report_data)
-    send_report(report_message)
+def stream_blockchain_logs():
+    """ Streaming blockchain worker, used instead of scheduled get_and_process_blockchain_logs();
+    Processes newly confirmed blocks each time blockchain head moves, so events are stored within a block time
+    and each run is just a few blocks """
+    for head in follow_heads():
+        if not is_leader(INGESTION_ROLE):
+            continue
+        try:
+            get_and_process_blockchain_logs(head)
+        except Exception as e:
+            logger.error(f"Failed to process blocks up to head {head}: {e}")
 
 
-if __name__ == "__main__":
-    # At startup checks DB, fetches new logs with TotalDistribution event, create and send report
+@metrics.timed("build_report")
+def build_report(hours=24):
+    """ Getting TotalDistributionEvents summary from db in time range and process it to create report message,
+    or takes it from the reports cache shared with bot commands """
+    report_message = get_report(hours)
+    logger.info(f"Reports cache: {report_cache.stats()}")
+    return report_message
+
+
+def build_and_queue_report(hours=24) -> bool:
+    """ Creates report message and puts it into the outbox, delivery sends it
+
+    :return bool: True if queued, False if there is no report or on db error """
+    report_message = build_report(hours)
+    return bool(report_message) and queue_report(report_message)
+
+
+def poll_commands():
+    """ Answers bot commands (/stats, /wallets) from the reports cache while this instance has report role:
+    Telegram gives updates to a single poller """
+    while True:
+        if not is_leader(REPORT_ROLE):
+            time.sleep(1)
+            continue
+        try:
+            get_bot().polling(non_stop=True)  # returns when report role is lost, see on_report_role_change()
+        except Exception as e:
+            logger.error(f"Bot commands polling failed: {e}")
+            time.sleep(3)
+
+
+def on_report_role_change(held):
+    """ Stops answering bot commands when another instance took report role """
+    if not held:
+        get_bot().stop_polling()
+
+
+async def run_job(job, func, *args):
+    """ Runs blocking func in the job's own thread with JOB_TIMEOUTS[job] seconds timeout.
+
+    Python threads can't be killed, so on timeout or cancellation the run is abandoned, not stopped: its result is
+    ignored, and new runs of the job are skipped until it finishes, so runs never overlap or pile up.
+
+    :param job: job name, key of JOB_TIMEOUTS
+    :return: func result, None if run was skipped, timed out or failed """
+    previous_run = running_jobs.get(job)
+    if previous_run is not None and not previous_run.done():
+        logger.warning(f"Job {job} is still running, skipping this run")
+        return None
+    running_jobs[job] = run = executors[job].submit(func, *args)
+    metrics_snapshot = metrics.snapshot()
+    try:
+        return await asyncio.wait_for(asyncio.wrap_future(run), JOB_TIMEOUTS[job])
+    except asyncio.TimeoutError:
+        metrics.inc("job_timeouts_total", job=job)
+        logger.error(f"Job {job} timed out after {JOB_TIMEOUTS[job]}s")
+    except Exception as e:
+        metrics.inc("job_errors_total", job=job)
+        logger.error(f"Job {job} failed: {e}")
+    finally:
+        # jobs run in parallel, so the summary can include a bit of other jobs work
+        logger.info(f"Job {job} summary: {metrics.summary(metrics_snapshot)}")
+    return None
+
+
+async def ingestion_job():
+    """ Scheduled get_and_process_blockchain_logs(), by the instance with ingestion role """
+    if not is_leader(INGESTION_ROLE):
+        logger.info("Blocks are ingested by another instance")
+        return
+    await run_job("ingestion", get_and_process_blockchain_logs)
+
+
+async def report_job(hours=24):
+    """ Scheduled report: builds it, queues into the outbox and hands over to a separate delivery task, so slow
+    Telegram doesn't hold the report job and a slow report doesn't hold delivery of the previous one. Report is
+    queued by the report job itself: if a delivery run is still going, this one is skipped, and the queued report
+    is sent by the running one or by the next delivery_job. Only the instance with report role sends reports,
+    so replicas don't send duplicates """
+    if not is_leader(REPORT_ROLE):
+        logger.info("Reports are sent by another instance")
+        return
+    if await run_job("report", build_and_queue_report, hours):
+        delivery_task = asyncio.create_task(run_job("delivery", deliver_messages))
+        delivery_tasks.add(delivery_task)
+        delivery_task.add_done_callback(delivery_tasks.discard)
+
+
+async def delivery_job():
+    """ Scheduled retry of Telegram messages which were not sent yet """
+    if not is_leader(REPORT_ROLE):
+        return
+    await run_job("delivery", deliver_messages)
+
+
+async def main(stream=False):
+    """ At startup checks DB, fetches new logs with TotalDistribution event, create and send report,
+    after that follows schedule from settings.py """
+    if METRICS_PORT:
+        start_metrics_server(METRICS_PORT, METRICS_HOST)
     create_db_and_tables()  # db/database init db if needed
-    get_and_process_blockchain_logs()  # (blockchain/events) looks is there new TotalDistribution Event Logs
-    generate_and_send_report()  # (bot/report) creates and send report to Telegram group
+    log_startup_time("db ready")
+    if COORDINATION:
+        # roles are taken before the first jobs, the heartbeat renews them or takes them over later
+        get_coordinator().elect(INGESTION_ROLE)
+        get_coordinator().elect(REPORT_ROLE, on_change=on_report_role_change)
+        get_coordinator().start()
+    await ingestion_job()  # (blockchain/events) looks is there new TotalDistribution Event Logs
+    if get_spool():
+        flush_spool(get_spool())  # the first report includes spooled events, then the flusher takes over
+        SpoolFlusher(get_spool(), on_stored=lambda stored_count: report_cache.invalidate()).start()
+    await report_job()  # (bot/report) creates and send report to Telegram group
 
-    # After that script uses schedule from settings.py
     # task was to send reports every 4 hours, but in demonstration porpoise that was changed to a once an hour
-    schedule.add_job(get_and_process_blockchain_logs, trigger=blockchain_events_trigger, misfire_grace_time=1000)
-    schedule.add_job(generate_and_send_report, trigger=telegram_report_trigger, misfire_grace_time=1000)
+    if stream:
+        threading.Thread(target=stream_blockchain_logs, name="stream", daemon=True).start()
+    else:
+        schedule.add_job(ingestion_job, trigger=blockchain_events_trigger, max_instances=1, coalesce=True,
+                         misfire_grace_time=1000)
+    schedule.add_job(report_job, trigger=telegram_report_trigger, max_instances=1, coalesce=True,
+                     misfire_grace_time=1000)
+    schedule.add_job(delivery_job, trigger="interval", seconds=TELEGRAM_RETRY_INTERVAL, max_instances=1,
+                     coalesce=True)
     schedule.start()
+    # bot commands (/stats, /wallets) are answered from the reports cache in their own thread
+    threading.Thread(target=poll_commands, name="commands", daemon=True).start()
+    await asyncio.Event().wait()  # run forever
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="TotalDistributionBot")
+    parser.add_argument("--rebuild-rollups", action="store_true",
+                        help="recompute hourly and daily rollups from stored events and exit")
+    parser.add_argument("--stream", action="store_true",
+                        help="process new blocks as soon as they appear instead of on blockchain_events_trigger")
+    args = parser.parse_args()
+    log_startup_time("modules imported")
+
+    if args.rebuild_rollups:
+        create_db_and_tables()
+        rebuild_rollups()
+        raise SystemExit
+
+    asyncio.run(main(stream=args.stream))
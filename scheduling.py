@@ -0,0 +1,94 @@
+# -*- coding: utf-8 -*-
+"""
+SCHEDULE SPECS
+
+Schedules are written as short specs instead of long lists of CronTriggers:
+
+    "every 30m at :28/:58"  -- at 28 and 58 minutes of every hour
+    "every 4h"              -- at 0:00, 4:00, 8:00, ...
+    "every 2h at 1:30"      -- at 1:30, 3:30, 5:30, ...
+    "every 1h at :00"       -- at the start of every hour
+
+Times after "at" are separated by "/", ":MM" is a minute of the hour and "H:MM" is a time of day. The job runs
+at each of them and every period before and after, so ":28/:58" and ":28" mean the same for "every 30m".
+Without "at" the job runs at the start of each period. Periods must divide an hour (m) or a day (h),
+so the schedule is the same every day.
+
+parse_schedule() -- parses spec into sorted list of times of day (seconds since midnight)
+compile_schedule() -- builds single CronTrigger for spec
+check_schedules_overlap() -- raises ValueError if a report may start while ingestion is still running
+"""
+import re
+from itertools import product
+
+from apscheduler.triggers.cron import CronTrigger
+
+
+DAY = 24 * 60 * 60
+UNITS = {'m': 60, 'h': 60 * 60}
+SPEC_RE = re.compile(r"^every\s+(\d+)\s*([mh])(?:\s+at\s+(\S+))?$")
+OFFSET_RE = re.compile(r"^(\d*):(\d{2})$")
+
+
+def parse_schedule(spec: str) -> list[int]:
+    """ Parses schedule spec
+
+    :param spec: schedule spec, e.g. "every 30m at :28/:58"
+    :return: sorted times of day in seconds since midnight when the job runs
+    :raises ValueError: if spec is malformed """
+    match = SPEC_RE.match(spec.strip().lower())
+    if not match:
+        raise ValueError(f"Bad schedule {spec!r}, expected e.g. 'every 30m at :28/:58' or 'every 4h'")
+    count, unit, offsets = match.groups()
+    period = int(count) * UNITS[unit]
+    if not period or (unit == 'm' and 60 * 60 % period) or DAY % period:
+        raise ValueError(f"Bad schedule {spec!r}: period must divide {'an hour' if unit == 'm' else 'a day'}")
+
+    offset_seconds = set()
+    for offset in (offsets.split("/") if offsets else [":00"]):
+        offset_match = OFFSET_RE.match(offset)
+        if not offset_match:
+            raise ValueError(f"Bad schedule {spec!r}: time {offset!r} must look like ':MM' or 'H:MM'")
+        hours, minutes = int(offset_match.group(1) or 0), int(offset_match.group(2))
+        if hours >= 24 or minutes >= 60:
+            raise ValueError(f"Bad schedule {spec!r}: time {offset!r} is out of a day")
+        offset_seconds.add((hours * 60 * 60 + minutes * 60) % period)
+
+    return sorted(start + offset for start in range(0, DAY, period) for offset in offset_seconds)
+
+
+def compile_schedule(spec: str, jitter: int = 0, timezone=None) -> CronTrigger:
+    """ Compiles schedule spec into a single CronTrigger
+
+    :param spec: schedule spec, e.g. "every 4h"
+    :param jitter: job starts up to jitter seconds later, so several bots don't hit the provider at the same second
+    :param timezone: trigger time zone, server's time zone by default
+    :raises ValueError: if spec is malformed or can't be expressed as a single cron (e.g. "every 4h at 0:30/1:15") """
+    times = parse_schedule(spec)
+    hours = sorted({time // 3600 for time in times})
+    minutes = sorted({time % 3600 // 60 for time in times})
+    if set(times) != {hour * 3600 + minute * 60 for hour, minute in product(hours, minutes)}:
+        raise ValueError(f"Bad schedule {spec!r}: all times must have the same minutes")
+    return CronTrigger(hour="*" if len(hours) == 24 else ",".join(map(str, hours)),
+                       minute=",".join(map(str, minutes)), jitter=jitter or None, timezone=timezone)
+
+
+def check_schedules_overlap(ingest_spec: str, report_spec: str, ingest_duration: int,
+                            ingest_jitter: int = 0, report_jitter: int = 0):
+    """ Makes sure reports are not built from half-ingested data.
+
+    Ingestion is expected to take up to ingest_duration seconds after its (jittered) start,
+    a report must not start (with its jitter) during that window.
+
+    :raises ValueError: naming the first conflicting ingestion and report times """
+    ingest_window = ingest_jitter + ingest_duration
+    for ingest_time, report_time in product(parse_schedule(ingest_spec), parse_schedule(report_spec)):
+        # report window [report_time, report_time + report_jitter] against ingestion window, both wrap at midnight
+        if (report_time - ingest_time) % DAY <= ingest_window or (ingest_time - report_time) % DAY <= report_jitter:
+            raise ValueError(f"Report at {format_time(report_time)} ({report_spec!r}) overlaps ingestion "
+                             f"at {format_time(ingest_time)} ({ingest_spec!r}) running up to {ingest_window}s")
+
+
+def format_time(seconds: int) -> str:
+    """ Seconds since midnight as HH:MM """
+    return f"{seconds // 3600:02d}:{seconds % 3600 // 60:02d}"
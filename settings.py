@@ -1,6 +1,9 @@
 # -*- coding: utf-8 -*-
-from apscheduler.triggers.combining import OrTrigger
-from apscheduler.triggers.cron import CronTrigger
+import json
+import os
+import socket
+
+from scheduling import compile_schedule, check_schedules_overlap
 """
 SETTINGS
 
@@ -26,16 +29,83 @@ In the config file:
 # WEB3 Provider
 INFURA_KEY = "...."  # "YOUR-KEY"  # You can get one free KEY at https://www.infura.io
 WEB3_PROVIDER_URL = f'https://mainnet.infura.io/v3/{INFURA_KEY}'
+# More endpoints (other providers or keys) for failover, requests go to the fastest healthy one; environment
+# variable format: WEB3_PROVIDER_URLS="https://mainnet.infura.io/v3/KEY,https://eth-mainnet.g.alchemy.com/v2/KEY"
+WEB3_PROVIDER_URLS = os.getenv('WEB3_PROVIDER_URLS', WEB3_PROVIDER_URL).split(",")
+# WebSocket endpoint used by streaming mode (python run.py --stream) to get new blocks as soon as they appear,
+# e.g. f'wss://mainnet.infura.io/ws/v3/{INFURA_KEY}'; None — new blocks are polled each STREAM_POLL_INTERVAL
+WEB3_WS_PROVIDER_URL = None
+STREAM_POLL_INTERVAL = 12  # seconds, 1 block each 12 seconds
 
 
 # Telegram
 TELEGRAM_API_KEY = "..."  # Telegram > @BotFather > Create New Bot
 TELEGRAM_CHAT_ID = -1002027272548  # Add @raw_data_bot to your chat or send to the bot chat's invite link to get id
+# Reports are sent to all these chats; environment variable format: TELEGRAM_CHAT_IDS="-100123,-100456"
+TELEGRAM_CHAT_IDS = [int(chat_id) for chat_id in os.getenv('TELEGRAM_CHAT_IDS', str(TELEGRAM_CHAT_ID)).split(",")]
+# Telegram limits: ~30 messages per second overall, 1 per second to a chat and 20 per minute to a group
+TELEGRAM_GLOBAL_RATE = 30  # messages per second
+TELEGRAM_CHAT_RATE = 1
+TELEGRAM_GROUP_RATE = 20 / 60
+TELEGRAM_MAX_ATTEMPTS = 10  # then message is kept in outbox with 'failed' status
+TELEGRAM_RETRY_BACKOFF = 5  # seconds, doubled after each failed attempt
+TELEGRAM_MAX_RETRY_BACKOFF = 30 * 60
+TELEGRAM_RETRY_INTERVAL = 30  # seconds, how often outbox is checked for messages to resend
+# Rendered reports are cached until new events are stored, but not longer than REPORT_CACHE_TTL
+REPORT_CACHE_TTL = 60  # seconds
+REPORT_MAX_HOURS = 90 * 24  # the longest /stats time window
+WALLETS_REPORT_HOURS = 7 * 24  # /wallets shows distributor wallets seen in this time window
 
 
 # ETH SMART CONTRACT DETAILS
 CONTRACT_ADDRESS = "0xaBE235136562a5C2B02557E1CaE7E8c85F2a5da0"
 TOTAL_DISTRIBUTION_EVENT_SIGNATURE_TEXT = "TotalDistribution(uint256,uint256,uint256,uint256)"
+TOTAL_DISTRIBUTION_EVENT_ABI = {"type": "event", "name": "TotalDistribution", "anonymous": False, "inputs": [
+    {"name": "inputAixAmount", "type": "uint256", "indexed": False},
+    {"name": "distributedAixAmount", "type": "uint256", "indexed": False},
+    {"name": "swappedEthAmount", "type": "uint256", "indexed": False},
+    {"name": "distributedEthAmount", "type": "uint256", "indexed": False}]}
+# Other events fetched by the same logs scan as TotalDistribution (one eth_getLogs request for all addresses and
+# events), each stored in its own table named after the event, e.g. "transfer_events". JSON list in the file:
+# [{"abi": {"type": "event", "name": "Transfer", "inputs": [{"name": "from", "type": "address", "indexed": true},
+#   {"name": "to", "type": "address", "indexed": true}, {"name": "value", "type": "uint256", "indexed": false}]},
+#   "addresses": ["0x..."]}]
+TRACKED_EVENTS_FILE = os.getenv('TRACKED_EVENTS_FILE')
+TRACKED_EVENTS = []
+if TRACKED_EVENTS_FILE:
+    with open(TRACKED_EVENTS_FILE) as tracked_events_file:
+        TRACKED_EVENTS = json.load(tracked_events_file)
+
+
+# BLOCKS SYNC
+# Each run scans only blocks after the last processed one (sync cursor stored in db) up to the head.
+# Blocks closer than CONFIRMATION_BLOCKS to the head still can be replaced by chain reorganization, so their events
+# wait in the pending buffer and get into reports only when blocks are deep enough
+CONFIRMATION_BLOCKS = 12  # reorg-safety window, ~2.5 minutes
+# On the first start (no sync cursor in db yet) a one-shot backfill is made from BACKFILL_FROM_BLOCK,
+# or if it's None, from the last INITIAL_SCAN_BLOCKS blocks
+INITIAL_SCAN_BLOCKS = 7200  # ~24h. 1 block each 12 seconds, 5 blocks a minute, 24h * 60m * 5 blocks = 7200
+BACKFILL_FROM_BLOCK = None  # e.g. smart contract creation block to get the whole history
+
+# Logs are fetched by chunks in parallel, chunk size adapts to the provider limits
+LOGS_CHUNK_SIZE = 2000  # blocks in the first requested chunk
+LOGS_MAX_CHUNK_SIZE = 10000  # chunk size doubles after each successful request up to this value
+LOGS_FETCH_WORKERS = 4  # parallel eth_getLogs requests
+
+# Historical backfill (python backfill.py) splits block range into shards fetched and decoded in worker processes
+BACKFILL_SHARD_SIZE = 50000  # blocks, about a week
+BACKFILL_WORKERS = 4  # processes
+
+# Blocks timestamps and transactions senders are cached to not request them again for each log
+RPC_CACHE_SIZE = 100000  # items in each cache
+RPC_CACHE_DIR = None  # directory to keep caches between restarts, e.g. "cache"; None — in memory only
+RPC_BATCH_SIZE = 100  # JSON-RPC requests in a single batch HTTP request, providers usually limit it by 100-1000
+RPC_TIMEOUT = 30  # seconds
+RPC_POOL_SIZE = 10  # connections kept alive to each endpoint
+PROVIDER_COOLDOWN = 30  # seconds failed endpoint is skipped, doubled with each failure in a row
+PROVIDER_MAX_COOLDOWN = 10 * 60
+PROVIDER_LATENCY_SMOOTHING = 0.2  # weight of the last request in endpoint's average latency
+BALANCE_CACHE_TTL = 60  # seconds, distributor wallets balances are reused by reports made within this time
 
 
 # DATABASE / PostgreSQL SETTINGS
@@ -49,90 +119,72 @@ DB_URL = f"postgresql://{DB_USER}:{DB_PASSWORD}@{DB_HOST}:{DB_PORT}/{DB_NAME}"
 # DB_URL = f"sqlite:///sqlite.db"  # sqlite for dev env
 
 
+# SPOOL
+# Scan results (decoded events and sync cursors) are appended to a local write-ahead spool first and stored into db
+# by a background flusher, so ingestion goes on while db is slow or down and fetched events are never refetched;
+# None — scan results are stored into db directly
+SPOOL_DIR = os.getenv('SPOOL_DIR', "spool") or None  # SPOOL_DIR="" environment variable turns it off
+SPOOL_SEGMENT_SIZE = 16 * 1024 * 1024  # bytes, then the next segment file is started
+SPOOL_FLUSH_INTERVAL = 5  # seconds between flushes, the flusher also wakes up after each spooled scan
+SPOOL_FLUSH_BATCH = 100  # records merged into a single db transaction
+
+# COORDINATION
+# Replicas of run.py share the work through db: one instance sends reports and answers bot commands, one ingests
+# new blocks, and when an instance is gone another one takes its role over. Backfill shards (python backfill.py)
+# are leased out across instances. PostgreSQL advisory locks are used, leases table with other databases (SQLite)
+COORDINATION = bool(os.getenv('COORDINATION'))  # COORDINATION=1 environment variable when running replicas
+INSTANCE_ID = os.getenv('INSTANCE_ID') or f"{socket.gethostname()}-{os.getpid()}"  # lease owner name
+LEASE_TTL = 30  # seconds a role is held without renewal (renewed each LEASE_TTL / 3), then another instance takes it
+BACKFILL_SHARD_LEASE_TTL = 30 * 60  # seconds, shard not stored by then is fetched by another instance
+
+# METRICS
+# Prometheus metrics (stages timings, RPC requests, db rows written, caches hits) are served at
+# http://METRICS_HOST:METRICS_PORT/metrics; None — not served, summaries are still logged after each job
+METRICS_PORT = int(os.getenv('METRICS_PORT')) if os.getenv('METRICS_PORT') else None  # e.g. 9100
+METRICS_HOST = "127.0.0.1"
+
+
+# ANALYTICS
+# Events history stats and columnar export (python -m db.analytics), needs numpy and pyarrow installed
+ANALYTICS_MOVING_AVERAGE_HOURS = 24  # window of hourly distributed AIX moving average
+ANALYTICS_PERCENTILES = (50, 90, 99)  # of distribution size
+ANALYTICS_EXPORT_BATCH_SIZE = 50000  # rows read from db and written to file at once
+
+
+# STARTUP
+# Web3 provider, Telegram bot and db engine are created on the first use, so start is fast.
+# Time from start to ready db is logged, with a warning if it's over the budget
+STARTUP_TIME_BUDGET = 3  # seconds
+
+
+# JOBS
+# Ingestion, report building and Telegram delivery run independently, each in its own thread, with timeouts
+JOB_TIMEOUTS = {
+    'ingestion': 20 * 60,  # seconds
+    'report': 5 * 60,
+    'delivery': 2 * 60,
+}
+
+
 # SCHEDULE
 # The schedule can be adjusted to more human-friendly times, such as the start and end of the workday.
 # Note: The schedule uses the server's time zone (e.g., Europe/Moscow in this case).
+# Specs look like "every 30m at :28/:58" or "every 4h" (see scheduling.py), each environment can override them
+# with INGEST_SCHEDULE / REPORT_SCHEDULE environment variables.
 
 # run.get_and_process_blockchain_logs() retrieves new TotalDistribution events from smart contract logs, stores into db
 # once a half hour
-blockchain_events_trigger = OrTrigger(
-    [CronTrigger(hour=0, minute=28),
-     CronTrigger(hour=0, minute=58),
-     CronTrigger(hour=1, minute=28),
-     CronTrigger(hour=1, minute=58),
-     CronTrigger(hour=2, minute=28),
-     CronTrigger(hour=2, minute=58),
-     CronTrigger(hour=3, minute=28),
-     CronTrigger(hour=3, minute=58),
-     CronTrigger(hour=4, minute=28),
-     CronTrigger(hour=4, minute=58),
-     CronTrigger(hour=5, minute=28),
-     CronTrigger(hour=5, minute=58),
-     CronTrigger(hour=6, minute=28),
-     CronTrigger(hour=6, minute=58),
-     CronTrigger(hour=6, minute=5),  # todo remove
-     CronTrigger(hour=6, minute=7),  # todo remove
-     CronTrigger(hour=7, minute=28),
-     CronTrigger(hour=7, minute=58),
-     CronTrigger(hour=8, minute=28),
-     CronTrigger(hour=8, minute=58),
-     CronTrigger(hour=9, minute=28),
-     CronTrigger(hour=9, minute=58),
-     CronTrigger(hour=10, minute=28),
-     CronTrigger(hour=10, minute=58),
-     CronTrigger(hour=11, minute=28),
-     CronTrigger(hour=11, minute=58),
-     CronTrigger(hour=12, minute=28),
-     CronTrigger(hour=12, minute=58),
-     CronTrigger(hour=13, minute=28),
-     CronTrigger(hour=13, minute=58),
-     CronTrigger(hour=14, minute=28),
-     CronTrigger(hour=14, minute=58),
-     CronTrigger(hour=15, minute=28),
-     CronTrigger(hour=15, minute=58),
-     CronTrigger(hour=16, minute=28),
-     CronTrigger(hour=16, minute=58),
-     CronTrigger(hour=17, minute=28),
-     CronTrigger(hour=17, minute=58),
-     CronTrigger(hour=18, minute=28),
-     CronTrigger(hour=18, minute=58),
-     CronTrigger(hour=19, minute=28),
-     CronTrigger(hour=19, minute=58),
-     CronTrigger(hour=20, minute=28),
-     CronTrigger(hour=20, minute=58),
-     CronTrigger(hour=21, minute=28),
-     CronTrigger(hour=21, minute=58),
-     CronTrigger(hour=22, minute=28),
-     CronTrigger(hour=22, minute=58),
-     CronTrigger(hour=23, minute=28),
-     CronTrigger(hour=23, minute=58)])
-
-# run.generate_and_send_report() function creates from db data reports and send them to the (TELEGRAM_CHAT_ID) chat
-# once an hour
-telegram_report_trigger = OrTrigger(
-    [CronTrigger(hour=0),
-     CronTrigger(hour=1),
-     CronTrigger(hour=2),
-     CronTrigger(hour=3),
-     CronTrigger(hour=4),
-     CronTrigger(hour=5),
-     CronTrigger(hour=6),
-     CronTrigger(hour=6, minute=6),  # todo remove
-     CronTrigger(hour=6, minute=8),  # todo remove
-     CronTrigger(hour=7),
-     CronTrigger(hour=8),
-     CronTrigger(hour=9),
-     CronTrigger(hour=10),
-     CronTrigger(hour=11),
-     CronTrigger(hour=12),
-     CronTrigger(hour=13),
-     CronTrigger(hour=14),
-     CronTrigger(hour=15),
-     CronTrigger(hour=16),
-     CronTrigger(hour=17),
-     CronTrigger(hour=18),
-     CronTrigger(hour=19),
-     CronTrigger(hour=20),
-     CronTrigger(hour=21),
-     CronTrigger(hour=22),
-     CronTrigger(hour=23)])
+INGEST_SCHEDULE = os.getenv('INGEST_SCHEDULE', "every 30m at :28/:58")
+INGEST_JITTER = int(os.getenv('INGEST_JITTER', 30))  # seconds, so bots sharing a provider don't call it at once
+INGEST_DURATION = int(os.getenv('INGEST_DURATION', 60))  # seconds, expected ingestion time, reports must wait for it
+
+# run.report_job() creates report with build_and_queue_report() and puts it into the outbox, delivery sends it to
+# Telegram groups
+# task was to send reports every 4 hours, but in demonstration porpoise that was changed to a once an hour
+REPORT_SCHEDULE = os.getenv('REPORT_SCHEDULE', "every 1h")
+REPORT_JITTER = int(os.getenv('REPORT_JITTER', 0))
+
+# 1-3 minutes delay between retrieving new events and sending the reports is far enough to process new data
+check_schedules_overlap(INGEST_SCHEDULE, REPORT_SCHEDULE, INGEST_DURATION, INGEST_JITTER, REPORT_JITTER)
+blockchain_events_trigger = compile_schedule(INGEST_SCHEDULE, jitter=INGEST_JITTER)
+telegram_report_trigger = compile_schedule(REPORT_SCHEDULE, jitter=REPORT_JITTER)
@@ -0,0 +1,5 @@
+import os
+
+# Tests never spool scan results into ./spool of the working directory (settings.SPOOL_DIR is read at import,
+# benchmark subprocesses inherit the environment); tests of the spool open it in a temp dir, see test_run.py
+os.environ['SPOOL_DIR'] = ""
@@ -0,0 +1,100 @@
+import datetime
+from decimal import Decimal
+import pytest
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+from db.database import AMOUNT_COLUMNS, store_events, get_events, get_events_summary
+from db.models import Base
+
+np = pytest.importorskip("numpy")
+from db.analytics import EventColumns, load_event_columns, compute_stats, export_events  # noqa: E402
+
+WEI = 10 ** 18
+
+
+@pytest.fixture
+def history_session():
+    """ Session of a db with an event each 30 minutes for the last 5 days, amounts bigger than int64
+    (but exact in float, as SQLite stores DECIMAL as float) """
+    engine = create_engine("sqlite:///:memory:")
+    Base.metadata.create_all(engine)
+    session = sessionmaker(bind=engine)()
+    now = datetime.datetime.utcnow()
+    store_events([{
+        "block": event_num,
+        "block_hash": f"block_hash_{event_num}",
+        "tx_hash": f"tx_{event_num}",
+        "log_index": 0,
+        "timestamp": now - datetime.timedelta(minutes=30 * event_num + 1),
+        "distributor_wallet": f"wallet_{event_num % 3}",
+        "input_aix_amount": (event_num + 1) * 1000 * WEI,
+        "distributed_aix_amount": (event_num + 1) * 900 * WEI,
+        "swapped_eth_amount": (event_num + 1) * WEI // 2,
+        "distributed_eth_amount": (event_num + 1) * WEI // 3,
+    } for event_num in range(240)], db_session=session)
+    return session
+
+
+def test_stats_match_db_summary(history_session):
+    columns = load_event_columns(hours=24 * 3, db_session=history_session)
+    stats = compute_stats(columns, moving_average_hours=4, percentiles=(50, 90))
+    summary = get_events_summary(hours=24 * 3, db_session=history_session)
+
+    assert stats['events_count'] == summary['events_count'] == 144
+    assert stats['totals']['input_aix_amount'] == sum(int(event.input_aix_amount)
+                                                      for event in get_events(24 * 3, db_session=history_session))
+    assert sum(wallet['events_count'] for wallet in stats['wallets'].values()) == 144
+    assert sum(wallet['distributed_eth_amount'] for wallet in stats['wallets'].values()) == \
+        stats['totals']['distributed_eth_amount']
+    assert float(stats['totals']['distributed_eth_amount']) == pytest.approx(float(summary['distributed_eth_amount']))
+    assert stats['distribution_size']['max'] == 144 * 900.0
+    assert stats['distribution_size']['p50'] == pytest.approx(np.percentile(np.arange(1, 145) * 900.0, 50))
+    assert stats['swap_rate']['average'] == pytest.approx(0.0005)
+
+
+def test_totals_are_exact():
+    amounts = np.array([10 ** 30 + 1, 10 ** 30 + 2, 3], dtype=object)
+    columns = EventColumns(timestamps=np.array(['2024-01-01T00:10', '2024-01-01T02:00', '2024-01-01T02:30'],
+                                               dtype='datetime64[s]'),
+                           wallets=np.array([0, 1, 0]), wallet_names=np.array(["wallet_0", "wallet_1"]),
+                           amounts={column: amounts for column in AMOUNT_COLUMNS})
+
+    stats = compute_stats(columns)
+
+    assert stats['totals']['input_aix_amount'] == 2 * 10 ** 30 + 6
+    assert stats['wallets']['wallet_0']['distributed_aix_amount'] == 10 ** 30 + 4
+    assert stats['hourly']['events_count'] == [1, 0, 2]
+
+
+def test_hourly_series(history_session):
+    stats = compute_stats(load_event_columns(hours=10, db_session=history_session), moving_average_hours=4)
+    hourly = stats['hourly']
+
+    assert len(hourly['hours']) == len(hourly['distributed_aix']) == len(hourly['distributed_aix_moving_average'])
+    assert sum(hourly['events_count']) == stats['events_count'] == 20
+    assert hourly['distributed_aix_moving_average'][:3] == [None] * 3
+    assert hourly['distributed_aix_moving_average'][3] == pytest.approx(sum(hourly['distributed_aix'][:4]) / 4)
+    # the older the event, the bigger the amounts in the fixture
+    assert hourly['distributed_aix'][0] > hourly['distributed_aix'][-1]
+
+
+def test_no_events(history_session):
+    assert compute_stats(load_event_columns(hours=0, db_session=history_session)) is None
+
+
+@pytest.mark.parametrize("file_name", ["events.parquet", "events.arrow"])
+def test_export_events(history_session, tmp_path, file_name):
+    pyarrow = pytest.importorskip("pyarrow")
+    import pyarrow.parquet
+
+    assert export_events(tmp_path / file_name, hours=24, batch_size=10, db_session=history_session) == 48
+
+    if file_name.endswith(".parquet"):
+        table = pyarrow.parquet.read_table(tmp_path / file_name)
+    else:
+        table = pyarrow.ipc.open_file(tmp_path / file_name).read_all()
+    assert table.num_rows == 48
+    assert table.column('input_aix_amount')[0].as_py() == Decimal(48 * 1000 * WEI)
+    assert table.column('tx_hash')[-1].as_py() == "tx_0"
+    with pytest.raises(ValueError):
+        export_events(tmp_path / "events.csv", db_session=history_session)
@@ -0,0 +1,72 @@
+import datetime
+import pytest
+from sqlalchemy import create_engine
+from sqlalchemy.pool import StaticPool
+import backfill
+from db.models import Base, TotalDistributionEvent, BackfillShard
+from db.database import get_session, acquire_lease, release_lease
+
+
+@pytest.fixture
+def fake_chain(monkeypatch):
+    """ In-memory db and a fake chain with an event each 10 blocks """
+    engine = create_engine("sqlite://", connect_args={"check_same_thread": False}, poolclass=StaticPool)
+    Base.metadata.create_all(engine)
+    monkeypatch.setattr("db.database.engine", engine)
+
+    chain = {'failing_blocks': set(), 'fetched': []}
+
+    def fetch_logs(start_block, end_block):
+        chain['fetched'].append((start_block, end_block))
+        if chain['failing_blocks'] & set(range(start_block, end_block + 1)):
+            return None
+        return [{"block": block, "block_hash": f"a{block}", "tx_hash": f"tx{block}", "log_index": 0,
+                 "timestamp": datetime.datetime(2024, 1, 1) + datetime.timedelta(seconds=12 * block),
+                 "distributor_wallet": "wallet", "input_aix_amount": 1, "distributed_aix_amount": 1,
+                 "swapped_eth_amount": 1, "distributed_eth_amount": 1}
+                for block in range(start_block, end_block + 1) if block % 10 == 0]
+
+    monkeypatch.setattr(backfill, "fetch_logs", fetch_logs)
+    monkeypatch.setattr(backfill, "decode_logs", lambda logs: [dict(log) for log in logs])
+    return chain
+
+
+@pytest.mark.parametrize("start_block, end_block, shards", [
+    (150, 420, [(150, 199), (200, 299), (300, 399), (400, 420)]),
+    (200, 299, [(200, 299)]),
+    (10, 5, []),
+])
+def test_plan_shards(start_block, end_block, shards):
+    assert backfill.plan_shards(start_block, end_block, shard_size=100) == shards
+
+
+def test_backfill_resumes_failed_shards(fake_chain):
+    fake_chain['failing_blocks'] = {250}
+    assert not backfill.backfill(150, 420, workers=0, shard_size=100)
+
+    with get_session() as session:
+        assert session.query(TotalDistributionEvent).count() == 5 + 10 + 3
+        assert session.query(BackfillShard).filter_by(status="done").count() == 3
+
+    # the next run fetches only the failed shard
+    fake_chain['failing_blocks'] = set()
+    fake_chain['fetched'] = []
+    assert backfill.backfill(150, 420, workers=0, shard_size=100)
+    assert fake_chain['fetched'] == [(200, 299)]
+
+    with get_session() as session:
+        assert session.query(TotalDistributionEvent).count() == 28
+        assert session.get(BackfillShard, (200, 299)).events_count == 10
+
+
+def test_backfill_skips_shards_leased_by_other_instance(fake_chain, monkeypatch):
+    monkeypatch.setattr("db.coordination.coordinator", None)
+    assert acquire_lease(backfill.shard_lease_name((200, 299)), "other instance", ttl=60)
+    assert backfill.backfill(150, 420, workers=0, shard_size=100)
+    assert fake_chain['fetched'] == [(150, 199), (300, 399), (400, 420)]
+
+    # the other instance stopped without storing the shard, the next run takes it
+    assert release_lease(backfill.shard_lease_name((200, 299)), "other instance")
+    fake_chain['fetched'] = []
+    assert backfill.backfill(150, 420, workers=0, shard_size=100)
+    assert fake_chain['fetched'] == [(200, 299)]
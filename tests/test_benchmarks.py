@@ -0,0 +1,37 @@
+import json
+import subprocess
+import sys
+from pathlib import Path
+from benchmarks.chain import SyntheticChain, LOGS_LIMIT
+
+
+def test_synthetic_chain_logs():
+    chain = SyntheticChain(years=0.01, events_per_day=20, seed=3)
+    assert chain.events == SyntheticChain(years=0.01, events_per_day=20, seed=3).events
+    logs = chain.call('eth_getLogs', [{'fromBlock': '0x0', 'toBlock': hex(chain.head)}])
+    assert len(logs) == len(chain.events) == 73
+    assert [(int(log['blockNumber'], 16), int(log['logIndex'], 16)) for log in logs] == \
+        [(event[0], event[1]) for event in chain.events]
+    assert chain.respond({'id': 1, 'method': 'eth_foo'})['error']
+
+    crowded_chain = SyntheticChain(years=0.01, events_per_day=LOGS_LIMIT // 3)
+    response = crowded_chain.respond({'id': 2, 'method': 'eth_getLogs', 'params': [{'fromBlock': '0x0'}]})
+    assert "more than" in response['error']['message']
+
+
+def test_benchmarks_smoke(tmp_path):
+    """ The whole suite runs in a subprocess as it points the project globals to the stand-ins """
+    output_path = tmp_path / "results.json"
+    subprocess.run([sys.executable, "-m", "benchmarks.bench", "--years", "0.01", "--events-per-day", "30",
+                    "--repeat", "1", "--chats", "2", "--output", str(output_path)],
+                   cwd=Path(__file__).parent.parent, check=True, timeout=120)
+
+    results = json.loads(output_path.read_text())
+    assert results['backend'] == "sqlite"
+    assert results['config']['events_per_day'] == 30
+    ingestion = results['results']['ingestion']
+    assert ingestion['events'] == ingestion['confirmed_events'] > 0
+    assert ingestion['rpc_requests']['eth_getLogs'] >= 1
+    for name in ("get_events_24h", "summary_365d", "report_render", "report_cached"):
+        assert results['results'][name]['min'] <= results['results'][name]['median'] <= results['results'][name]['max']
+    assert results['results']['delivery']['sent'] == 2
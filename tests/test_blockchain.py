@@ -1,6 +1,28 @@
+import json
+import os
+import subprocess
+import sys
+from datetime import datetime
+import threading
+import time
+from itertools import islice
+from decimal import Decimal
+from http.server import HTTPServer, BaseHTTPRequestHandler
 import pytest
-from unittest.mock import MagicMock
-from blockchain.events import fetch_logs
+from unittest.mock import MagicMock, PropertyMock
+from hexbytes import HexBytes
+from web3 import Web3
+from settings import CONTRACT_ADDRESS, TOTAL_DISTRIBUTION_EVENT_ABI, TOTAL_DISTRIBUTION_EVENT_SIGNATURE_TEXT
+from blockchain.cache import LRUCache
+from blockchain.providers import ProviderPool, PoolProvider, ProviderError
+from eth_abi import encode
+from sqlalchemy import create_engine
+from sqlalchemy.pool import StaticPool
+from blockchain.registry import TOTAL_DISTRIBUTION, EventRegistry, EventSpec, compile_decoder, event_signature
+from db.database import store_events, store_scan_results, drop_pending_events, get_session
+from db.models import Base, TotalDistributionEvent
+from blockchain.events import fetch_logs, plan_chunks, get_block_timestamp, decode_logs, get_wallet_balances, \
+    follow_heads, find_block_by_time
 
 
 @pytest.fixture
@@ -14,6 +36,51 @@ def mock_web3(monkeypatch):
     return mock_web3
 
 
+@pytest.fixture
+def rpc_server(monkeypatch):
+    """ Local JSON-RPC server with a tiny fake chain, web3 in blockchain.events is pointed to it """
+    chain = {
+        'blocks': {'0x' + f"{block_number:064x}": {'number': hex(block_number),
+                                                   'timestamp': hex(1700000000 + block_number)}
+                   for block_number in range(1000, 1010)},
+        'transactions': {'0x' + f"{tx:064x}": {'from': '0x' + f"{tx:040x}"} for tx in range(1, 10)},
+        'http_requests': 0,
+    }
+
+    class JSONRPCHandler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            chain['http_requests'] += 1
+            payload = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+            responses = []
+            for request in (payload if isinstance(payload, list) else [payload]):
+                if request['method'] == 'eth_getBlockByHash':
+                    result = chain['blocks'].get(request['params'][0])
+                elif request['method'] == 'eth_getTransactionByHash':
+                    result = chain['transactions'].get(request['params'][0])
+                elif request['method'] == 'eth_getBalance':
+                    result = hex(10 ** 18 * int(request['params'][0], 16))
+                else:  # eth_blockNumber
+                    result = hex(1009)
+                responses.append({'jsonrpc': '2.0', 'id': request['id'], 'result': result})
+            body = json.dumps(responses if isinstance(payload, list) else responses[0]).encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = HTTPServer(('127.0.0.1', 0), JSONRPCHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    pool = ProviderPool([f"http://127.0.0.1:{server.server_port}"])
+    monkeypatch.setattr("blockchain.events.provider_pool", pool)
+    monkeypatch.setattr("blockchain.events.web3", Web3(PoolProvider(pool)))
+    yield chain
+    server.shutdown()
+
+
 def test_fetch_logs(mock_web3):
     expected_logs = [{'blockNumber': 12345, 'data': 'mocked_data', 'transactionHash': '0xhash'}]
     mock_web3.eth.get_logs.return_value = expected_logs
@@ -24,3 +91,310 @@ def test_fetch_logs(mock_web3):
 
     assert logs == expected_logs
     mock_web3.eth.get_logs.assert_called_once()
+
+
+def test_plan_chunks():
+    assert plan_chunks(100, 350, 100) == [(100, 199), (200, 299), (300, 350)]
+    assert plan_chunks(100, 100, 100) == [(100, 100)]
+
+
+def test_fetch_logs_bisects_too_big_range(mock_web3):
+    def get_logs(filter_params):
+        if filter_params['toBlock'] - filter_params['fromBlock'] >= 30:
+            raise ValueError({'code': -32005, 'message': 'query returned more than 10000 results'})
+        return [{'blockNumber': filter_params['fromBlock'], 'logIndex': 0}]
+
+    mock_web3.eth.get_logs.side_effect = get_logs
+
+    logs = fetch_logs(10000, 10099)
+
+    assert [log['blockNumber'] for log in logs] == [10000, 10025, 10050, 10075]
+
+
+def test_fetch_logs_failure(mock_web3):
+    mock_web3.eth.get_logs.side_effect = ConnectionError("provider is down")
+
+    assert fetch_logs(10000, 10100) is None
+
+
+def test_lru_cache(tmp_path):
+    cache = LRUCache(2, path=str(tmp_path / "cache.json"))
+    cache.set(1, 100)
+    cache.set(2, 200)
+    assert cache.get(1) == 100  # 1 is recently used now
+    cache.set(3, 300)  # evicts 2
+
+    assert cache.get(2) is None
+    assert cache.stats()['hits'] == 1 and cache.stats()['misses'] == 1
+
+    cache.save()
+    restored_cache = LRUCache(2, path=str(tmp_path / "cache.json"))
+    assert restored_cache.get(1) == 100 and restored_cache.get(3) == 300
+
+
+def test_get_block_timestamp_is_cached(mock_web3):
+    mock_web3.eth.get_block.return_value = {'timestamp': 1700000000}
+
+    assert get_block_timestamp('0x777') == 1700000000
+    assert get_block_timestamp('0x777') == 1700000000
+    mock_web3.eth.get_block.assert_called_once_with('0x777')
+
+
+def test_decode_logs(rpc_server):
+    logs = [{'address': CONTRACT_ADDRESS,
+             'topics': [HexBytes(TOTAL_DISTRIBUTION.topic)],
+             'blockNumber': 1000 + tx % 3,
+             'blockHash': HexBytes(f"{1000 + tx % 3:064x}"),
+             'logIndex': 0,
+             'transactionHash': HexBytes(f"{tx:064x}"),
+             'data': HexBytes(b"".join((tx * word).to_bytes(32, "big") for word in (1, 2, 3, 4)))}
+            for tx in range(1, 7)]
+
+    events = decode_logs(logs)
+
+    # all 3 blocks and 6 transactions are requested in a single HTTP request
+    assert rpc_server['http_requests'] == 1
+    assert events[0]['timestamp'] == datetime.utcfromtimestamp(1700001001)
+    assert events[0]['distributor_wallet'] == Web3.to_checksum_address('0x' + f"{1:040x}")
+    assert events[5]['input_aix_amount'] == Decimal(6)
+    assert events[5]['distributed_eth_amount'] == Decimal(24)
+
+
+def test_get_wallet_balances(rpc_server):
+    wallets = ['0x' + f"{wallet:040x}" for wallet in (1, 2, 2, 1, 3)]
+
+    balances = get_wallet_balances(wallets)
+    assert balances == {wallets[0]: 1, wallets[1]: 2, wallets[4]: 3}
+    # block number and a batch of 3 balances
+    assert rpc_server['http_requests'] == 2
+
+    # balances are cached
+    assert get_wallet_balances(wallets[:2]) == {wallets[0]: 1, wallets[1]: 2}
+    assert rpc_server['http_requests'] == 2
+
+
+def test_import_is_lazy():
+    # importing the whole program creates no clients and doesn't touch the network
+    code = ("import sys, run, blockchain.events, bot.bot, db.database; "
+            "assert blockchain.events.web3 is None and bot.bot.bot is None and db.database.engine is None; "
+            "assert 'web3' not in sys.modules")
+    project_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    subprocess.run([sys.executable, "-c", code], check=True, timeout=60, cwd=project_dir)
+
+
+def test_follow_heads_polling(mock_web3):
+    type(mock_web3.eth).block_number = PropertyMock(side_effect=[100, 100, 101, 101, 103])
+
+    assert list(islice(follow_heads(poll_interval=0, ws_url=None), 3)) == [100, 101, 103]
+
+
+def test_follow_heads_websocket():
+    from websockets.sync.server import serve
+
+    def fake_node(websocket):
+        request = json.loads(websocket.recv())
+        assert request['method'] == 'eth_subscribe' and request['params'] == ['newHeads']
+        websocket.send(json.dumps({'jsonrpc': '2.0', 'id': request['id'], 'result': '0xsubscription'}))
+        for head in (200, 201, 202):
+            websocket.send(json.dumps({'jsonrpc': '2.0', 'method': 'eth_subscription',
+                                       'params': {'subscription': '0xsubscription', 'result': {'number': hex(head)}}}))
+        websocket.recv()  # wait for the client to disconnect
+
+    with serve(fake_node, "127.0.0.1", 0) as server:
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        ws_url = f"ws://127.0.0.1:{server.socket.getsockname()[1]}"
+        heads = follow_heads(poll_interval=0, ws_url=ws_url)
+        assert list(islice(heads, 3)) == [200, 201, 202]
+        heads.close()
+        server.shutdown()
+
+
+def test_find_block_by_time(mock_web3):
+    # a block each 12 seconds from 2024-01-01
+    genesis = datetime(2024, 1, 1).timestamp() - datetime(1970, 1, 1).timestamp()
+    mock_web3.eth.block_number = 10000
+    mock_web3.eth.get_block.side_effect = lambda block: {'timestamp': genesis + block * 12}
+
+    assert find_block_by_time(datetime(2024, 1, 1, 0, 1)) == 5
+    assert find_block_by_time(datetime(2024, 1, 1, 0, 1, 1)) == 6
+    assert find_block_by_time(datetime(2023, 1, 1)) == 0
+    assert find_block_by_time(datetime(2025, 1, 1)) == 10001
+
+
+def start_rpc_endpoint(respond):
+    """ Local JSON-RPC endpoint, respond(request) returns (HTTP status, response body); stopped by shutdown() """
+    class Handler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            status, response = respond(json.loads(self.rfile.read(int(self.headers['Content-Length']))))
+            body = json.dumps(response).encode()
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = HTTPServer(('127.0.0.1', 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def test_provider_pool_failover_and_latency_routing():
+    calls = {'slow': 0, 'fast': 0, 'down': 0}
+
+    def endpoint(name, status=200, delay=0.0):
+        def respond(request):
+            calls[name] += 1
+            time.sleep(delay)
+            return status, {'jsonrpc': '2.0', 'id': request['id'], 'result': name}
+        return respond
+
+    servers = [start_rpc_endpoint(endpoint("down", status=503)), start_rpc_endpoint(endpoint("slow", delay=0.05)),
+               start_rpc_endpoint(endpoint("fast"))]
+    pool = ProviderPool([f"http://127.0.0.1:{server.server_port}/v3/KEY" for server in servers])
+    request = {'jsonrpc': '2.0', 'id': 1, 'method': 'eth_blockNumber', 'params': []}
+    try:
+        # not measured endpoints are tried first, failed one is skipped for a cooldown
+        assert pool.post(request)['result'] == "slow"
+        assert pool.post(request)['result'] == "fast"
+        for _ in range(5):
+            assert pool.post(request)['result'] == "fast"
+        assert calls == {'down': 1, 'slow': 1, 'fast': 6}
+
+        stats = pool.stats()
+        assert [stats[name]['healthy'] for name in stats] == [False, True, True]
+        assert list(stats.values())[0]['error_rate'] == 1.0
+        assert "KEY" not in str(stats)
+
+        # fast one is down too
+        servers[2].shutdown()
+        servers[2].server_close()
+        assert pool.post(request)['result'] == "slow"
+    finally:
+        for server in servers[:2]:
+            server.shutdown()
+
+
+def test_provider_pool_rate_limit_and_all_failed():
+    rate_limited = start_rpc_endpoint(lambda request: (200, {'jsonrpc': '2.0', 'id': request['id'], 'error': {
+        'code': -32005, 'message': "daily request count exceeded, request rate limited"}}))
+    bad_request = start_rpc_endpoint(lambda request: (200, {'jsonrpc': '2.0', 'id': request['id'], 'error': {
+        'code': -32602, 'message': "invalid argument"}}))
+    try:
+        pool = ProviderPool([f"http://127.0.0.1:{rate_limited.server_port}",
+                             f"http://127.0.0.1:{bad_request.server_port}"])
+        # request errors are not provider failures, they are returned as is
+        assert pool.post({'jsonrpc': '2.0', 'id': 1, 'method': 'eth_call', 'params': []})['error']['code'] == -32602
+        assert [stats['errors'] for stats in pool.stats().values()] == [1, 0]
+
+        pool = ProviderPool([f"http://127.0.0.1:{rate_limited.server_port}"])
+        with pytest.raises(ProviderError, match="rate limited"):
+            pool.post({'jsonrpc': '2.0', 'id': 1, 'method': 'eth_call', 'params': []})
+    finally:
+        rate_limited.shutdown()
+        bad_request.shutdown()
+
+
+TRANSFER_ABI = {"type": "event", "name": "Transfer", "inputs": [
+    {"name": "from", "type": "address", "indexed": True}, {"name": "to", "type": "address", "indexed": True},
+    {"name": "value", "type": "uint256", "indexed": False}]}
+TOKEN_ADDRESS = Web3.to_checksum_address("0x" + "70" * 20)
+
+
+def test_event_spec_from_abi():
+    assert event_signature(TOTAL_DISTRIBUTION_EVENT_ABI) == TOTAL_DISTRIBUTION_EVENT_SIGNATURE_TEXT
+    transfer = EventSpec(TRANSFER_ABI, [TOKEN_ADDRESS])
+    assert transfer.topic == "0xddf252ad1be2c89b69c2b068fc378daa952ba7f163c4a11628f55a4df523b3ef"
+    assert transfer.model.__tablename__ == "transfer_events"
+
+    registry = EventRegistry()
+    registry.register(TOTAL_DISTRIBUTION)
+    registry.register(transfer)
+    logs_filter = registry.logs_filter(1, 2)
+    assert logs_filter['address'] == [CONTRACT_ADDRESS, TOKEN_ADDRESS]
+    assert logs_filter['topics'] == [[TOTAL_DISTRIBUTION.topic, transfer.topic]]
+    assert registry.route({'address': TOKEN_ADDRESS.lower(), 'topics': [HexBytes(transfer.topic)]}) is transfer
+    # filter matches any tracked address with any tracked topic, but only tracked pairs are routed
+    assert registry.route({'address': CONTRACT_ADDRESS, 'topics': [HexBytes(transfer.topic)]}) is None
+    with pytest.raises(ValueError):
+        registry.register(EventSpec(TRANSFER_ABI, [CONTRACT_ADDRESS]))
+
+
+def test_compiled_decoder_matches_abi_decoder():
+    sender, receiver = "0x" + "11" * 20, "0x" + "22" * 20
+    decode = compile_decoder(TRANSFER_ABI['inputs'])
+    arguments = decode([HexBytes(EventSpec(TRANSFER_ABI, []).topic), HexBytes("0x" + "00" * 12 + sender[2:]),
+                        HexBytes("0x" + "00" * 12 + receiver[2:])], encode(['uint256'], [10 ** 30]))
+    assert arguments == {'from': Web3.to_checksum_address(sender), 'to': Web3.to_checksum_address(receiver),
+                         'value': Decimal(10 ** 30)}
+
+    # dynamic types are decoded by eth_abi, camelCase names become snake_case columns
+    decode = compile_decoder([{"name": "newName", "type": "string"}, {"name": "amounts", "type": "int256[]"}])
+    assert decode(["0x" + "00" * 32], encode(['string', 'int256[]'], ["AIX", [-1, 2]])) == \
+        {'new_name': "AIX", 'amounts': "[-1, 2]"}
+    with pytest.raises(ValueError):
+        compile_decoder(TRANSFER_ABI['inputs'])(["0x" + "00" * 32], b"")
+
+
+def test_batch_decoder_matches_single_log_decoder():
+    transfer = EventSpec(TRANSFER_ABI, [TOKEN_ADDRESS])
+    logs = [{'topics': [HexBytes(transfer.topic), HexBytes("0x" + "00" * 12 + f"{sender:040x}"),
+                        HexBytes("0x" + "00" * 12 + "22" * 20)], 'data': HexBytes(encode(['uint256'], [value]))}
+            for sender, value in ((1, 10 ** 30), (2, 0), (3, 7))]
+    assert transfer.decode_batch(logs) == [transfer.decode(log['topics'], log['data']) for log in logs]
+
+    distribution_logs = [{'topics': [HexBytes(TOTAL_DISTRIBUTION.topic)],
+                          'data': HexBytes(encode(['uint256'] * 4, [number, 2 * number, 3, 10 ** 40]))}
+                         for number in range(3)]
+    assert TOTAL_DISTRIBUTION.decode_batch(distribution_logs) == \
+        [TOTAL_DISTRIBUTION.decode(log['topics'], log['data']) for log in distribution_logs]
+    with pytest.raises(ValueError):
+        TOTAL_DISTRIBUTION.decode_batch(distribution_logs + [{'topics': [TOTAL_DISTRIBUTION.topic], 'data': b""}])
+
+
+def test_decode_and_store_tracked_events(rpc_server, monkeypatch):
+    engine = create_engine("sqlite://", connect_args={"check_same_thread": False}, poolclass=StaticPool)
+    transfer = EventSpec(TRANSFER_ABI, [TOKEN_ADDRESS])
+    Base.metadata.create_all(engine)
+    registry = EventRegistry()
+    registry.register(TOTAL_DISTRIBUTION)
+    registry.register(transfer)
+    monkeypatch.setattr("db.database.engine", engine)
+    monkeypatch.setattr("blockchain.events.event_registry", registry)
+    monkeypatch.setattr("db.database.event_registry", registry)
+
+    def make_log(address, topics, tx, data):
+        return {'address': address, 'topics': [HexBytes(topic) for topic in topics], 'blockNumber': 1005,
+                'blockHash': HexBytes(f"{1005:064x}"), 'logIndex': tx, 'transactionHash': HexBytes(f"{tx:064x}"),
+                'data': HexBytes(data)}
+    wallet_topic = "0x" + f"{7:064x}"
+    logs = [make_log(CONTRACT_ADDRESS, [TOTAL_DISTRIBUTION.topic], 7, encode(['uint256'] * 4, [1, 2, 3, 4])),
+            make_log(TOKEN_ADDRESS, [transfer.topic, wallet_topic, wallet_topic], 8, encode(['uint256'], [5])),
+            make_log(CONTRACT_ADDRESS, [transfer.topic, wallet_topic, wallet_topic], 9, encode(['uint256'], [6]))]
+
+    events = decode_logs(logs)
+
+    assert len(events) == 2  # Transfer of the TotalDistribution contract is not tracked
+    assert events[0]['input_aix_amount'] == Decimal(1) and 'event' not in events[0]
+    assert events[1]['event'] == "Transfer" and events[1]['value'] == Decimal(5)
+    assert events[1]['timestamp'] == datetime.utcfromtimestamp(1700001005)
+    assert rpc_server['http_requests'] == 1  # block and TotalDistribution transaction sender in one batch
+
+    assert store_events(events) == 1
+    assert store_events(events) == 0
+    with get_session() as session:
+        stored_transfer = session.query(transfer.model).one()
+        assert stored_transfer.address == TOKEN_ADDRESS and stored_transfer.to == Web3.to_checksum_address(
+            "0x" + f"{7:040x}")
+        assert session.query(TotalDistributionEvent).count() == 1
+
+    # tracked events of not confirmed blocks are stored at once and deleted if blocks are replaced
+    pending_transfer = dict(events[1], block=1010, tx_hash="0x10", log_index=0)
+    assert store_scan_results([], [pending_transfer], 1005, 1010, "0xhead") == 0
+    with get_session() as session:
+        assert session.query(transfer.model).count() == 2
+    assert drop_pending_events()
+    with get_session() as session:
+        assert session.query(transfer.model).count() == 1
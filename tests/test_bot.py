@@ -1,8 +1,21 @@
 import datetime
+import json
+import threading
+import time
 from decimal import Decimal
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from urllib.parse import parse_qs, urlparse
 import pytest
+import telebot
 from unittest.mock import MagicMock
-from bot.report import format_duration, prepare_report_data
+from sqlalchemy import create_engine
+from sqlalchemy.pool import StaticPool
+from bot import delivery
+from bot import bot as telegram_bot
+from bot.report import format_duration, prepare_report_data, summarize_events, ReportCache, parse_window
+from bot.report import create_report_message
+from db.database import get_session
+from db.models import Base, OutboxMessage
 
 
 @pytest.mark.parametrize("timedelta,expected", [
@@ -28,11 +41,198 @@ def test_get_report_data(mocker):
                   distributor_wallet=mock_wallet_address),
     ]
 
-    mocker.patch('bot.report.prepare_report_data', return_value=mock_events)
-    mocker.patch('blockchain.events.get_wallet_balance', return_value=Decimal('1.5'))  # Mock wallet balance
+    # Mock wallet balances, so no RPC requests are made
+    get_wallet_balances = mocker.patch('bot.report.get_wallet_balances',
+                                       return_value={mock_wallet_address: Decimal('1.5')})
 
     data = prepare_report_data(mock_events)
 
+    get_wallet_balances.assert_called_once_with([mock_wallet_address])
     assert data['aix_processed'] == Decimal('1')
+    assert data['aix_distributed'] == Decimal('0.5')
+    assert data['eth_bought'] == Decimal('2')
+    assert data['eth_distributed'] == Decimal('1')
+    assert data['distributor_wallets'] == {mock_wallet_address: Decimal('1.5')}
 
 
+def test_summarize_events():
+    now = datetime.datetime.utcnow()
+    mock_events = [
+        MagicMock(timestamp=now - datetime.timedelta(hours=hours), input_aix_amount=Decimal(10),
+                  distributed_aix_amount=Decimal(9), swapped_eth_amount=Decimal(2), distributed_eth_amount=Decimal(1),
+                  distributor_wallet=wallet)
+        for hours, wallet in ((1, "0xA"), (3, "0xB"), (2, "0xA"))]
+
+    summary = summarize_events(mock_events)
+
+    assert summary['first_timestamp'] == now - datetime.timedelta(hours=3)
+    assert summary['last_timestamp'] == now - datetime.timedelta(hours=1)
+    assert summary['input_aix_amount'] == Decimal(30)
+    assert summary['distributor_wallets'] == ["0xA", "0xB"]
+    assert summarize_events([]) is None
+
+
+@pytest.fixture
+def bot_api(monkeypatch):
+    """ Local fake Telegram Bot API server and in-memory outbox db.
+    Chat -1 is flooded (429 once), chat -2 gets server error once, chat -3 doesn't exist """
+    engine = create_engine("sqlite://", connect_args={"check_same_thread": False}, poolclass=StaticPool)
+    Base.metadata.create_all(engine)
+    monkeypatch.setattr("db.database.engine", engine)
+    api = {'sent': [], 'requests': 0}
+
+    class BotAPIHandler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            api['requests'] += 1
+            params = parse_qs(urlparse(self.path).query)  # telebot sends parameters in query string
+            chat_id = int(params['chat_id'][0])
+            attempts = sum(1 for request_chat_id in api.setdefault('attempts', []) if request_chat_id == chat_id)
+            api['attempts'].append(chat_id)
+            if chat_id == -1 and not attempts:
+                status, body = 429, {'ok': False, 'error_code': 429, 'description': "Too Many Requests: retry after 7",
+                                     'parameters': {'retry_after': 7}}
+            elif chat_id == -2 and not attempts:
+                status, body = 502, {'ok': False, 'error_code': 502, 'description': "Bad Gateway"}
+            elif chat_id == -3:
+                status, body = 400, {'ok': False, 'error_code': 400, 'description': "Bad Request: chat not found"}
+            else:
+                api['sent'].append((chat_id, params['text'][0]))
+                status, body = 200, {'ok': True, 'result': {'message_id': len(api['sent']), 'date': 0,
+                                                              'chat': {'id': chat_id, 'type': 'group'}}}
+            body = json.dumps(body).encode()
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = HTTPServer(('127.0.0.1', 0), BotAPIHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    monkeypatch.setattr(telebot.apihelper, "API_URL", f"http://127.0.0.1:{server.server_port}/bot{{0}}/{{1}}")
+    monkeypatch.setattr("bot.bot.bot", telebot.TeleBot("123:TEST"))
+    monkeypatch.setattr(delivery, "chat_buckets", {})
+    yield api
+    server.shutdown()
+
+
+def outbox():
+    with get_session() as session:
+        return {message.chat_id: (message.status, message.attempts, message.next_attempt_at)
+                for message in session.query(OutboxMessage)}
+
+
+def test_delivery_retries_and_survives_restart(bot_api):
+    delivery.queue_report("report", chat_ids=[-1, -2, -3, -4])
+    started_at = datetime.datetime.utcnow()
+    assert delivery.deliver_messages() == 1
+
+    assert bot_api['sent'] == [(-4, "report")]
+    messages = outbox()
+    assert set(messages) == {-1, -2, -3}
+    # 429 is retried after retry_after, 5xx after backoff, "chat not found" is not retried
+    assert messages[-1][:2] == ("pending", 1)
+    assert datetime.timedelta(seconds=6) < messages[-1][2] - started_at < datetime.timedelta(seconds=9)
+    assert messages[-2][:2] == ("pending", 1)
+    assert messages[-3][:2] == ("failed", 1)
+
+    # messages are not due yet
+    assert delivery.deliver_messages() == 0
+    assert len(bot_api['attempts']) == 4
+
+    # "restart": messages are in db, limiters are new, retry time has come
+    delivery.chat_buckets.clear()
+    with get_session() as session:
+        session.query(OutboxMessage).update({'next_attempt_at': started_at})
+        session.commit()
+    assert delivery.deliver_messages() == 2
+    assert sorted(bot_api['sent']) == [(-4, "report"), (-2, "report"), (-1, "report")]
+    assert outbox() == {-3: ("failed", 1, started_at)}
+
+
+def test_chat_rate_limit_postpones_messages(bot_api):
+    delivery.queue_report("first", chat_ids=[-4])
+    delivery.queue_report("second", chat_ids=[-4])
+
+    # group gets one message per 3 seconds, the second one waits in outbox
+    assert delivery.deliver_messages() == 1
+    assert bot_api['sent'] == [(-4, "first")]
+    assert outbox()[-4][:2] == ("pending", 0)
+
+
+def test_token_bucket():
+    bucket = delivery.TokenBucket(rate=10, capacity=2)
+    bucket.take()
+    assert bucket.delay() == 0
+    bucket.take()
+    assert 0.09 < bucket.delay() <= 0.1
+    bucket.pause(5)
+    assert 4.9 < bucket.delay() <= 5
+
+
+def test_report_cache_renders_once():
+    cache = ReportCache(ttl=60)
+    renders = []
+
+    def render():
+        renders.append(1)
+        time.sleep(0.05)
+        return "report"
+
+    # many chats / users at once
+    threads = [threading.Thread(target=cache.get, args=(('stats', 24), render)) for _ in range(20)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(renders) == 1
+    assert cache.get(('stats', 168), lambda: "weekly") == "weekly"
+
+    cache.invalidate()  # new events stored
+    assert cache.get(('stats', 24), render) == "report"
+    assert len(renders) == 2
+
+    stats = cache.stats()
+    assert (stats['hits'], stats['misses'], stats['renders']) == (19, 3, 3)
+    assert stats['avg_render_seconds'] > 0
+
+
+def test_report_cache_ttl():
+    cache = ReportCache(ttl=0)
+    assert cache.get("key", lambda: 1) == 1
+    assert cache.get("key", lambda: 2) == 2
+
+
+@pytest.mark.parametrize("window, hours", [("24h", 24), ("7d", 168), ("1H", 1)])
+def test_parse_window(window, hours):
+    assert parse_window(window) == hours
+
+
+@pytest.mark.parametrize("window", ["24", "0h", "1w", "1000d"])
+def test_parse_bad_window(window):
+    with pytest.raises(ValueError):
+        parse_window(window)
+
+
+def test_report_title():
+    data = {'first_tx_ago': "1h ago", 'last_tx_ago': "5m ago", 'aix_processed': 1, 'aix_distributed': 1,
+            'eth_bought': 1, 'eth_distributed': 1, 'distributor_wallets': {"0xA": Decimal('1.5')}}
+    assert "Daily $AIX Stats" in create_report_message(data)
+    assert "Weekly $AIX Stats" in create_report_message(data, hours=168)
+    assert "12h $AIX Stats" in create_report_message(data, hours=12)
+    assert "last 168 hours" in create_report_message(None, hours=168)
+
+
+def test_stats_command(mocker):
+    bot = MagicMock()
+    mocker.patch.object(telegram_bot, "get_bot", return_value=bot)
+    get_report = mocker.patch.object(telegram_bot, "get_report", return_value="report")
+
+    telegram_bot.stats_command(MagicMock(text="/stats 7d", chat=MagicMock(id=-1)))
+    get_report.assert_called_once_with(168)
+    bot.send_message.assert_called_once_with(-1, "report", parse_mode='MarkdownV2')
+
+    telegram_bot.stats_command(MagicMock(text="/stats week"))
+    assert "Usage" in bot.reply_to.call_args.args[1]
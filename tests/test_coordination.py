@@ -0,0 +1,61 @@
+import pytest
+from sqlalchemy import create_engine
+from sqlalchemy.pool import StaticPool
+from db.coordination import Coordinator, LeaseLocks, lock_key, REPORT_ROLE
+from db.database import acquire_lease, release_lease
+from db.models import Base
+
+
+@pytest.fixture
+def test_engine(monkeypatch):
+    engine = create_engine("sqlite://", connect_args={"check_same_thread": False}, poolclass=StaticPool)
+    Base.metadata.create_all(engine)
+    monkeypatch.setattr("db.database.engine", engine)
+    return engine
+
+
+def test_lease(test_engine):
+    assert acquire_lease("role", "a", ttl=60)
+    assert acquire_lease("role", "b", ttl=60) is False
+    assert acquire_lease("role", "a", ttl=60)  # renewed
+
+    assert release_lease("role", "b")  # not held by b, nothing changes
+    assert acquire_lease("role", "b", ttl=60) is False
+    assert release_lease("role", "a")
+    assert acquire_lease("role", "b", ttl=60)
+
+    # lease which is not renewed in time is taken over
+    assert acquire_lease("role", "b", ttl=-1)
+    assert acquire_lease("role", "a", ttl=60)
+
+
+def test_single_instance_has_role(test_engine):
+    changes = {'a': [], 'b': []}
+    instance_a = Coordinator(LeaseLocks("a"))
+    instance_b = Coordinator(LeaseLocks("b"))
+    assert instance_a.elect(REPORT_ROLE, on_change=changes['a'].append)
+    assert not instance_b.elect(REPORT_ROLE, on_change=changes['b'].append)
+    instance_b.renew_roles()
+    assert instance_a.holds(REPORT_ROLE) and not instance_b.holds(REPORT_ROLE)
+
+    # instance a stops, b takes the role on its next heartbeat
+    instance_a.stop()
+    instance_b.renew_roles()
+    assert instance_b.holds(REPORT_ROLE) and not instance_a.holds(REPORT_ROLE)
+    assert changes == {'a': [True], 'b': [True]}
+
+
+def test_role_is_kept_until_expiry_on_db_error(test_engine, monkeypatch):
+    instance = Coordinator(LeaseLocks("a"), ttl=60)
+    assert instance.elect(REPORT_ROLE)
+    monkeypatch.setattr("db.coordination.acquire_lease", lambda name, owner, ttl: None)  # db is down
+    instance.renew_roles()
+    assert instance.holds(REPORT_ROLE)
+
+    instance._held_until[REPORT_ROLE] = 0  # lease expired while db was down
+    assert not instance.holds(REPORT_ROLE)
+
+
+def test_lock_key():
+    assert lock_key("report") == lock_key("report") != lock_key("ingestion")
+    assert -2 ** 63 <= lock_key("report") < 2 ** 63
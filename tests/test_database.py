@@ -1,8 +1,10 @@
 import pytest
 import datetime
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, inspect, text
 from sqlalchemy.orm import sessionmaker
-from db.database import store_event, get_events
+from db.database import store_event, store_events, get_events, get_sync_cursor, set_sync_cursor, migrate_db, \
+    get_events_summary, rebuild_rollups
+from db.models import HourlyDistributionRollup
 from db.models import Base, TotalDistributionEvent
 
 TEST_DATABASE_URL = "sqlite:///:memory:"
@@ -52,4 +54,142 @@ def test_get_distribution_events_returns_correct_events(test_session):
     with test_session as db_test_session:
         recent_events = get_events(hours=24, db_session=db_test_session)
         # Verify that only events within the last 24 hours are returned
-        assert all(event.timestamp > datetime.datetime.utcnow() - datetime.timedelta(hours=24) for event in recent_events)
\ No newline at end of file
+        assert all(event.timestamp > datetime.datetime.utcnow() - datetime.timedelta(hours=24) for event in recent_events)
+
+
+def test_sync_cursor(test_session):
+    # no cursor before the first sync
+    assert get_sync_cursor(name="test_cursor", db_session=test_session) is None
+
+    assert set_sync_cursor(100, name="test_cursor", db_session=test_session)
+    assert set_sync_cursor(200, name="test_cursor", db_session=test_session)
+
+    assert get_sync_cursor(name="test_cursor", db_session=test_session) == 200
+
+
+def test_store_events_skips_stored_events(test_session):
+    events = [{
+        "block": 12346,
+        "tx_hash": "bulk_tx_hash",
+        "log_index": log_index,
+        "timestamp": datetime.datetime.utcnow(),
+        "distributor_wallet": "wallet_address",
+        "input_aix_amount": 1000,
+        "distributed_aix_amount": 900,
+        "swapped_eth_amount": 5,
+        "distributed_eth_amount": 4,
+    } for log_index in range(3)]
+
+    assert store_events(events[:2], db_session=test_session) == 2
+    # the first two events are already stored
+    assert store_events(events, db_session=test_session) == 1
+
+    with test_session as session:
+        assert session.query(TotalDistributionEvent).filter_by(tx_hash="bulk_tx_hash").count() == 3
+
+
+def test_migrate_db_upgrades_old_table():
+    engine = create_engine(TEST_DATABASE_URL)
+    with engine.begin() as connection:
+        # table as it was created by the first version
+        connection.execute(text("CREATE TABLE total_distribution_events (id INTEGER PRIMARY KEY, block BIGINT, "
+                                "tx_hash VARCHAR, timestamp DATETIME, distributor_wallet VARCHAR, "
+                                "input_aix_amount NUMERIC(38, 0), distributed_aix_amount NUMERIC(38, 0), "
+                                "swapped_eth_amount NUMERIC(38, 0), distributed_eth_amount NUMERIC(38, 0))"))
+
+    migrate_db(engine)
+    migrate_db(engine)  # nothing to do second time
+
+    inspector = inspect(engine)
+    assert "log_index" in {column['name'] for column in inspector.get_columns("total_distribution_events")}
+    assert {index['name'] for index in inspector.get_indexes("total_distribution_events")} == {
+        "uq_total_distribution_events_tx_hash_log_index",
+        "ix_total_distribution_events_timestamp",
+        "ix_total_distribution_events_block"}
+
+
+def test_migrated_events_are_not_stored_again():
+    engine = create_engine(TEST_DATABASE_URL)
+    now = datetime.datetime.utcnow()
+    with engine.begin() as connection:
+        connection.execute(text("CREATE TABLE total_distribution_events (id INTEGER PRIMARY KEY, block BIGINT, "
+                                "tx_hash VARCHAR, timestamp DATETIME, distributor_wallet VARCHAR, "
+                                "input_aix_amount NUMERIC(38, 0), distributed_aix_amount NUMERIC(38, 0), "
+                                "swapped_eth_amount NUMERIC(38, 0), distributed_eth_amount NUMERIC(38, 0))"))
+        connection.execute(text("INSERT INTO total_distribution_events (block, tx_hash, timestamp, "
+                                "distributor_wallet, input_aix_amount, distributed_aix_amount, swapped_eth_amount, "
+                                "distributed_eth_amount) VALUES (10, 'legacy_tx', :now, 'wallet', 1, 2, 3, 4)"),
+                           {'now': now})
+    migrate_db(engine)
+    Base.metadata.create_all(engine)
+    session = sessionmaker(bind=engine)()
+    assert rebuild_rollups(db_session=session)
+
+    # the first scan after the upgrade gets the legacy event and one more event of the same tx
+    event = {"block": 10, "block_hash": "0x10", "tx_hash": "legacy_tx", "timestamp": now,
+             "distributor_wallet": "wallet", "input_aix_amount": 1, "distributed_aix_amount": 2,
+             "swapped_eth_amount": 3, "distributed_eth_amount": 4}
+    assert store_events([dict(event, log_index=0), dict(event, log_index=1)], db_session=session) == 1
+    assert store_events([dict(event, log_index=0), dict(event, log_index=1)], db_session=session) == 0
+
+    events = session.query(TotalDistributionEvent).order_by(TotalDistributionEvent.log_index).all()
+    assert [(event.log_index, event.block_hash) for event in events] == [(0, "0x10"), (1, "0x10")]
+    assert get_events_summary(hours=1, db_session=session)['events_count'] == 2
+
+
+def test_get_events_summary_matches_events(test_session):
+    with test_session as session:
+        events = get_events(hours=24, db_session=session)
+        summary = get_events_summary(hours=24, db_session=session)
+
+    assert summary['events_count'] == len(events)
+    assert summary['first_timestamp'] == min(event.timestamp for event in events)
+    assert summary['distributed_eth_amount'] == sum(event.distributed_eth_amount for event in events)
+    assert summary['distributor_wallets'] == ["wallet_address"]
+
+
+def test_get_events_summary_no_events(test_session):
+    assert get_events_summary(hours=0, db_session=test_session) is None
+
+
+@pytest.fixture
+def history_session():
+    """ Session of a separate db with events every 50 minutes for the last 10 days """
+    engine = create_engine(TEST_DATABASE_URL)
+    Base.metadata.create_all(engine)
+    session = sessionmaker(bind=engine)()
+    now = datetime.datetime.utcnow()
+    store_events([{
+        "block": event_num,
+        "tx_hash": f"history_tx_{event_num}",
+        "log_index": 0,
+        "timestamp": now - datetime.timedelta(minutes=50 * event_num + 1),
+        "distributor_wallet": f"wallet_{event_num % 2}",
+        "input_aix_amount": event_num,
+        "distributed_aix_amount": 1,
+        "swapped_eth_amount": 2,
+        "distributed_eth_amount": 3,
+    } for event_num in range(300)], db_session=session)
+    return session
+
+
+@pytest.mark.parametrize("hours", [1, 5, 30, 24 * 7, 24 * 30])
+def test_get_events_summary_from_rollups(history_session, hours):
+    events = get_events(hours=hours, db_session=history_session)
+    summary = get_events_summary(hours=hours, db_session=history_session)
+
+    assert summary['events_count'] == len(events)
+    assert summary['first_timestamp'] == min(event.timestamp for event in events)
+    assert summary['last_timestamp'] == max(event.timestamp for event in events)
+    assert summary['input_aix_amount'] == sum(event.input_aix_amount for event in events)
+    assert set(summary['distributor_wallets']) == {event.distributor_wallet for event in events}
+
+
+def test_rebuild_rollups(history_session):
+    summary = get_events_summary(hours=24 * 7, db_session=history_session)
+    with history_session as session:
+        session.query(HourlyDistributionRollup).delete()
+        session.commit()
+
+    assert rebuild_rollups(db_session=history_session)
+    assert get_events_summary(hours=24 * 7, db_session=history_session) == summary
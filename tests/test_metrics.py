@@ -0,0 +1,64 @@
+import urllib.error
+import urllib.request
+import pytest
+from metrics import Metrics, start_metrics_server
+
+
+def test_counters_and_histograms():
+    metrics = Metrics(buckets=(0.1, 1))
+    metrics.inc("rpc_requests_total", method="eth_getLogs")
+    metrics.inc("rpc_requests_total", 2, method="eth_getLogs")
+    metrics.observe("stage_seconds", 0.05, stage="fetch_logs")
+    metrics.observe("stage_seconds", 0.5, stage="fetch_logs")
+    metrics.observe("stage_seconds", 5, stage="fetch_logs")
+    metrics.add_collector(lambda: [("cache_hits_total", {'cache': "blocks"}, 7)])
+
+    assert metrics.render().splitlines() == [
+        '# TYPE aix_cache_hits_total counter',
+        'aix_cache_hits_total{cache="blocks"} 7',
+        '# TYPE aix_rpc_requests_total counter',
+        'aix_rpc_requests_total{method="eth_getLogs"} 3',
+        '# TYPE aix_stage_seconds histogram',
+        'aix_stage_seconds_bucket{stage="fetch_logs",le="0.1"} 1',
+        'aix_stage_seconds_bucket{stage="fetch_logs",le="1"} 2',
+        'aix_stage_seconds_bucket{stage="fetch_logs",le="+Inf"} 3',
+        'aix_stage_seconds_sum{stage="fetch_logs"} 5.55',
+        'aix_stage_seconds_count{stage="fetch_logs"} 3',
+    ]
+
+
+def test_timed_and_summary():
+    metrics = Metrics()
+
+    @metrics.timed("decode_logs")
+    def decode(fail=False):
+        if fail:
+            raise ValueError("bad log")
+        return "decoded"
+
+    assert decode() == "decoded"
+    snapshot = metrics.snapshot()
+    assert metrics.summary(snapshot) == "no activity"
+
+    with pytest.raises(ValueError):
+        decode(fail=True)
+    metrics.inc("db_rows_written_total", 5, table="events")
+
+    summary = metrics.summary(snapshot)
+    assert 'stage_seconds{stage="decode_logs"}=' in summary and summary.split(", ")[0].endswith("s/1")
+    assert 'stage_errors_total{stage="decode_logs"}=1' in summary
+    assert 'db_rows_written_total{table="events"}=5' in summary
+
+
+def test_metrics_server():
+    metrics = Metrics()
+    metrics.inc("telegram_messages_total", status="sent")
+    server = start_metrics_server(0, registry=metrics)
+    try:
+        url = f"http://127.0.0.1:{server.server_port}"
+        with urllib.request.urlopen(f"{url}/metrics") as response:
+            assert 'aix_telegram_messages_total{status="sent"} 1' in response.read().decode()
+        with pytest.raises(urllib.error.HTTPError):
+            urllib.request.urlopen(f"{url}/other")
+    finally:
+        server.shutdown()
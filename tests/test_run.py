@@ -0,0 +1,282 @@
+import datetime
+import asyncio
+import threading
+import pytest
+from sqlalchemy import create_engine
+from sqlalchemy.pool import StaticPool
+import run
+from db.models import Base, TotalDistributionEvent, PendingDistributionEvent
+from db.coordination import Coordinator, LeaseLocks, REPORT_ROLE, INGESTION_ROLE
+from db.database import get_session, acquire_lease, release_lease
+from db.spool import Spool, flush_spool
+
+
+@pytest.fixture
+def fake_chain(monkeypatch):
+    """ In-memory db and a fake chain: blocks hashes and events by block num """
+    engine = create_engine("sqlite://", connect_args={"check_same_thread": False}, poolclass=StaticPool)
+    Base.metadata.create_all(engine)
+    monkeypatch.setattr("db.database.engine", engine)
+
+    chain = {'head': 20, 'hashes': {block: f"a{block}" for block in range(1, 30)}, 'events': {}}
+
+    def add_event(block, tx_hash):
+        chain['events'][block] = [{
+            "block": block, "block_hash": chain['hashes'][block], "tx_hash": tx_hash, "log_index": 0,
+            "timestamp": datetime.datetime.utcnow(), "distributor_wallet": "wallet",
+            "input_aix_amount": 1, "distributed_aix_amount": 1, "swapped_eth_amount": 1, "distributed_eth_amount": 1}]
+    chain['add_event'] = add_event
+
+    monkeypatch.setattr(run, "SPOOL_DIR", None)  # stored into db directly, spool_chain fixture turns spool on
+    monkeypatch.setattr(run, "spool", None)
+    monkeypatch.setattr(run, "CONFIRMATION_BLOCKS", 2)
+    monkeypatch.setattr(run, "INITIAL_SCAN_BLOCKS", 10)
+    monkeypatch.setattr(run, "BACKFILL_FROM_BLOCK", None)
+    monkeypatch.setattr(run, "last_block", lambda: chain['head'])
+    monkeypatch.setattr(run, "get_block_hash", lambda block: chain['hashes'][block])
+    monkeypatch.setattr(run, "fetch_logs", lambda start_block, end_block: [
+        event for block in range(start_block, end_block + 1) for event in chain['events'].get(block, [])])
+    monkeypatch.setattr(run, "decode_logs", lambda logs: [dict(log) for log in logs])
+    monkeypatch.setattr(run, "save_rpc_caches", lambda: None)
+    return chain
+
+
+@pytest.fixture
+def spool_chain(fake_chain, monkeypatch, tmp_path):
+    """ fake_chain with scan results spooled in a temp dir """
+    monkeypatch.setattr(run, "spool", Spool(str(tmp_path / "spool")))
+    fake_chain['tmp_path'] = tmp_path
+    return fake_chain
+
+
+def stored_tx_hashes(model):
+    with get_session() as session:
+        return [event.tx_hash for event in session.query(model).order_by(model.block)]
+
+
+def test_reorg_replaces_pending_events(fake_chain):
+    fake_chain['add_event'](15, "tx15")
+    fake_chain['add_event'](19, "tx19")
+    run.get_and_process_blockchain_logs()
+
+    # block 19 is not 2 blocks deep yet
+    assert stored_tx_hashes(TotalDistributionEvent) == ["tx15"]
+    assert stored_tx_hashes(PendingDistributionEvent) == ["tx19"]
+
+    # blocks 19 and 20 are replaced, tx19 moved to block 20
+    fake_chain['hashes'].update({19: "b19", 20: "b20"})
+    fake_chain['events'].pop(19)
+    fake_chain['add_event'](20, "tx19")
+    fake_chain['head'] = 21
+    run.get_and_process_blockchain_logs()
+
+    assert stored_tx_hashes(TotalDistributionEvent) == ["tx15"]
+    assert stored_tx_hashes(PendingDistributionEvent) == ["tx19"]
+
+    # block 20 is confirmed now
+    fake_chain['head'] = 23
+    run.get_and_process_blockchain_logs()
+
+    assert stored_tx_hashes(TotalDistributionEvent) == ["tx15", "tx19"]
+    assert stored_tx_hashes(PendingDistributionEvent) == []
+    with get_session() as session:
+        assert session.query(TotalDistributionEvent).filter_by(tx_hash="tx19").one().block_hash == "b20"
+
+
+def fake_outbox(monkeypatch, sent_reports, deliver=None):
+    """ Reports are built as "report 24h", queued into a list and moved to sent_reports by deliver_messages() """
+    outbox = []
+
+    def deliver_messages():
+        if deliver:
+            deliver()
+        sent_reports.extend(outbox)
+        outbox.clear()
+
+    monkeypatch.setattr(run, "build_report", lambda hours: f"report {hours}h")
+    monkeypatch.setattr(run, "queue_report", lambda report: outbox.append(report) or True)
+    monkeypatch.setattr(run, "deliver_messages", deliver_messages)
+    monkeypatch.setattr(run, "running_jobs", {})
+    return outbox
+
+
+def test_slow_ingestion_does_not_block_report(monkeypatch):
+    release_ingestion = threading.Event()
+    ingestion_runs = []
+    sent_reports = []
+
+    def slow_ingestion():
+        ingestion_runs.append(1)
+        release_ingestion.wait(5)
+
+    monkeypatch.setattr(run, "get_and_process_blockchain_logs", slow_ingestion)
+    fake_outbox(monkeypatch, sent_reports)
+
+    async def scenario():
+        ingestion = asyncio.create_task(run.ingestion_job())
+        await asyncio.sleep(0.05)
+        await run.ingestion_job()  # previous run is still going, so this one is skipped
+        await run.report_job(hours=24)
+        await asyncio.gather(*run.delivery_tasks)
+        assert sent_reports == ["report 24h"]
+        assert not ingestion.done()
+        release_ingestion.set()
+        await ingestion
+
+    asyncio.run(scenario())
+    assert len(ingestion_runs) == 1
+
+
+def test_replicas_run_jobs_of_their_roles(fake_chain, monkeypatch):
+    sent_reports = []
+    fake_outbox(monkeypatch, sent_reports)
+    monkeypatch.setattr(run, "COORDINATION", True)
+    # this instance has ingestion role, another one has report role
+    monkeypatch.setattr("db.coordination.coordinator", Coordinator(LeaseLocks("this instance")))
+    assert acquire_lease(REPORT_ROLE, "other instance", ttl=60)
+    assert run.get_coordinator().elect(INGESTION_ROLE)
+    assert not run.get_coordinator().elect(REPORT_ROLE)
+    fake_chain['add_event'](15, "tx15")
+
+    async def scenario():
+        await run.ingestion_job()
+        await run.report_job(hours=24)
+        await asyncio.gather(*run.delivery_tasks)
+
+    asyncio.run(scenario())
+    assert stored_tx_hashes(TotalDistributionEvent) == ["tx15"]
+    assert sent_reports == []
+
+    # the other instance is gone, its role is taken over on the next heartbeat
+    assert release_lease(REPORT_ROLE, "other instance")
+    run.get_coordinator().renew_roles()
+    asyncio.run(scenario())
+    assert sent_reports == ["report 24h"]
+
+
+def test_report_is_queued_while_delivery_is_running(monkeypatch):
+    release_delivery = threading.Event()
+    delivery_runs = []
+    sent_reports = []
+    outbox = fake_outbox(monkeypatch, sent_reports, deliver=lambda: delivery_runs.append(release_delivery.wait(5)))
+
+    async def scenario():
+        delivery = asyncio.create_task(run.delivery_job())
+        await asyncio.sleep(0.05)
+        # delivery run of the report is skipped, the report waits in the outbox
+        await run.report_job(hours=24)
+        await asyncio.gather(*run.delivery_tasks)
+        assert outbox == ["report 24h"]
+        release_delivery.set()
+        await delivery
+        await run.delivery_job()
+
+    asyncio.run(scenario())
+    assert len(delivery_runs) == 2
+    assert sent_reports == ["report 24h"]
+
+
+def test_job_timeout(monkeypatch):
+    release_job = threading.Event()
+    monkeypatch.setattr(run, "running_jobs", {})
+    monkeypatch.setitem(run.JOB_TIMEOUTS, "report", 0.05)
+
+    assert asyncio.run(run.run_job("report", release_job.wait, 5)) is None
+    # timed out run is abandoned, the next one is skipped until it finishes
+    assert asyncio.run(run.run_job("report", lambda: "report")) is None
+    release_job.set()
+    run.running_jobs["report"].result()
+    assert asyncio.run(run.run_job("report", lambda: "report")) == "report"
+
+
+def test_spool_keeps_ingesting_while_db_is_down(spool_chain, monkeypatch):
+    fetched_ranges = []
+    fetch_logs = run.fetch_logs
+    monkeypatch.setattr(run, "fetch_logs", lambda start_block, end_block: fetched_ranges.append(
+        (start_block, end_block)) or fetch_logs(start_block, end_block))
+    spool_chain['add_event'](15, "tx15")
+    spool_chain['add_event'](19, "tx19")
+    run.get_and_process_blockchain_logs()
+
+    with monkeypatch.context() as db_down:
+        db_down.setattr("db.spool.store_scan_results", lambda *args: None)
+        db_down.setattr(run, "get_sync_cursor", lambda *args, **kwargs: pytest.fail("cursors are in spool"))
+        assert flush_spool(run.spool) is None
+        spool_chain['add_event'](22, "tx22")
+        spool_chain['head'] = 23
+        run.get_and_process_blockchain_logs()
+
+    # the second scan went on from the spooled cursor, nothing is fetched twice
+    assert fetched_ranges == [(8, 20), (21, 23)]
+    assert stored_tx_hashes(TotalDistributionEvent) == []
+    assert run.spool.backlog() == 2
+
+    assert flush_spool(run.spool) == 2
+    assert stored_tx_hashes(TotalDistributionEvent) == ["tx15", "tx19"]
+    assert stored_tx_hashes(PendingDistributionEvent) == ["tx22"]
+    # cursors of the stored records stay in spool, so the next scan doesn't need db
+    assert run.spool.backlog() == 0
+    assert run.spool.cursors() == {TotalDistributionEvent.__tablename__: (21, None),
+                                   PendingDistributionEvent.__tablename__: (23, "a23")}
+    assert run.get_cursor() == 21 == run.get_sync_cursor()
+
+
+def test_spool_without_cursors_postpones_scan_while_db_is_down(spool_chain, monkeypatch):
+    fetched_ranges = []
+    fetch_logs = run.fetch_logs
+    monkeypatch.setattr(run, "fetch_logs", lambda start_block, end_block: fetched_ranges.append(
+        (start_block, end_block)) or fetch_logs(start_block, end_block))
+    unreachable_engine = create_engine(f"sqlite:///{spool_chain['tmp_path']}/no/such/dir/db.sqlite")
+
+    # new spool doesn't know cursors, db down isn't taken for the first start
+    with monkeypatch.context() as db_down:
+        db_down.setattr("db.database.engine", unreachable_engine)
+        run.get_and_process_blockchain_logs()
+    assert fetched_ranges == [] and run.spool.backlog() == 0
+
+    run.get_and_process_blockchain_logs()
+    assert flush_spool(run.spool) == 0
+    assert fetched_ranges == [(8, 20)]
+
+    # everything is stored, the reopened spool still knows the cursors
+    monkeypatch.setattr(run, "spool", Spool(run.spool.path))
+    with monkeypatch.context() as db_down:
+        db_down.setattr("db.database.engine", unreachable_engine)
+        spool_chain['head'] = 23
+        run.get_and_process_blockchain_logs()
+    assert fetched_ranges == [(8, 20), (21, 23)]
+    assert run.spool.backlog() == 1
+
+
+def test_reorg_with_spool(spool_chain):
+    spool_chain['add_event'](15, "tx15")
+    spool_chain['add_event'](19, "tx19")
+    run.get_and_process_blockchain_logs()
+    spool_chain['hashes'].update({19: "b19", 20: "b20"})
+    spool_chain['events'].pop(19)
+    spool_chain['add_event'](20, "tx19")
+    spool_chain['head'] = 21
+    run.get_and_process_blockchain_logs()  # reorg is detected by the spooled cursor hash
+
+    assert flush_spool(run.spool) == 1
+    assert stored_tx_hashes(TotalDistributionEvent) == ["tx15"]
+    assert stored_tx_hashes(PendingDistributionEvent) == ["tx19"]
+    with get_session() as session:
+        assert session.query(PendingDistributionEvent).one().block_hash == "b20"
+
+
+def test_spool_drops_torn_record(tmp_path):
+    spool = Spool(str(tmp_path), segment_size=60)
+    for block in range(3):
+        spool.append({'type': "drop_pending", 'block': block})
+    spool.close()
+    segments = spool.segments()
+    assert len(segments) == 2  # the third record starts the next segment
+    with open(segments[-1][1], "a") as segment_file:
+        segment_file.write('4 0000abcd {"type": "dro')  # crash in the middle of a write
+
+    reopened_spool = Spool(str(tmp_path))
+    assert [record['block'] for _, record in reopened_spool.read()] == [0, 1, 2]
+    assert reopened_spool.append({'type': "drop_pending", 'block': 3}) == 4
+    reopened_spool.checkpoint(2)
+    assert [seq for seq, _ in Spool(str(tmp_path)).read()] == [3, 4]
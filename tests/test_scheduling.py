@@ -0,0 +1,44 @@
+import datetime
+import pytest
+from scheduling import parse_schedule, compile_schedule, check_schedules_overlap
+
+
+@pytest.mark.parametrize("spec, first_times", [
+    ("every 30m at :28/:58", ["00:28", "00:58", "01:28"]),
+    ("every 30m at :28", ["00:28", "00:58", "01:28"]),
+    ("every 4h", ["00:00", "04:00", "08:00"]),
+    ("every 2h at 9:30", ["01:30", "03:30", "05:30"]),
+    ("Every 15m", ["00:00", "00:15", "00:30"]),
+])
+def test_parse_schedule(spec, first_times):
+    times = parse_schedule(spec)
+    assert [f"{time // 3600:02d}:{time % 3600 // 60:02d}" for time in times[:3]] == first_times
+
+
+@pytest.mark.parametrize("spec", ["every 7m", "every 5h", "every 0m", "each 30m", "every 30m at 28", "every 1h at :60",
+                                  "every 4h at 0:30/1:15"])
+def test_bad_schedule(spec):
+    with pytest.raises(ValueError):
+        compile_schedule(spec)
+
+
+def test_compile_schedule():
+    trigger = compile_schedule("every 30m at :28/:58", timezone="UTC")
+    now = datetime.datetime(2024, 3, 1, 10, 30, tzinfo=datetime.timezone.utc)
+    assert trigger.get_next_fire_time(None, now) == now.replace(minute=58)
+
+    trigger = compile_schedule("every 4h", jitter=60, timezone="UTC")
+    next_fire_time = trigger.get_next_fire_time(None, now)
+    assert now.replace(hour=12, minute=0) <= next_fire_time <= now.replace(hour=12, minute=1)
+
+
+def test_check_schedules_overlap():
+    check_schedules_overlap("every 30m at :28/:58", "every 1h", ingest_duration=60, ingest_jitter=30)
+    check_schedules_overlap("every 30m at :28/:58", "every 4h at 1:00", ingest_duration=60)
+
+    with pytest.raises(ValueError, match="overlaps"):
+        check_schedules_overlap("every 30m at :28/:58", "every 1h", ingest_duration=90, ingest_jitter=30)
+    with pytest.raises(ValueError, match="overlaps"):  # same minute
+        check_schedules_overlap("every 1h", "every 4h", ingest_duration=0)
+    with pytest.raises(ValueError, match="overlaps"):  # jittered report may start after ingestion
+        check_schedules_overlap("every 1h at :01", "every 1h", ingest_duration=30, report_jitter=90)